@@ -0,0 +1,96 @@
+#! /usr/bin/env python3
+"""
+Compares the server engines (SocketServer/FileServer vs. AsyncFileServer) under the same load: concurrent clients
+repeatedly uploading and downloading a file, each transfer over a new connection.
+"""
+import os, socket, sys, threading, time
+
+dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.abspath(os.path.join(dir, '../src')))
+
+import lib.params as params
+import protocol
+
+flags = (
+    (('-l', '--listenPort'), 'listenPort', 50111),
+    (('-c', '--clients'), 'clients', 16),
+    (('-s', '--fileSize'), 'fileSize', 1 << 20),
+    (('-n', '--rounds'), 'rounds', 20),  # upload + download rounds per client
+    (('-?', '--usage'), "usage", False),  # boolean (set if present)
+)
+
+ENGINES = ('select', 'asyncio')
+
+
+def run_client(port: int, client_id: int, data: bytes, rounds: int, latencies: list, errors: list):
+    fname = 'bench-engines-%d.bin' % client_id
+    try:
+        for _ in range(rounds):
+            for action in ('U', 'D'):
+                start = time.perf_counter()
+                with socket.create_connection(('localhost', port)) as sock:
+                    if action == 'U':
+                        protocol.upload(sock, fname, data)
+                    elif protocol.download(sock, fname) != data:
+                        raise RuntimeError("Downloaded file differs")
+                latencies.append(time.perf_counter() - start)
+    except Exception as e:
+        errors.append(e)
+
+
+def bench(engine: str, port: int, clients: int, data: bytes, rounds: int):
+    server = protocol.start_server(port, '-e', engine, '-c', str(clients * 2))
+    latencies, errors = [], []
+    try:
+        cpu = protocol.cpu_seconds(server.pid)
+        start = time.perf_counter()
+
+        threads = [
+            threading.Thread(target=run_client, args=(port, i, data, rounds, latencies, errors))
+            for i in range(clients)
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        elapsed = time.perf_counter() - start
+        cpu = protocol.cpu_seconds(server.pid) - cpu
+    finally:
+        protocol.stop_server(server)
+        for i in range(clients):
+            try:
+                os.remove(os.path.join(protocol.SERVER_DATA_DIR, 'bench-engines-%d.bin' % i))
+            except FileNotFoundError:
+                pass
+
+    if errors:
+        raise errors[0]
+
+    return {
+        'throughput': len(latencies) * len(data) / elapsed / (1 << 20),
+        'transfers': len(latencies) / elapsed,
+        'p50': protocol.percentile(latencies, 50) * 1000,
+        'p99': protocol.percentile(latencies, 99) * 1000,
+        'cpu': cpu,
+    }
+
+
+if __name__ == '__main__':
+    param_map = params.parseParams(flags)
+    if param_map['usage']:
+        params.usage()
+        sys.exit(0)
+
+    port, clients, size, rounds = (
+        int(param_map['listenPort']), int(param_map['clients']), int(param_map['fileSize']), int(param_map['rounds'])
+    )
+    data = os.urandom(size)
+
+    print('%d clients x %d rounds of upload + download of %dB' % (clients, rounds, size))
+    print('%-8s %10s %12s %10s %10s %14s' % ('engine', 'MiB/s', 'transfers/s', 'p50 (ms)', 'p99 (ms)', 'server CPU (s)'))
+
+    for engine in ENGINES:
+        r = bench(engine, port, clients, data, rounds)
+        print('%-8s %10.1f %12.1f %10.2f %10.2f %14.2f'
+              % (engine, r['throughput'], r['transfers'], r['p50'], r['p99'], r['cpu']))
@@ -0,0 +1,219 @@
+#! /usr/bin/env python3
+"""
+Load test of the file server over a matrix of file sizes, upload/download mixes and numbers of concurrent clients.
+For each cell of the matrix a fresh server (src/server/main.py) is started, `connections` client threads make
+`rounds` transfers each (each transfer over a new connection), and the throughput, the latency percentiles and
+the server's CPU time and peak RSS (including pre-forked workers) are measured.
+
+The results are saved as JSON, a previous result file can be given to compare against (e.g. of another commit).
+Optionally the clients connect through stammer-proxy, which forwards the data in randomly sized pieces.
+"""
+import json, os, random, shlex, shutil, socket, subprocess, sys, threading, time
+
+dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.abspath(os.path.join(dir, '../src')))
+
+import lib.params as params
+import protocol
+
+flags = (
+    (('-l', '--listenPort'), 'listenPort', 50121),
+    (('-s', '--sizes'), 'sizes', '4k,256k,4m'),  # file sizes (k/m/g suffixes)
+    (('-u', '--uploads'), 'uploads', '0,0.5,1'),  # fractions of the transfers that are uploads
+    (('-c', '--connections'), 'connections', '1,16'),  # numbers of concurrent clients
+    (('-n', '--rounds'), 'rounds', 20),  # transfers per client
+    (('-a', '--serverArgs'), 'serverArgs', 'none'),  # extra arguments of the server, e.g. "-t 2 -w 2"
+    (('-P', '--proxyPort'), 'proxyPort', '0'),  # connect through stammer-proxy listening on this port, 0 = off
+    (('-p', '--proxyDelay'), 'proxyDelay', '0.001'),  # pause of the proxy after a partial send
+    (('-o', '--output'), 'output', 'auto'),  # result file, auto = bench/results/<commit>.json
+    (('-C', '--compare'), 'compare', 'none'),  # previous result file to compare against
+    (('-?', '--usage'), "usage", False),  # boolean (set if present)
+)
+
+# the file downloaded by the clients, uploaded before each cell
+DOWNLOAD_FNAME = os.path.join(protocol.BENCH_FOLDER, 'bench-load.bin')
+
+
+def parse_size(size: str) -> int:
+    """
+    Parse a size with an optional k/m/g suffix (binary units).
+    """
+    size = size.strip().lower()
+    if size and size[-1] in 'kmg':
+        return int(float(size[:-1]) * (1 << (10 * ('kmg'.index(size[-1]) + 1))))
+
+    return int(size)
+
+
+def run_client(port: int, client_id: int, data: bytes, rounds: int, upload_ratio: float, latencies: dict,
+               errors: list):
+    """
+    A client thread, makes `rounds` transfers, each is an upload with the probability `upload_ratio`.
+    """
+    fname = os.path.join(protocol.BENCH_FOLDER, 'bench-load-%d.bin' % client_id)
+    rand = random.Random(client_id)  # the same sequence of actions in each run
+    for _ in range(rounds):
+        action = 'U' if rand.random() < upload_ratio else 'D'
+        start = time.perf_counter()
+        try:
+            with socket_to(port) as sock:
+                if action == 'U':
+                    protocol.upload(sock, fname, data)
+                elif protocol.download(sock, DOWNLOAD_FNAME) != data:
+                    raise RuntimeError("Downloaded file differs")
+        except Exception as e:
+            errors.append('%s: %s' % (type(e).__name__, e))
+            continue
+
+        latencies[action].append(time.perf_counter() - start)
+
+
+def socket_to(port: int):
+    return socket.create_connection(('localhost', port), timeout=60)
+
+
+def sample_rss(pid: int, peak: list, stop: threading.Event):
+    """
+    Track the peak RSS of the server (and its workers) until stopped.
+    """
+    while not stop.wait(0.05):
+        peak[0] = max(peak[0], protocol.rss_bytes(pid))
+
+
+def summarize(latencies: list) -> dict:
+    """
+    Latency percentiles in milliseconds.
+    """
+    return {
+        'p50': round(protocol.percentile(latencies, 50) * 1000, 3),
+        'p90': round(protocol.percentile(latencies, 90) * 1000, 3),
+        'p99': round(protocol.percentile(latencies, 99) * 1000, 3),
+        'max': round(max(latencies, default=0.0) * 1000, 3),
+    }
+
+
+def bench(port: int, server_args: list, size: int, upload_ratio: float, connections: int, rounds: int,
+          proxy_port: int, proxy_delay: float) -> dict:
+    """
+    Run a single cell of the matrix.
+    """
+    data = os.urandom(size)
+    os.makedirs(os.path.join(protocol.SERVER_DATA_DIR, protocol.BENCH_FOLDER), exist_ok=True)
+    server = protocol.start_server(port, '-c', str(max(100, connections * 2)), *server_args)
+    proxy = protocol.start_proxy(proxy_port, port, proxy_delay) if proxy_port else None
+    latencies, errors = {'U': [], 'D': []}, []
+    peak_rss, stop = [protocol.rss_bytes(server.pid)], threading.Event()
+    sampler = threading.Thread(target=sample_rss, args=(server.pid, peak_rss, stop))
+    try:
+        with socket_to(port) as sock:
+            protocol.upload(sock, DOWNLOAD_FNAME, data)
+
+        sampler.start()
+        cpu = protocol.tree_cpu_seconds(server.pid)
+        start = time.perf_counter()
+
+        threads = [
+            threading.Thread(
+                target=run_client,
+                args=(proxy_port or port, i, data, rounds, upload_ratio, latencies, errors)
+            )
+            for i in range(connections)
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        elapsed = time.perf_counter() - start
+        cpu = protocol.tree_cpu_seconds(server.pid) - cpu
+    finally:
+        stop.set()
+        if sampler.is_alive():
+            sampler.join()
+        if proxy is not None:
+            proxy.kill()
+            proxy.wait()
+        protocol.stop_server(server)
+        shutil.rmtree(os.path.join(protocol.SERVER_DATA_DIR, protocol.BENCH_FOLDER), ignore_errors=True)
+
+    transfers = len(latencies['U']) + len(latencies['D'])
+    return {
+        'size': size, 'uploads': upload_ratio, 'connections': connections,
+        'transfers': transfers, 'errors': len(errors), 'first_error': errors[0] if errors else None,
+        'elapsed': round(elapsed, 3),
+        'throughput': round(transfers * size / elapsed / (1 << 20), 2),  # MiB/s
+        'transfers_per_s': round(transfers / elapsed, 2),
+        'latency': summarize(latencies['U'] + latencies['D']),
+        'upload_latency': summarize(latencies['U']), 'download_latency': summarize(latencies['D']),
+        'server_cpu': round(cpu, 3),  # seconds
+        'server_rss': peak_rss[0],  # bytes
+    }
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=protocol.ROOT_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def print_cell(r: dict, previous: dict | None):
+    line = '%8s %7s %5d %10.1f %12.1f %10.2f %10.2f %8.2f %9.1f %6d' % (
+        r['size'], r['uploads'], r['connections'], r['throughput'], r['transfers_per_s'],
+        r['latency']['p50'], r['latency']['p99'], r['server_cpu'], r['server_rss'] / (1 << 20), r['errors']
+    )
+    if previous is not None and previous['throughput']:
+        line += '   %+6.1f%% MiB/s  %+6.1f%% p99' % (
+            (r['throughput'] / previous['throughput'] - 1) * 100,
+            (r['latency']['p99'] / previous['latency']['p99'] - 1) * 100 if previous['latency']['p99'] else 0.0
+        )
+    print(line)
+
+
+if __name__ == '__main__':
+    param_map = params.parseParams(flags)
+    if param_map['usage']:
+        params.usage()
+        sys.exit(0)
+
+    port, rounds = int(param_map['listenPort']), int(param_map['rounds'])
+    sizes = [parse_size(s) for s in param_map['sizes'].split(',')]
+    upload_ratios = [float(u) for u in param_map['uploads'].split(',')]
+    connection_counts = [int(c) for c in param_map['connections'].split(',')]
+    server_args = [] if param_map['serverArgs'] == 'none' else shlex.split(param_map['serverArgs'])
+    proxy_port, proxy_delay = int(param_map['proxyPort']), float(param_map['proxyDelay'])
+
+    commit = git_commit()
+    output = param_map['output']
+    if output == 'auto':
+        output = os.path.join(dir, 'results', '%s.json' % commit)
+
+    previous = {}
+    if param_map['compare'] != 'none':
+        with open(param_map['compare']) as f:
+            previous = {(r['size'], r['uploads'], r['connections']): r for r in json.load(f)['results']}
+
+    print('commit %s, server args: %s%s, %d transfers per client' % (
+        commit, ' '.join(server_args) or '-', ', through stammer-proxy' if proxy_port else '', rounds
+    ))
+    print('%8s %7s %5s %10s %12s %10s %10s %8s %9s %6s' % (
+        'size', 'uploads', 'conns', 'MiB/s', 'transfers/s', 'p50 (ms)', 'p99 (ms)', 'CPU (s)', 'RSS (MiB)', 'errors'
+    ))
+
+    results = []
+    for size in sizes:
+        for upload_ratio in upload_ratios:
+            for connections in connection_counts:
+                r = bench(port, server_args, size, upload_ratio, connections, rounds, proxy_port, proxy_delay)
+                results.append(r)
+                print_cell(r, previous.get((size, upload_ratio, connections), None))
+
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump({
+            'commit': commit, 'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'server_args': server_args,
+            'proxy': {'delay': proxy_delay} if proxy_port else None, 'rounds': rounds, 'results': results,
+        }, f, indent=2)
+    print('Results saved to %s' % output)
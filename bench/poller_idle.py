@@ -0,0 +1,122 @@
+#! /usr/bin/env python3
+"""
+Measures the cost of the SocketServer event loop with many idle connections, for each available poller backend.
+
+A forked child opens `connections` idle connections plus one active connection, then ping-pongs a single byte
+over the active one. The server (this process) echoes it back. With `select`/`poll` every wakeup scans all the
+registered descriptors, with `epoll` the cost does not depend on the number of idle connections.
+"""
+import os, resource, socket, sys, time
+
+dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.abspath(os.path.join(dir, '../src')))
+sys.path.append(os.path.abspath(os.path.join(dir, '../src/server')))
+
+import lib.params as params
+from socket_server import SocketServer, POLLERS
+
+flags = (
+    (('-l', '--listenPort'), 'listenPort', 50101),
+    (('-c', '--connections'), 'connections', 10000),
+    (('-i', '--iterations'), 'iterations', 5000),
+    (('-?', '--usage'), "usage", False),  # boolean (set if present)
+)
+
+
+def run_clients(port: int, connections: int, iterations: int):
+    """
+    The child process, opens the connections and ping-pongs over the first one.
+    """
+    active = socket.create_connection(('localhost', port))
+    idle = [socket.create_connection(('localhost', port)) for _ in range(connections)]
+
+    for _ in range(iterations):
+        active.sendall(b'x')
+        active.recv(1)
+
+    active.close()
+    for s in idle:
+        s.close()
+
+
+def bench(poller: str, port: int, connections: int, iterations: int):
+    """
+    Run the benchmark for a single poller.
+    :return: (µs per round trip, µs spent in a single poll call) or None if the poller can not handle that many
+    descriptors.
+    """
+    counters = {'connected': 0, 'disconnected': 0, 'pings': 0, 'poll_time': 0.0, 'start': 0.0}
+
+    def on_connect(addr):
+        counters['connected'] += 1
+
+    def on_disconnect(addr):
+        counters['disconnected'] += 1
+
+    def on_data(fd, data):
+        if counters['pings'] == 0:
+            counters['start'] = time.perf_counter()
+            counters['poll_time'] = 0.0
+        counters['pings'] += len(data)
+        server.send(fd, data)
+
+    server = SocketServer(port, connections + 1, poller=poller)
+    server.on('connect', on_connect).on('disconnect', on_disconnect).on('data', on_data)
+    server.start()
+
+    pid = os.fork()
+    if pid == 0:
+        try:
+            run_clients(port, connections, iterations)
+        finally:
+            os._exit(0)
+
+    try:
+        while counters['disconnected'] < connections + 1:
+            t = time.perf_counter()
+            server.poll(1)
+            counters['poll_time'] += time.perf_counter() - t
+
+            if counters['pings'] == iterations and counters['start']:
+                elapsed = time.perf_counter() - counters['start']
+                round_trip, poll_time = elapsed / iterations, counters['poll_time'] / iterations
+                counters['start'] = 0.0
+        result = (round_trip * 1e6, poll_time * 1e6)
+    except ValueError:
+        # select() can not handle descriptors >= FD_SETSIZE
+        os.kill(pid, 9)
+        result = None
+    finally:
+        os.waitpid(pid, 0)
+        server.close()
+
+    return result
+
+
+if __name__ == '__main__':
+    param_map = params.parseParams(flags)
+    if param_map['usage']:
+        params.usage()
+        sys.exit(0)
+
+    port, connections, iterations = (
+        int(param_map['listenPort']), int(param_map['connections']), int(param_map['iterations'])
+    )
+
+    # both the client and the server side of each connection are in this process tree, but in different processes
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < connections + 64:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (min(hard, connections + 64), hard))
+
+    print('%d idle connections, %d round trips over one active connection' % (connections, iterations))
+    print('%-8s %16s %16s' % ('poller', 'round trip (us)', 'poll() (us)'))
+
+    for poller in sorted(POLLERS):
+        if poller == 'auto':
+            continue
+
+        result = bench(poller, port, connections, iterations)
+        if result is None:
+            print('%-8s %16s %16s' % (poller, 'n/a (FD_SETSIZE)', '-'))
+        else:
+            print('%-8s %16.1f %16.1f' % (poller, *result))
@@ -0,0 +1,190 @@
+"""
+Minimal blocking implementation of the client side of the protocol (see server-client-communication.md) and
+helpers for driving a local server, used by the benchmarks.
+"""
+import os
+import socket
+import subprocess
+import sys
+import time
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+SERVER_MAIN = os.path.join(ROOT_DIR, 'src', 'server', 'main.py')
+SERVER_DATA_DIR = os.path.join(ROOT_DIR, 'data', 'server')
+# subfolder of the data folder the benchmarks upload their files into (ignored by git)
+BENCH_FOLDER = 'bench-tmp'
+PROXY_MAIN = os.path.join(ROOT_DIR, 'stammer-proxy', 'stammerProxy.py')
+
+BYTEORDER = 'little'
+
+
+def recv_exact(sock: socket.socket, n: int) -> bytes:
+    """
+    Receive exactly `n` bytes.
+    """
+    out = bytearray()
+    while len(out) < n:
+        chunk = sock.recv(min(n - len(out), 1 << 20))
+        if not chunk:
+            raise ConnectionError("Server closed the connection")
+        out += chunk
+
+    return bytes(out)
+
+
+def read_confirmation(sock: socket.socket):
+    """
+    Read a confirmation, raise if it is an error.
+    """
+    if recv_exact(sock, 1)[0] != 0:
+        error_len = recv_exact(sock, 1)[0]
+        raise RuntimeError("Server error: %s" % recv_exact(sock, error_len).decode())
+
+
+def upload(sock: socket.socket, fname: str, data: bytes):
+    """
+    Upload a file over a connected socket.
+    """
+    sock.sendall(b'U' + len(fname).to_bytes(1, BYTEORDER) + fname.encode() + len(data).to_bytes(8, BYTEORDER))
+    read_confirmation(sock)
+    sock.sendall(data)
+    read_confirmation(sock)
+
+
+def download(sock: socket.socket, fname: str) -> bytes:
+    """
+    Download a file over a connected socket.
+    """
+    sock.sendall(b'D' + len(fname).to_bytes(1, BYTEORDER) + fname.encode())
+    read_confirmation(sock)
+    fsize = int.from_bytes(recv_exact(sock, 8), BYTEORDER)
+    return recv_exact(sock, fsize)
+
+
+def start_server(port: int, *args: str, stdout=subprocess.DEVNULL) -> subprocess.Popen:
+    """
+    Start src/server/main.py on the given port and wait until it accepts connections.
+    """
+    os.makedirs(SERVER_DATA_DIR, exist_ok=True)
+    server = subprocess.Popen(
+        [sys.executable, SERVER_MAIN, '-l', str(port), *args], stdout=stdout, stderr=subprocess.STDOUT
+    )
+
+    wait_listening(port, server)
+    return server
+
+
+def start_proxy(port: int, server_port: int, pause_delay: float) -> subprocess.Popen:
+    """
+    Start stammer-proxy/stammerProxy.py on the given port, forwarding to the server on `server_port` in randomly
+    sized pieces (each followed by a pause, if the piece is not the whole buffered data).
+    """
+    proxy = subprocess.Popen(
+        [sys.executable, PROXY_MAIN, '-l', str(port), '-s', '127.0.0.1:%d' % server_port, '-p', str(pause_delay)],
+        cwd=os.path.dirname(PROXY_MAIN), stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT
+    )
+    wait_listening(port, proxy)
+    return proxy
+
+
+def wait_listening(port: int, process: subprocess.Popen):
+    """
+    Wait until a started process accepts connections on the given port.
+    """
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline and process.poll() is None:
+        try:
+            socket.create_connection(('localhost', port), timeout=1).close()
+            return
+        except ConnectionRefusedError:
+            time.sleep(0.05)
+
+    process.kill()
+    raise RuntimeError("%s has not started" % os.path.basename(process.args[1]))
+
+
+def stop_server(server: subprocess.Popen):
+    """
+    Stop a server started by `start_server` (like Ctrl+C).
+    """
+    server.send_signal(2)  # SIGINT
+    try:
+        server.wait(10)
+    except subprocess.TimeoutExpired:
+        server.kill()
+        server.wait()
+
+
+def cpu_seconds(pid: int) -> float:
+    """
+    CPU time (user + system) consumed by a process and its waited-for children so far (Linux /proc).
+    """
+    with open('/proc/%d/stat' % pid) as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+
+    # utime, stime, cutime, cstime (fields 14-17 of proc(5), the first two are cut off here)
+    return sum(int(v) for v in fields[11:15]) / os.sysconf('SC_CLK_TCK')
+
+
+def process_tree(pid: int) -> list:
+    """
+    The process and all its descendants, e.g. a pre-forking server and its workers (Linux /proc).
+    """
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % entry) as f:
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue  # exited meanwhile
+        children.setdefault(ppid, []).append(int(entry))
+
+    tree, pending = [], [pid]
+    while pending:
+        pid = pending.pop()
+        tree.append(pid)
+        pending.extend(children.get(pid, ()))
+
+    return tree
+
+
+def tree_cpu_seconds(pid: int) -> float:
+    """
+    CPU time consumed by a process and all its descendants so far, see `cpu_seconds`.
+    """
+    total = 0.0
+    for p in process_tree(pid):
+        try:
+            total += cpu_seconds(p)
+        except OSError:
+            pass  # exited meanwhile
+
+    return total
+
+
+def rss_bytes(pid: int) -> int:
+    """
+    Resident set size of a process and all its descendants (Linux /proc).
+    """
+    total = 0
+    for p in process_tree(pid):
+        try:
+            with open('/proc/%d/statm' % p) as f:
+                total += int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except OSError:
+            pass  # exited meanwhile
+
+    return total
+
+
+def percentile(values, p: float) -> float:
+    """
+    The p-th percentile (0-100) of the values (nearest rank).
+    """
+    if not values:
+        return 0.0
+
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, int(round(p / 100 * len(values))) - 1))]
@@ -0,0 +1,39 @@
+class AdaptiveSize:
+    """
+    Size of the chunks read/sent over a single connection, adapted to the observed throughput.
+
+    Starts at `min_len`, which is enough for the headers of the protocol. Whenever a whole chunk has been
+    transferred at once (the peer/socket keeps up, so more data is likely waiting), the size doubles up to `max_len`,
+    which quickly brings bulk payload transfers to large chunks and few syscalls. When the chunks stay mostly empty,
+    the size halves back towards `min_len`.
+    """
+
+    __slots__ = ('min_len', 'max_len', 'size')
+
+    def __init__(self, min_len=1024, max_len=1 << 20):
+        if not 0 < min_len <= max_len:
+            raise ValueError("Invalid chunk sizes %d-%d" % (min_len, max_len))
+
+        self.min_len = min_len
+        self.max_len = max_len
+        self.size = min_len
+
+    def observe(self, transferred: int):
+        """
+        Adapt the size to the number of bytes transferred using a chunk of the current size.
+        :param transferred:
+        :return: The new size.
+        """
+        if transferred >= self.size:
+            self.size = min(self.size * 2, self.max_len)
+        elif transferred < self.size // 4:
+            self.size = max(self.size // 2, self.min_len)
+
+        return self.size
+
+    def reset(self):
+        """
+        Go back to the minimal size, e.g. when a new request header is expected.
+        :return:
+        """
+        self.size = self.min_len
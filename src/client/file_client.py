@@ -1,19 +1,91 @@
 #! /usr/bin/env python3
 
 # Echo client program
-import socket, sys, re, os
+import socket, sys, re, os, hashlib, json
+from typing import Callable, List, Tuple, TypedDict
 
-import helpers
+import compression
+import delta
+from adaptive import AdaptiveSize
+from compression import Compressor, Decompressor
+from helpers import ViewReader
 
 READ_BUFFER_LEN = 1024
+MAX_READ_BUFFER_LEN = 1 << 20
+
+# max number of files sent in a single bundle request
+MAX_BUNDLE_FILES = 4096
 
 # directory of this file
 ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
 
 
+class TransferError(Exception):
+    """
+    A file transfer has failed.
+    Attributes:
+        fatal: Whether the connection can not be used anymore (the server closes the connection after an error).
+    """
+
+    def __init__(self, msg: str, fatal=True):
+        super().__init__(msg)
+        self.fatal = fatal
+
+
+class Request(TypedDict):
+    """
+    A file transfer request sent to the server.
+    Attributes:
+        action: 'U' - upload, 'D' - download
+        fname: The name of the file.
+        fd: The opened file to upload, until it has been sent.
+        fsize: The size of the uploaded file.
+        offset: Number of bytes the server/client holds already, the transfer resumes after them.
+        codec: Compression codec requested for the transfer, 0 if not compressed.
+        hashed: Whether the upload has been requested with the hash of the file, the server may have its content.
+        delta: Whether only the changed blocks of the uploaded file are sent.
+    """
+    action: str
+    fname: str
+    fd: int | None
+    fsize: int
+    offset: int
+    codec: int
+    hashed: bool
+    delta: bool
+
+
 class Client:
-    def __init__(self, addr: str, byteorder="little"):
+    def __init__(self, addr: str, byteorder="little", min_chunk_len=READ_BUFFER_LEN, max_chunk_len=MAX_READ_BUFFER_LEN,
+                 resume=False, verify=False, compress: str = None, dedup=False,
+                 delta=False, bundle=False):
+        """
+        :param addr: host:port of the server.
+        :param byteorder:
+        :param min_chunk_len: Number of bytes read/sent at once for the headers.
+        :param max_chunk_len: The chunks grow up to this size while a file is transferred.
+        :param resume: Resume the transfers from the bytes the destination already holds (e.g. after a dropped
+        connection), instead of transferring whole files.
+        :param verify: When resuming, compare the hashes of the bytes already held at both sides and transfer the whole
+        file if they differ.
+        :param compress: Compress the transferred files with this codec ('zlib', 'bz2' or 'lzma'), if they compress
+        well. Resumed and partial transfers are not compressed.
+        :param dedup: Send the hash of an uploaded file first, the content is not sent if the server already has it.
+        Takes precedence over the compression of uploads.
+        :param delta: Send only the blocks of an uploaded file that differ from the server's version of the file
+        (rsync algorithm). Takes precedence over the deduplication and the compression of uploads.
+        :param bundle: Transfer the files in bundles, many files in a single request and a single confirmation
+        (see `upload_bundle`/`download_bundle`). The other transfer options do not apply to bundles.
+        """
         self.__byteorder = byteorder
+        self.__min_chunk_len = min_chunk_len
+        self.__max_chunk_len = max_chunk_len
+        self.__resume = resume
+        self.__verify = verify
+        self.__codec = compression.CODEC_IDS[compress] if compress else compression.NONE
+        self.__dedup = dedup
+        self.__delta = delta
+        self.__bundle = bundle
         # self.__data_folder = os.path.abspath(os.path.join(ROOT_DIR, data_folder))
         self.__addr = addr
         self.__socket = None
@@ -26,7 +98,7 @@ class Client:
             serverPort = int(serverPort)
         except:
             print("Can't parse server:port from '%s'" % self.__addr)
-            sys.exit(1)
+            return False
 
         for res in socket.getaddrinfo(serverHost, serverPort, socket.AF_UNSPEC, socket.SOCK_STREAM):
             af, socktype, proto, canonname, sa = res
@@ -54,75 +126,261 @@ class Client:
 
         return True
 
+    def upload_file(self, fname: str):
+        """
+        Upload a file.
+        :param fname:
+        :raise TransferError: If the upload has failed.
+        """
+        self.__upload(self.__send_request('U', fname))
+
     def download_file(self, fname: str):
-        print('[client] requesting to download "%s"...' % fname)
+        """
+        Download a file.
+        :param fname:
+        :raise TransferError: If the download has failed.
+        """
+        self.__download(self.__send_request('D', fname))
+
+    def stat(self, fname: str, verify_len=0) -> Tuple[int, bytes | None]:
+        """
+        Get the size of a file on the server.
+        :param fname:
+        :param verify_len: Get also the SHA-256 of the first `verify_len` bytes of the file.
+        :return: (size, digest), a missing file has size 0, digest is None if `verify_len` is 0.
+        :raise TransferError:
+        """
+        print('[client] requesting the state of "%s"...' % fname)
 
-        self.__send("D".encode())
+        self.__send("S".encode())
         self.__write_fname(fname)
+        self.__send(int.to_bytes(verify_len, 8, self.__byteorder))
 
-        buffer = self.__read()
+        self.__read_confirmation()
+        size = int.from_bytes(self.__recv_exact(8), self.__byteorder)
+        digest = bytes(self.__recv_exact(32)) if verify_len > 0 else None
+        print("[server] -> file size is %dB" % size)
 
-        confirmation = self.__read_confirmation(buffer)
+        return size, digest
 
-        if confirmation == 1:
-            print("[server] -> ERROR: %s" % buffer.decode())
-            exit(1)
+    def download_part(self, fname: str, offset: int, length: int) -> int:
+        """
+        Download a part (byte range) of a file and write it to the local file at the same offset. The local file is
+        not truncated, the parts of a file can be downloaded in any order (or in parallel).
+        :param fname:
+        :param offset:
+        :param length: Max length of the part, it ends earlier at the end of the file.
+        :return: Number of bytes that have been downloaded.
+        :raise TransferError:
+        """
+        print('[client] requesting to download %dB of "%s" from %dB...' % (length, fname, offset))
 
-        elif confirmation == 0:
-            print("[server] -> OK")
+        self.__send("P".encode())
+        self.__write_fname(fname)
+        self.__send(int.to_bytes(offset, 8, self.__byteorder) + int.to_bytes(length, 8, self.__byteorder))
 
-            fsize = self.__read_fsize(buffer)
-            print("[server] -> sending file (%dB)..." % fsize)
+        self.__read_confirmation()
+        count = int.from_bytes(self.__recv_exact(8), self.__byteorder)
+        print("[server] -> sending part of the file (%dB)..." % count)
 
-            self.__read_file(buffer, fname, fsize)
-            print('[client] file has been downloaded: %s' % self.__get_file_path(fname))
+        out_fd = os.open(self.__get_file_path(fname), os.O_WRONLY | os.O_CREAT)
+        try:
+            self.__receive_to_file(out_fd, count, offset)
+        finally:
+            os.close(out_fd)
 
-        else:
-            print("[server] -> ERROR: unknown confirmation code: %d" % confirmation)
-            self.exit(1)
+        return count
 
-    def upload_file(self, fname: str):
-        print('[client] requesting to upload "%s"...' % fname)
-        if not self.__validate_file(fname):
-            print('ERROR: file "%s" does not exist' % fname)
-            self.exit(1)
+    def list_files(self, prefix='', after='', limit=0) -> Tuple[List[Tuple[str, int, int]], bool]:
+        """
+        Get a page of the listing of the files on the server, in the order of their names.
+        :param prefix: Only the files with names starting with the prefix.
+        :param after: The page starts after this name (the last name of the previous page), '' for the first page.
+        :param limit: Max number of files of the page, 0 for the server's max.
+        :return: (list of (fname, size, mtime_ns), whether there are more files after the page)
+        :raise TransferError:
+        """
+        print('[client] requesting the files starting with "%s" after "%s"...' % (prefix, after))
 
-        self.__send("U".encode())
-        self.__write_fname(fname)
+        request = "L".encode()
+        for field in (prefix, after):
+            request += int.to_bytes(len(field.encode()), 1, self.__byteorder) + field.encode()
+        self.__send(request + int.to_bytes(limit, 4, self.__byteorder))
 
-        fd = os.open(self.__get_file_path(fname), os.O_RDONLY)
-        fsize = self.__write_fsize(fd)
+        self.__read_confirmation()
+        count = int.from_bytes(self.__recv_exact(4), self.__byteorder)
 
-        buffer = self.__read()
+        entries = []
+        for _ in range(count):
+            fname = self.__recv_exact(self.__recv_exact(1)[0]).decode()
+            size = int.from_bytes(self.__recv_exact(8), self.__byteorder)
+            mtime_ns = int.from_bytes(self.__recv_exact(8), self.__byteorder)
+            entries.append((fname, size, mtime_ns))
 
-        confirmation = self.__read_confirmation(buffer)
+        more = self.__recv_exact(1)[0] == 1
+        print("[server] -> %d files%s" % (count, ", more to list" if more else ""))
 
-        if confirmation == 1:
-            print("[server] -> ERROR: %s" % buffer.decode())
-            self.exit(1)
+        return entries, more
 
-        elif confirmation == 0:
-            print("[server] -> OK")
-            print("[server] <- sending file (%dB)..." % fsize)
-            self.__write_file(fd)
+    def server_stats(self) -> dict:
+        """
+        Get a snapshot of the counters of the server (of the worker process serving the connection).
+        :return: See `FileServer.__process_stats`.
+        :raise TransferError:
+        """
+        self.__send("T".encode())
+
+        self.__read_confirmation()
+        length = int.from_bytes(self.__recv_exact(4), self.__byteorder)
+        return json.loads(self.__recv_exact(length).decode())
+
+    def upload_bundle(self, fnames: List[str]) -> List[TransferError | None]:
+        """
+        Upload many (small) files in a single request, the server confirms all of them at once.
+        :param fnames: At most `MAX_BUNDLE_FILES` files.
+        :return: The error of each file, None if it has been uploaded.
+        :raise TransferError: If the whole bundle has failed.
+        """
+        errors: List[TransferError | None] = [None] * len(fnames)
+        sent = []
+        for i, fname in enumerate(fnames):
+            if self.__validate_file(fname):
+                sent.append(i)
+            else:
+                errors[i] = TransferError('file "%s" does not exist' % fname, fatal=False)
+
+        print('[client] requesting to upload a bundle of %d files...' % len(sent))
+        buffer = bytearray("M".encode() + int.to_bytes(len(sent), 4, self.__byteorder))
+        for i in sent:
+            with open(self.__get_file_path(fnames[i]), 'rb') as f:
+                fsize = os.fstat(f.fileno()).st_size
+                buffer += int.to_bytes(len(fnames[i]), 1, self.__byteorder) + fnames[i].encode()
+                buffer += int.to_bytes(fsize, 8, self.__byteorder)
+
+                # the small files are coalesced into large sends
+                while chunk := f.read(self.__max_chunk_len):
+                    buffer += chunk
+                    if len(buffer) >= self.__max_chunk_len:
+                        self.__send(bytes(buffer))
+                        buffer = bytearray()
+        self.__send(bytes(buffer))
+
+        self.__read_confirmation()
+        count = int.from_bytes(self.__recv_exact(4), self.__byteorder)
+        if count != len(sent):
+            raise TransferError("The server has confirmed %d files instead of %d" % (count, len(sent)))
+
+        for i in sent:
+            if self.__recv_exact(1)[0] != 0:
+                error_len = self.__recv_exact(1)[0]
+                errors[i] = TransferError(self.__recv_exact(error_len).decode(), fatal=False)
+                print('[server] -> ERROR "%s": %s' % (fnames[i], errors[i]))
+
+        failed = sum(errors[i] is not None for i in sent)
+        print('[client] bundle has been uploaded: %d files, %d failed' % (len(sent), failed))
+        return errors
+
+    def download_bundle(self, fnames: List[str]) -> List[TransferError | None]:
+        """
+        Download many (small) files in a single request, each file is sent with its own status.
+        :param fnames: At most `MAX_BUNDLE_FILES` files.
+        :return: The error of each file, None if it has been downloaded.
+        :raise TransferError: If the whole bundle has failed.
+        """
+        print('[client] requesting to download a bundle of %d files...' % len(fnames))
+        request = bytearray("G".encode() + int.to_bytes(len(fnames), 4, self.__byteorder))
+        for fname in fnames:
+            request += int.to_bytes(len(fname), 1, self.__byteorder) + fname.encode()
+        self.__send(bytes(request))
+
+        self.__read_confirmation()
+
+        errors: List[TransferError | None] = []
+        for fname in fnames:
+            if self.__recv_exact(1)[0] != 0:
+                error_len = self.__recv_exact(1)[0]
+                errors.append(TransferError(self.__recv_exact(error_len).decode(), fatal=False))
+                print('[server] -> ERROR "%s": %s' % (fname, errors[-1]))
+                continue
 
-            buffer = self.__read()
-            confirmation = self.__read_confirmation(buffer)
+            fsize = int.from_bytes(self.__recv_exact(8), self.__byteorder)
+            self.__read_file(fname, fsize)
+            errors.append(None)
 
-            if confirmation == 1:
-                print("[server] -> ERROR: %s" % buffer.decode())
-                self.exit(1)
-            elif confirmation == 0:
-                print("[server] -> OK")
-                print('[client] file has been uploaded')
+        print('[client] bundle has been downloaded: %d files, %d failed' % (
+            len(fnames), sum(error is not None for error in errors)
+        ))
+        return errors
 
+    def transfer_files(self, requests: List[Tuple[str, str]]) -> List[Tuple[str, str, TransferError | None]]:
+        """
+        Upload/download the files back-to-back over the connection. The next request is sent while the current
+        transfer is being finished (pipelined), so the server does not wait for the client between the files.
+        The server closes the connection after an error, the client reconnects then and continues with the next file.
+        Resumed transfers are not pipelined, since the size of each file is asked for before its transfer.
+        :param requests: List of (action, fname), where action is 'U' (upload) or 'D' (download).
+        :return: List of (action, fname, error) in the order of the requests, error is None if the transfer has
+        succeeded.
+        """
+        if self.__bundle:
+            return self.__transfer_bundles(requests)
 
-        else:
-            print("[server] -> ERROR: unknown confirmation code: %d" % confirmation)
-            self.exit(1)
+        results = []
+        request = None  # the current request, if it has been sent already
+
+        for i, (action, fname) in enumerate(requests):
+            next_request = requests[i + 1] if i + 1 < len(requests) else None
+            pipelined = None
+
+            def send_next():
+                nonlocal pipelined
+                if next_request is not None and not self.__resume:
+                    try:
+                        pipelined = self.__send_request(*next_request)
+                    except TransferError:
+                        pass  # the file can not be sent, it fails once it is its turn
+
+            error = None
+            try:
+                if request is None:
+                    request = self.__send_request(action, fname)
+
+                if action == 'U':
+                    self.__upload(request, send_next)
+                else:
+                    self.__download(request, send_next)
+
+            except TransferError as e:
+                error = e
+            except OSError as e:
+                error = TransferError(str(e))
+
+            results.append((action, fname, error))
+            request = pipelined
+
+            if error is None:
+                continue
+
+            print('[client] transfer of "%s" has failed: %s' % (fname, error))
+            if error.fatal:
+                self.__discard_request(request)
+                request = None
+
+                if next_request is not None and not self.__reconnect():
+                    error = TransferError("Could not reconnect to the server")
+                    results += [(a, f, error) for a, f in requests[i + 1:]]
+                    break
+
+        return results
 
     def close(self):
-        self.__socket.shutdown(socket.SHUT_WR)  # no more output
+        if self.__socket is None:
+            return
+
+        try:
+            self.__socket.shutdown(socket.SHUT_WR)  # no more output
+        except OSError:
+            pass  # the server has closed the connection already
         self.__socket.close()
 
     def exit(self, status=0):
@@ -131,54 +389,362 @@ class Client:
 
     # endregion
 
-    def __read_confirmation(self, buffer: bytearray):
+    # region Transfers
+
+    def __transfer_bundles(self, requests: List[Tuple[str, str]]) -> List[Tuple[str, str, TransferError | None]]:
+        """
+        Transfer the files in bundles: the consecutive requests with the same action, up to `MAX_BUNDLE_FILES`
+        files each. After a failed bundle the client reconnects and continues with the next bundle.
+        :param requests: See `transfer_files`.
+        :return: See `transfer_files`.
+        """
+        bundles = []
+        for action, fname in requests:
+            if bundles and bundles[-1][0] == action and len(bundles[-1][1]) < MAX_BUNDLE_FILES:
+                bundles[-1][1].append(fname)
+            else:
+                bundles.append((action, [fname]))
+
+        results = []
+        for i, (action, fnames) in enumerate(bundles):
+            try:
+                if action == 'U':
+                    errors = self.upload_bundle(fnames)
+                elif action == 'D':
+                    errors = self.download_bundle(fnames)
+                else:
+                    errors = [TransferError('unknown action "%s"' % action, fatal=False)] * len(fnames)
+            except (TransferError, OSError) as e:
+                error = e if isinstance(e, TransferError) else TransferError(str(e))
+                print('[client] transfer of the bundle has failed: %s' % error)
+                errors = [error] * len(fnames)
+
+                if i + 1 < len(bundles) and not self.__reconnect():
+                    error = TransferError("Could not reconnect to the server")
+                    errors += [error] * sum(len(f) for _, f in bundles[i + 1:])
+                    results += [(a, f, e) for (a, f), e in zip(requests[len(results):], errors)]
+                    break
+
+            results += [(action, fname, error) for fname, error in zip(fnames, errors)]
+
+        return results
+
+    def __send_request(self, action: str, fname: str) -> Request:
+        """
+        Send the request for a file transfer (the part before the server's first confirmation).
+        :param action: 'U' or 'D'
+        :param fname:
+        :return: The sent request.
+        :raise TransferError: If the file to upload does not exist, nothing is sent then (not fatal).
+        """
+        request: Request = {
+            'action': action, 'fname': fname, 'fd': None, 'fsize': 0, 'offset': 0, 'codec': 0, 'hashed': False,
+            'delta': False
+        }
+
+        if action == 'U':
+            if not self.__validate_file(fname):
+                raise TransferError('file "%s" does not exist' % fname, fatal=False)
+
+            if self.__resume:
+                request['offset'] = self.__resume_offset(fname, True)
+
+            request['fd'] = os.open(self.__get_file_path(fname), os.O_RDONLY)
+
+            if request['offset'] > 0:
+                print('[client] requesting to resume the upload of "%s" from %dB...' % (fname, request['offset']))
+                os.lseek(request['fd'], request['offset'], os.SEEK_SET)
+                self.__send("R".encode())
+            elif self.__delta:
+                print('[client] requesting to upload the changed blocks of "%s"...' % fname)
+                request['delta'] = True
+                self.__send("B".encode())
+            elif self.__dedup:
+                print('[client] requesting to upload "%s" by its hash...' % fname)
+                request['hashed'] = True
+                self.__send("H".encode())
+            elif self.__codec and compression.worth_compressing(
+                    self.__codec, os.pread(request['fd'], compression.SAMPLE_LEN, 0)):
+                print('[client] requesting to upload "%s" (%s)...' % (fname, compression.CODECS[self.__codec]))
+                request['codec'] = self.__codec
+                self.__send("C".encode() + int.to_bytes(self.__codec, 1, self.__byteorder) + "U".encode())
+            else:
+                print('[client] requesting to upload "%s"...' % fname)
+                self.__send("U".encode())
+
+            self.__write_fname(fname)
+            request['fsize'] = self.__write_fsize(request['fd'])
+            if request['offset'] > 0:
+                self.__send(int.to_bytes(request['offset'], 8, self.__byteorder))
+            if request['hashed']:
+                self.__send(self.__hash_file(fname, request['fsize']))
+
+        elif action == 'D':
+            if self.__resume and self.__validate_file(fname):
+                request['offset'] = self.__resume_offset(fname, False)
+
+            if request['offset'] > 0:
+                print('[client] requesting to resume the download of "%s" from %dB...' % (fname, request['offset']))
+                self.__send("O".encode())
+                self.__write_fname(fname)
+                self.__send(int.to_bytes(request['offset'], 8, self.__byteorder))
+            elif self.__codec:
+                print('[client] requesting to download "%s" (%s)...' % (fname, compression.CODECS[self.__codec]))
+                request['codec'] = self.__codec
+                self.__send("C".encode() + int.to_bytes(self.__codec, 1, self.__byteorder) + "D".encode())
+                self.__write_fname(fname)
+            else:
+                print('[client] requesting to download "%s"...' % fname)
+                self.__send("D".encode())
+                self.__write_fname(fname)
+
+        else:
+            raise TransferError('unknown action "%s"' % action, fatal=False)
+
+        return request
+
+    def __upload(self, request: Request, send_next: Callable[[], None] = None):
         """
-        Read the confirmation code from the buffer.
-        :param buffer:
+        Finish a sent upload request.
+        :param request:
+        :param send_next: Sends the next request, called once the file has been sent.
         :return:
         """
-        return int.from_bytes(
-            helpers.read_buffer(buffer, 1),
-            self.__byteorder
-        )
+        if request['delta']:
+            return self.__upload_delta(request, send_next)
+
+        try:
+            if self.__read_confirmation(request['hashed']) == 2:
+                print('[client] file has been uploaded (the server has its content already)')
+                if send_next is not None:
+                    send_next()
+                return
+
+            print("[server] <- sending file (%dB)..." % (request['fsize'] - request['offset']))
+            if request['codec']:
+                self.__write_file_compressed(request['fd'], request['codec'])
+            else:
+                self.__write_file(request['fd'], close_fd=False)
+        finally:
+            self.__discard_request(request)
+
+        if send_next is not None:
+            send_next()
+
+        self.__read_confirmation()
+        print('[client] file has been uploaded')
+
+    def __upload_delta(self, request: Request, send_next: Callable[[], None] = None):
+        """
+        Finish a sent delta upload request: receive the signatures of the server's version of the file and send
+        the delta.
+        :param request:
+        :param send_next: Sends the next request, called once the delta has been sent.
+        :return:
+        """
+        try:
+            self.__read_confirmation()
+
+            basis_size = int.from_bytes(self.__recv_exact(8), self.__byteorder)
+            block_len = int.from_bytes(self.__recv_exact(4), self.__byteorder)
+            if block_len <= 0:
+                raise TransferError("Invalid block length %d" % block_len)
+
+            count = delta.block_count(basis_size, block_len)
+            signatures = self.__recv_exact(count * delta.SIGNATURE_LEN)
+            print("[server] -> signatures of %d blocks of %dB" % (count, block_len))
+
+            encoder = delta.Encoder(delta.parse_signatures(signatures, basis_size, block_len), block_len)
+            buffer = bytearray()
+            for part in encoder.encode(lambda n: os.read(request['fd'], n)):
+                # the delta is mostly small copy operations for a slightly changed file
+                buffer += part
+                if len(buffer) >= self.__max_chunk_len:
+                    self.__send(bytes(buffer))
+                    buffer = bytearray()
+            self.__send(bytes(buffer))
+        finally:
+            self.__discard_request(request)
+
+        print("[client] sent %dB of %dB (%.1f%%), the rest is copied from the server's version" % (
+            encoder.literal_len, request['fsize'], 100 * encoder.literal_len / max(request['fsize'], 1)
+        ))
+
+        if send_next is not None:
+            send_next()
+
+        self.__read_confirmation()
+        print('[client] file has been uploaded')
+
+    def __download(self, request: Request, send_next: Callable[[], None] = None):
+        """
+        Finish a sent download request.
+        :param request:
+        :param send_next: Sends the next request, called once the size of the file has been received.
+        :return:
+        """
+        self.__read_confirmation()
+
+        fsize = int.from_bytes(self.__recv_exact(8), self.__byteorder)
+        print("[server] -> sending file (%dB)..." % fsize)
 
-    def __read_fsize(self, buffer: bytearray):
+        codec = compression.NONE
+        if request['codec']:
+            # the server sends the file uncompressed if it does not compress well
+            codec = self.__recv_exact(1)[0]
+            print("[server] -> compression: %s" % compression.CODECS.get(codec, 'none'))
+
+        if send_next is not None:
+            send_next()
+
+        if codec:
+            self.__read_file_compressed(request['fname'], fsize, codec)
+        else:
+            self.__read_file(request['fname'], fsize, request['offset'])
+        print('[client] file has been downloaded: %s' % self.__get_file_path(request['fname']))
+
+    def __resume_offset(self, fname: str, upload: bool) -> int:
         """
-        Read the file size from the buffer.
-        Will request more data from the socket if the fsize is not complete
-        :param buffer:
+        Find out from where the transfer of a file can be resumed: the number of bytes held by the destination
+        (the server for uploads, the client for downloads), if the source is at least that long.
+        :param fname:
+        :param upload:
         :return:
         """
-        fsize = helpers.read_buffer(buffer, 8)
+        local_size = os.path.getsize(self.__get_file_path(fname))
+        size, digest = self.stat(fname, local_size if self.__verify else 0)
 
-        diff = 8 - len(fsize)
-        while diff > 0:
-            buffer += self.__read()
-            fsize += helpers.read_buffer(buffer, diff)
-            diff = 8 - len(fsize)
+        offset, source_size = (size, local_size) if upload else (local_size, size)
+        if offset > source_size:
+            return 0  # the destination holds a different file
+
+        if digest is not None and digest != self.__hash_file(fname, offset):
+            print('[client] the held part of "%s" differs, transferring the whole file' % fname)
+            return 0
+
+        return offset
+
+    @staticmethod
+    def __discard_request(request: Request | None):
+        """
+        Release the resources of a request.
+        """
+        if request is not None and request['fd'] is not None:
+            os.close(request['fd'])
+            request['fd'] = None
+
+    def __reconnect(self) -> bool:
+        """
+        Open a new connection to the server (after the server has closed the previous one).
+        """
+        self.__socket.close()
+        self.__socket = None
+        return self.connect()
+
+    # endregion
+
+    # region Framing/un-framing
+
+    def __read_confirmation(self, duplicate=False) -> int:
+        """
+        Read a confirmation from the server.
+        :param duplicate: Whether the server may reply that it has the content of an uploaded file already.
+        :return: 0 - OK, 2 - the server has the content (only if `duplicate`).
+        :raise TransferError: If the server has replied with an error.
+        """
+        confirmation = self.__recv_exact(1)[0]
+
+        if confirmation == 0:
+            print("[server] -> OK")
+            return confirmation
+
+        if confirmation == 2 and duplicate:
+            print("[server] -> HAVE IT")
+            return confirmation
+
+        if confirmation == 1:
+            error_len = self.__recv_exact(1)[0]
+            error = self.__recv_exact(error_len).decode()
+            print("[server] -> ERROR: %s" % error)
+            raise TransferError(error)
 
-        return int.from_bytes(fsize, self.__byteorder)
+        print("[server] -> ERROR: unknown confirmation code: %d" % confirmation)
+        raise TransferError("unknown confirmation code: %d" % confirmation)
 
-    def __read_file(self, buffer: bytearray, fname: str, fsize: int):
+    def __read_file(self, fname: str, fsize: int, offset=0):
         """
-        Read the file from the buffer and write it to the given file name.
-        Will request more data from the socket if the file is not complete
-        :param buffer:
+        Read the file from the socket and write it to the given file name. Reads exactly `fsize` bytes, anything
+        after that belongs to the next transfer.
         :param fname:
         :param fsize:
+        :param offset: Position in the file to write the received bytes to, anything after it is dropped.
         :return:
         """
+        out_fd = os.open(self.__get_file_path(fname), os.O_WRONLY | os.O_CREAT)
+        try:
+            os.ftruncate(out_fd, offset)
+            self.__receive_to_file(out_fd, fsize, offset)
+        finally:
+            os.close(out_fd)
+
+    def __read_file_compressed(self, fname: str, fsize: int, codec: int):
+        """
+        Read the compressed file (its frames) from the socket, decompress it and write it to the given file name.
+        :param fname:
+        :param fsize: Size of the decompressed file.
+        :param codec:
+        :return:
+        """
+        decompressor = Decompressor(codec, self.__max_chunk_len)
         out_fd = os.open(self.__get_file_path(fname), os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
 
-        diff = fsize
-        diff -= self.__write_buffer_to_file(buffer, out_fd)
+        try:
+            while not decompressor.eof:
+                header = self.__recv_exact(compression.FRAME_HEADER_LEN)
+                frame = header + self.__recv_exact(int.from_bytes(header, compression.FRAME_BYTEORDER))
+
+                for chunk in decompressor.feed(ViewReader(memoryview(frame))):
+                    if decompressor.raw_len > fsize:
+                        raise TransferError("The decompressed file is longer than %dB" % fsize)
+
+                    view = memoryview(chunk)
+                    while view:
+                        view = view[os.write(out_fd, view):]
+        except ValueError as e:
+            raise TransferError(str(e))
+        finally:
+            os.close(out_fd)
 
+        if decompressor.raw_len != fsize:
+            raise TransferError("The decompressed file is shorter than %dB" % fsize)
+
+        self.__print_ratio(decompressor.raw_len, decompressor.compressed_len)
+
+    def __receive_to_file(self, out_fd: int, count: int, offset: int):
+        """
+        Read exactly `count` bytes from the socket and write them to the file at the given offset (the position of
+        the fd is not used, so more connections can write to the same file).
+        :param out_fd:
+        :param count:
+        :param offset:
+        :return:
+        """
+        chunk_len = AdaptiveSize(self.__min_chunk_len, self.__max_chunk_len)
+
+        diff = count
         while diff > 0:
-            # we do not have to store the data to a buffer for future use, like `buffer += read()`,
-            # since the EOF will be the end of the socket stream itself
-            diff -= self.__write_buffer_to_file(self.__read(), out_fd)
+            buffer = memoryview(self.__read(min(diff, chunk_len.size)))
+            if len(buffer) == 0:
+                raise TransferError("Server closed the connection, %dB of the file are missing" % diff)
+
+            received = len(buffer)
+            while buffer:
+                written = os.pwrite(out_fd, buffer, offset)
+                offset += written
+                buffer = buffer[written:]
 
-        os.close(out_fd)
+            diff -= received
+            chunk_len.observe(received)
 
     def __write_fname(self, fname: str):
         """
@@ -209,37 +775,77 @@ class Client:
         :param fd:
         :return:
         """
+        chunk_len = AdaptiveSize(self.__min_chunk_len, self.__max_chunk_len)
         while True:
-            buffer = os.read(fd, READ_BUFFER_LEN)
+            buffer = os.read(fd, chunk_len.size)
             if not buffer:
                 break
 
             self.__send(buffer)
+            chunk_len.observe(len(buffer))
 
         if close_fd:
             os.close(fd)
 
+    def __write_file_compressed(self, fd: int, codec: int):
+        """
+        Write the file to the socket, compressed in frames.
+        :param fd:
+        :param codec:
+        :return:
+        """
+        compressor = Compressor(codec)
+        chunk_len = AdaptiveSize(self.__min_chunk_len, self.__max_chunk_len)
+        while True:
+            buffer = os.read(fd, chunk_len.size)
+            if not buffer:
+                break
+
+            self.__send(compressor.compress(buffer))
+            chunk_len.observe(len(buffer))
+
+        self.__send(compressor.flush())
+        self.__print_ratio(compressor.raw_len, compressor.compressed_len)
+
+    # endregion
+
     # region Helper methods
 
+    @staticmethod
+    def __print_ratio(raw_len: int, compressed_len: int):
+        print("[client] compressed %dB to %dB (%.1fx)" % (
+            raw_len, compressed_len, compression.ratio(raw_len, compressed_len)
+        ))
+
     def __send(self, data: bytes, debug=False):
         if debug:
             print('[server] <- "%s" (%s)' % (data.decode(), data))
 
-        self.__socket.sendall(data)
+        try:
+            self.__socket.sendall(data)
+        except OSError as e:
+            # e.g. the server has closed the connection (after an error, or it does not support the request)
+            raise TransferError("Could not send to the server: %s" % e)
 
-    def __read(self, len=READ_BUFFER_LEN):
-        return bytearray(os.read(self.__socket.fileno(), len))
+    def __read(self, len=None):
+        try:
+            return bytearray(os.read(self.__socket.fileno(), len or self.__min_chunk_len))
+        except OSError as e:
+            raise TransferError("Could not receive from the server: %s" % e)
 
-    def __write_buffer_to_file(self, buffer: bytearray, fd: int):
+    def __recv_exact(self, n: int) -> bytearray:
         """
-        Read the whole buffer and write it to the given fd.
-        :param buffer:
-        :param fd:
-        :return: Number of bytes that were written (always len(buffer)).
+        Read exactly `n` bytes from the socket.
+        :raise TransferError: If the server has closed the connection.
         """
-        wrote = len(buffer)
-        os.write(fd, helpers.read_buffer(buffer, wrote))
-        return wrote
+        buffer = bytearray()
+        while len(buffer) < n:
+            chunk = self.__read(n - len(buffer))
+            if not chunk:
+                raise TransferError("Server closed the connection")
+            buffer += chunk
+
+        return buffer
 
     def __get_file_path(self, fname: str):
         """
@@ -248,6 +854,21 @@ class Client:
         # return os.path.abspath(os.path.join(self.__data_folder, fname))
         return fname
 
+    def __hash_file(self, fname: str, length: int) -> bytes:
+        """
+        Get the SHA-256 of the first `length` bytes of a local file (the same way the server does).
+        """
+        digest = hashlib.sha256()
+        with open(self.__get_file_path(fname), 'rb') as f:
+            while length > 0:
+                chunk = f.read(min(length, self.__max_chunk_len))
+                if not chunk:
+                    break
+                digest.update(chunk)
+                length -= len(chunk)
+
+        return digest.digest()
+
     def __validate_file(self, fname: str):
         """
         Check if the given fname is a valid file.
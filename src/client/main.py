@@ -1,16 +1,50 @@
 #! /usr/bin/env python3
-import os, sys, signal, re
+import os, sys, signal, re, time, json
 
 dir = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(os.path.abspath(os.path.join(dir, '..')))
 
+import lib.params as params
 import file_client
+import compression
+import pool
+
+flags = (
+    (('-b', '--minBuffer'), 'minBuffer', file_client.READ_BUFFER_LEN),  # read/send chunk size for headers
+    (('-B', '--maxBuffer'), 'maxBuffer', file_client.MAX_READ_BUFFER_LEN),  # chunk sizes grow up to this
+    (('-n', '--connections'), 'connections', 1),  # files are spread across this many connections
+    (('-R', '--resume'), 'resume', False),  # boolean, resume the transfers from the bytes already held
+    (('-V', '--verify'), 'verify', False),  # boolean, compare the hashes of the held bytes when resuming
+    (('-z', '--compress'), 'compress', 'none'),  # zlib|bz2|lzma|none
+    (('-d', '--dedup'), 'dedup', False),  # boolean, send the hash of uploaded files first
+    (('-D', '--delta'), 'delta', False),  # boolean, upload only the changed blocks of files
+    (('-m', '--bundle'), 'bundle', False),  # boolean, transfer many files per request
+    (('-L', '--list'), 'list', False),  # boolean, list the files on the server
+    (('-T', '--stats'), 'stats', False),  # boolean, print the stats of the server
+    (('-?', '--usage'), "usage", False),  # boolean (set if present)
+)
 
 
 def print_usage():
     print("Usage:")
-    print("   client.py <file_to_upload> <host:port>")
-    print("   client.py <host:port>@<file_to_download>")
+    print("   client.py [options] <file_to_upload>... <host:port>")
+    print("   client.py [options] <host:port>@<file_to_download> [<file_to_download>...]")
+    print("   client.py -L <host:port>[@<prefix>]")
+    print("   client.py -T <host:port>")
+    print("Multiple files are transferred over a single connection, or spread across a pool of connections.")
+    print("A single downloaded file is split into segments downloaded over the pool of connections.")
+    print("Options:")
+    print("   -b, --minBuffer <bytes>   (default = %d)" % file_client.READ_BUFFER_LEN)
+    print("   -B, --maxBuffer <bytes>   (default = %d)" % file_client.MAX_READ_BUFFER_LEN)
+    print("   -n, --connections <n>     (default = 1)")
+    print("   -R, --resume              resume interrupted transfers")
+    print("   -V, --verify              verify the already transferred part when resuming")
+    print("   -z, --compress <codec>    zlib, bz2, lzma or none (default = none)")
+    print("   -d, --dedup               skip uploading the content the server already has")
+    print("   -D, --delta               upload only the blocks that differ from the server's version")
+    print("   -m, --bundle              transfer the files in bundles (many small files per request)")
+    print("   -L, --list                list the files on the server (starting with the prefix)")
+    print("   -T, --stats               print the stats of the server (JSON)")
 
 
 def incorrect_usage():
@@ -18,23 +52,74 @@ def incorrect_usage():
     sys.exit(1)
 
 
+param_map = params.parseParams(flags)
+if param_map['usage']:
+    print_usage()
+    sys.exit(0)
+
+args = params.args
+
+if param_map['stats']:
+    if len(args) != 1:
+        incorrect_usage()
+
+    client = file_client.Client(args[0])
+    if not client.connect():
+        print('[client] could not connect to %s. Exiting...' % args[0])
+        sys.exit(1)
+
+    try:
+        print(json.dumps(client.server_stats(), indent=2))
+    except file_client.TransferError as e:
+        print('[client] stats request has failed: %s' % e)
+        client.exit(1)
+    client.exit(0)
+
+if param_map['list']:
+    if len(args) != 1:
+        incorrect_usage()
+
+    server, _, prefix = args[0].partition('@')
+    client = file_client.Client(server)
+    if not client.connect():
+        print('[client] could not connect to %s. Exiting...' % server)
+        sys.exit(1)
+
+    after, count = '', 0
+    try:
+        while True:
+            entries, more = client.list_files(prefix, after)
+            for fname, size, mtime_ns in entries:
+                mtime = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(mtime_ns / 1e9))
+                print('%12d  %s  %s' % (size, mtime, fname))
+            count += len(entries)
+            if not more:
+                break
+            after = entries[-1][0]
+    except file_client.TransferError as e:
+        print('[client] listing has failed: %s' % e)
+        client.exit(1)
+
+    print('[client] %d files' % count)
+    client.exit(0)
+
 action = None
 server = None
-if len(sys.argv) == 3:
-    # if command is to upload
-    action = 'U'
-    server = sys.argv[2]
-    fname = sys.argv[1]
-
-elif len(sys.argv) == 2:
+if len(args) >= 1 and '@' in args[0]:
     # if command is to download
     action = 'D'
-    params = sys.argv[1].split('@')
-    if len(params) != 2:
+    parts = args[0].split('@')
+    if len(parts) != 2:
         incorrect_usage()
 
-    server = params[0]
-    fname = params[1]
+    server = parts[0]
+    fnames = [parts[1]] + args[1:]
+
+elif len(args) >= 2:
+    # if command is to upload
+    action = 'U'
+    server = args[-1]
+    fnames = args[:-1]
 
 else:
     incorrect_usage()  # will exit
@@ -46,13 +131,52 @@ try:
 except:
     incorrect_usage()
 
-if len(server_host) == 0 or len(fname) == 0 or not 0 < server_port < 65536:
+if len(server_host) == 0 or not all(fnames) or not 0 < server_port < 65536:
     incorrect_usage()
 
 # run the client
-client = file_client.Client(server)
+try:
+    min_buffer, max_buffer = int(param_map['minBuffer']), int(param_map['maxBuffer'])
+    connections = int(param_map['connections'])
+except ValueError:
+    incorrect_usage()
+
+if connections < 1 or param_map['compress'] not in ('none', *compression.CODEC_IDS):
+    incorrect_usage()
+
+compress = None if param_map['compress'] == 'none' else param_map['compress']
+
+requests = [(action, fname) for fname in fnames]
+
+if connections > 1:
+    client_pool = pool.ClientPool(
+        server, connections, min_chunk_len=min_buffer, max_chunk_len=max_buffer,
+        resume=param_map['resume'], verify=param_map['verify'], compress=compress,
+        dedup=param_map['dedup'], delta=param_map['delta'], bundle=param_map['bundle']
+    )
+    if action == 'D' and len(requests) == 1:
+        report = client_pool.download_segmented(fnames[0])
+    else:
+        report = client_pool.transfer_files(requests)
+
+    for result in report['results']:
+        if result['error'] is not None:
+            print('[client] FAILED "%s": %s' % (result['fname'], result['error']))
+
+    print('[client] %d/%d files have been transferred (%dB in %.2fs, %.1f MiB/s over %d connections)' % (
+        report['transferred'], len(requests), report['bytes'], report['elapsed'],
+        report['throughput'] / (1 << 20), report['connections']
+    ))
+    sys.exit(1 if report['failed'] else 0)
+
+client = file_client.Client(
+    server, min_chunk_len=min_buffer, max_chunk_len=max_buffer,
+    resume=param_map['resume'], verify=param_map['verify'], compress=compress,
+    dedup=param_map['dedup'], delta=param_map['delta'], bundle=param_map['bundle']
+)
 if not client.connect():
     print('[client] could not connect to %s. Exiting...' % server)
+    sys.exit(1)
 
 
 def signal_handler(sig, frame):
@@ -63,9 +187,11 @@ def signal_handler(sig, frame):
 
 signal.signal(signal.SIGINT, signal_handler)
 
-if action == 'D':
-    client.download_file(fname)
-elif action == 'U':
-    client.upload_file(fname)
-
+results = client.transfer_files(requests)
 client.close()
+
+failed = [fname for _, fname, error in results if error is not None]
+if len(fnames) > 1:
+    print('[client] %d/%d files have been transferred' % (len(fnames) - len(failed), len(fnames)))
+
+sys.exit(1 if failed else 0)
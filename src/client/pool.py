@@ -0,0 +1,255 @@
+import heapq
+import os
+import threading
+import time
+from typing import List, Tuple, TypedDict
+
+from file_client import Client, TransferError
+
+
+class TransferResult(TypedDict):
+    """
+    Result of a single file transfer of a pool.
+    Attributes:
+        action: 'U' - upload, 'D' - download
+        fname: The name of the file.
+        size: Size of the transferred file (0 if it has failed).
+        connection: Index of the pool connection that has transferred the file.
+        error: Why the transfer has failed, None on success.
+    """
+    action: str
+    fname: str
+    size: int
+    connection: int
+    error: TransferError | None
+
+
+class PoolReport(TypedDict):
+    """
+    Results of a bulk transfer of a pool.
+    Attributes:
+        results: Per-file results, in the order of the requests.
+        transferred: Number of files that have been transferred successfully.
+        failed: Number of files that have failed.
+        bytes: Total size of the transferred files.
+        elapsed: Wall time of the whole transfer (seconds).
+        throughput: Aggregate throughput (bytes per second).
+        connections: Number of connections that have been used.
+    """
+    results: List[TransferResult]
+    transferred: int
+    failed: int
+    bytes: int
+    elapsed: float
+    throughput: float
+    connections: int
+
+
+def schedule(sizes: List[int], connections: int) -> List[List[int]]:
+    """
+    Split the files across the connections so that each connection transfers roughly the same number of bytes:
+    the largest file goes first, to the connection with the least bytes assigned so far (LPT scheduling).
+    Files of unknown size (0) are spread evenly by their count.
+    :param sizes: Size of each file.
+    :param connections:
+    :return: Indices of the files for each connection, largest first.
+    """
+    # (bytes, files, connection) of each connection
+    loads = [(0, 0, i) for i in range(connections)]
+    assigned: List[List[int]] = [[] for _ in range(connections)]
+
+    for index in sorted(range(len(sizes)), key=lambda i: -sizes[i]):
+        load, count, connection = heapq.heappop(loads)
+        assigned[connection].append(index)
+        heapq.heappush(loads, (load + sizes[index], count + 1, connection))
+
+    return assigned
+
+
+class ClientPool:
+    """
+    Transfers a list of files over a pool of connections to the server in parallel (a thread per connection), so
+    a single TCP stream does not limit the throughput on high-latency paths. The requests of each connection are
+    pipelined by `Client.transfer_files`. A single large file can be downloaded in segments over the pool as well.
+    """
+
+    def __init__(self, addr: str, connections=4, min_segment_len=1 << 20, **client_options):
+        """
+        :param addr: host:port of the server.
+        :param connections: Max number of connections opened to the server.
+        :param min_segment_len: A file downloaded in segments is split into segments of at least this size.
+        :param client_options: Passed to each `Client`.
+        """
+        self.__addr = addr
+        self.__connections = connections
+        self.__min_segment_len = min_segment_len
+        self.__client_options = client_options
+
+    def transfer_files(self, requests: List[Tuple[str, str]]) -> PoolReport:
+        """
+        Upload/download the files over the pool of connections.
+        :param requests: List of (action, fname), where action is 'U' (upload) or 'D' (download).
+        :return:
+        """
+        # the size of a downloaded file is not known until it is downloaded
+        sizes = [self.__local_size(fname) if action == 'U' else 0 for action, fname in requests]
+        assigned = [indices for indices in schedule(sizes, min(self.__connections, len(requests))) if indices]
+
+        results: List[TransferResult | None] = [None] * len(requests)
+        start = time.perf_counter()
+
+        threads = [
+            threading.Thread(
+                target=self.__run_connection, args=(connection, indices, requests, results), daemon=True
+            )
+            for connection, indices in enumerate(assigned)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        return self.__report(results, time.perf_counter() - start, len(assigned))
+
+    def download_segmented(self, fname: str) -> PoolReport:
+        """
+        Download a single file split into segments, each segment over its own connection. The segments are written
+        in place into the local file, preallocated to the size of the file.
+        :param fname:
+        :return:
+        """
+        start = time.perf_counter()
+
+        client = Client(self.__addr, **self.__client_options)
+        if not client.connect():
+            error = TransferError("Could not connect to %s" % self.__addr)
+            return self.__report([self.__result('D', fname, 0, 0, error)], time.perf_counter() - start, 1)
+
+        try:
+            fsize, _ = client.stat(fname)
+            if fsize < 2 * self.__min_segment_len:
+                # not worth splitting (or missing, the server reports the error of a plain download)
+                (action, fname, error), = client.transfer_files([('D', fname)])
+                size = self.__local_size(fname) if error is None else 0
+                return self.__report([self.__result('D', fname, size, 0, error)], time.perf_counter() - start, 1)
+        except TransferError as e:
+            return self.__report([self.__result('D', fname, 0, 0, e)], time.perf_counter() - start, 1)
+        finally:
+            client.close()
+
+        segments = min(self.__connections, fsize // self.__min_segment_len)
+        segment_len = -(-fsize // segments)  # ceil
+        self.__preallocate(fname, fsize)
+        print('[client] downloading "%s" (%dB) in %d segments...' % (fname, fsize, segments))
+
+        errors: List[TransferError | None] = [None] * segments
+        threads = [
+            threading.Thread(
+                target=self.__run_segment, daemon=True,
+                args=(i, fname, i * segment_len, min(segment_len, fsize - i * segment_len), errors)
+            )
+            for i in range(segments)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        error = next((e for e in errors if e is not None), None)
+        result = self.__result('D', fname, fsize if error is None else 0, 0, error)
+        return self.__report([result], time.perf_counter() - start, segments)
+
+    def __run_segment(self, segment: int, fname: str, offset: int, length: int, errors: List[TransferError | None]):
+        """
+        Download a segment of a file over its own connection (runs on its own thread).
+        :param segment: Index of the segment.
+        :param fname:
+        :param offset:
+        :param length:
+        :param errors: The error of the segment is stored here (at its index), if it fails.
+        :return:
+        """
+        client = Client(self.__addr, **self.__client_options)
+        if not client.connect():
+            errors[segment] = TransferError("Could not connect to %s" % self.__addr)
+            return
+
+        try:
+            if client.download_part(fname, offset, length) != length:
+                raise TransferError("segment %d of the file has been cut short" % segment)
+        except TransferError as e:
+            errors[segment] = e
+        except OSError as e:
+            errors[segment] = TransferError(str(e))
+        finally:
+            client.close()
+
+    def __run_connection(self, connection: int, indices: List[int], requests: List[Tuple[str, str]],
+                         results: List[TransferResult | None]):
+        """
+        Transfer the assigned files over a single connection (runs on its own thread).
+        :param connection: Index of the connection.
+        :param indices: Indices of the requests assigned to the connection.
+        :param requests:
+        :param results: The results of the transferred files are stored here (at the index of their request).
+        :return:
+        """
+        client = Client(self.__addr, **self.__client_options)
+        if client.connect():
+            try:
+                transferred = client.transfer_files([requests[i] for i in indices])
+            finally:
+                client.close()
+        else:
+            error = TransferError("Could not connect to %s" % self.__addr)
+            transferred = [(requests[i][0], requests[i][1], error) for i in indices]
+
+        for index, (action, fname, error) in zip(indices, transferred):
+            results[index] = self.__result(
+                action, fname, self.__local_size(fname) if error is None else 0, connection, error
+            )
+
+    @staticmethod
+    def __result(action: str, fname: str, size: int, connection: int, error: TransferError | None) -> TransferResult:
+        return {'action': action, 'fname': fname, 'size': size, 'connection': connection, 'error': error}
+
+    @staticmethod
+    def __report(results: List[TransferResult], elapsed: float, connections: int) -> PoolReport:
+        """
+        Sum up the results of the transfers.
+        """
+        transferred = sum(result['size'] for result in results if result['error'] is None)
+        failed = sum(1 for result in results if result['error'] is not None)
+
+        return {
+            'results': results,
+            'transferred': len(results) - failed,
+            'failed': failed,
+            'bytes': transferred,
+            'elapsed': elapsed,
+            'throughput': transferred / elapsed if elapsed > 0 else 0.0,
+            'connections': connections,
+        }
+
+    @staticmethod
+    def __preallocate(fname: str, fsize: int):
+        """
+        Create the local file with the given size, reserving the disk space where possible.
+        """
+        fd = os.open(fname, os.O_WRONLY | os.O_CREAT)
+        try:
+            os.ftruncate(fd, fsize)
+            if hasattr(os, 'posix_fallocate'):
+                try:
+                    os.posix_fallocate(fd, 0, fsize)
+                except OSError:
+                    pass  # not supported by the filesystem, the file is sparse then
+        finally:
+            os.close(fd)
+
+    @staticmethod
+    def __local_size(fname: str) -> int:
+        try:
+            return os.path.getsize(fname)
+        except OSError:
+            return 0
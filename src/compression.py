@@ -0,0 +1,197 @@
+"""
+Streaming compression of the transferred files, shared by the server and the client (see
+server-client-communication.md). The compressed stream is sent in length-prefixed frames, so the receiver knows where
+the stream ends without reading past it (into the next request/response).
+"""
+import bz2
+import lzma
+import zlib
+from typing import Iterator
+
+from helpers import ViewReader
+
+NONE = 0
+# codec id -> name, the ids are sent in the protocol
+CODECS = {1: 'zlib', 2: 'bz2', 3: 'lzma'}
+CODEC_IDS = {name: codec for codec, name in CODECS.items()}
+
+# the first bytes of a file are compressed to find out if the file is worth compressing
+SAMPLE_LEN = 64 * 1024
+# ... it is if it shrinks at least this many times
+MIN_RATIO = 1.1
+
+FRAME_HEADER_LEN = 4
+MAX_FRAME_LEN = 1 << 20
+
+FRAME_BYTEORDER = 'little'
+
+
+def _new_compressor(codec: int):
+    if codec == 1:
+        return zlib.compressobj(6)
+    if codec == 2:
+        return bz2.BZ2Compressor(9)
+    if codec == 3:
+        return lzma.LZMACompressor(preset=1)  # the default preset is too slow for streaming
+
+    raise ValueError("Unknown codec %d" % codec)
+
+
+def _new_decompressor(codec: int):
+    if codec == 1:
+        return zlib.decompressobj()
+    if codec == 2:
+        return bz2.BZ2Decompressor()
+    if codec == 3:
+        return lzma.LZMADecompressor()
+
+    raise ValueError("Unknown codec %d" % codec)
+
+
+def worth_compressing(codec: int, sample: bytes) -> bool:
+    """
+    Whether a file starting with the given sample shrinks enough when compressed by the codec.
+    :param codec:
+    :param sample: The first (at most `SAMPLE_LEN`) bytes of the file.
+    :return:
+    """
+    if not sample:
+        return False
+
+    compressor = _new_compressor(codec)
+    compressed_len = len(compressor.compress(sample)) + len(compressor.flush())
+    return compressed_len * MIN_RATIO <= len(sample)
+
+
+def ratio(raw_len: int, compressed_len: int) -> float:
+    """
+    :return: How many times the data has shrunk.
+    """
+    return raw_len / compressed_len if compressed_len else 0.0
+
+
+class Compressor:
+    """
+    Compresses a stream into frames.
+    Attributes:
+        raw_len: Number of bytes compressed so far.
+        compressed_len: Number of compressed bytes produced so far (without the frame headers).
+    """
+
+    def __init__(self, codec: int):
+        self.__compressor = _new_compressor(codec)
+        self.raw_len = 0
+        self.compressed_len = 0
+
+    def compress(self, data) -> bytes:
+        """
+        Compress the next part of the stream.
+        :param data:
+        :return: Frames of the compressed data, may be empty when the codec buffers the data.
+        """
+        self.raw_len += len(data)
+        return self.__frame(self.__compressor.compress(data))
+
+    def flush(self) -> bytes:
+        """
+        End the stream.
+        :return: Frames of the rest of the compressed data.
+        """
+        return self.__frame(self.__compressor.flush())
+
+    def __frame(self, data: bytes) -> bytes:
+        self.compressed_len += len(data)
+
+        frames = bytearray()
+        for pos in range(0, len(data), MAX_FRAME_LEN):
+            chunk = data[pos:pos + MAX_FRAME_LEN]
+            frames += len(chunk).to_bytes(FRAME_HEADER_LEN, FRAME_BYTEORDER) + chunk
+
+        return bytes(frames)
+
+
+class Decompressor:
+    """
+    Decompresses a stream of frames, received in parts of any size.
+    Attributes:
+        raw_len: Number of bytes decompressed so far.
+        compressed_len: Number of compressed bytes received so far (without the frame headers).
+    """
+
+    def __init__(self, codec: int, max_chunk_len=1 << 20):
+        """
+        :param codec:
+        :param max_chunk_len: Max size of the decompressed chunks, so a small frame does not expand to a huge buffer.
+        """
+        self.__codec = codec
+        self.__decompressor = _new_decompressor(codec)
+        self.__max_chunk_len = max_chunk_len
+
+        self.__header = bytearray()
+        self.__frame_remaining = 0
+
+        self.raw_len = 0
+        self.compressed_len = 0
+
+    @property
+    def eof(self) -> bool:
+        """
+        Whether the whole stream has been decompressed.
+        """
+        return self.__decompressor.eof
+
+    def feed(self, reader: ViewReader) -> Iterator[bytes]:
+        """
+        Read frames from the reader and decompress them. Stops reading at the end of the stream.
+        :param reader: reader of the received data
+        :return: The decompressed chunks.
+        :raise ValueError: If the stream is not valid.
+        """
+        while len(reader) > 0 and not self.eof:
+            if self.__frame_remaining == 0:
+                self.__header += reader.read(FRAME_HEADER_LEN - len(self.__header))
+                if len(self.__header) < FRAME_HEADER_LEN:
+                    return  # the frame header is not complete yet
+
+                self.__frame_remaining = int.from_bytes(self.__header, FRAME_BYTEORDER)
+                self.__header = bytearray()
+                if self.__frame_remaining > MAX_FRAME_LEN:
+                    raise ValueError("Frame of %dB is too long" % self.__frame_remaining)
+                continue
+
+            data = reader.read(self.__frame_remaining)
+            self.__frame_remaining -= len(data)
+            self.compressed_len += len(data)
+
+            try:
+                yield from self.__decompress(data)
+            except (zlib.error, lzma.LZMAError, OSError, EOFError) as e:
+                raise ValueError("Invalid compressed data: %s" % e)
+
+            if self.eof and (self.__frame_remaining > 0 or self.__decompressor.unused_data):
+                raise ValueError("Data after the end of the compressed stream")
+
+    def __decompress(self, data) -> Iterator[bytes]:
+        """
+        Decompress a part of the stream, in chunks of at most `max_chunk_len` bytes.
+        """
+        if self.__codec == 1:
+            out = self.__decompressor.decompress(data, self.__max_chunk_len)
+            self.raw_len += len(out)
+            yield out
+
+            # the output can be cut by the limit even when the whole input has been consumed
+            while not self.eof and (self.__decompressor.unconsumed_tail or len(out) == self.__max_chunk_len):
+                out = self.__decompressor.decompress(self.__decompressor.unconsumed_tail, self.__max_chunk_len)
+                self.raw_len += len(out)
+                yield out
+            return
+
+        out = self.__decompressor.decompress(data, self.__max_chunk_len)
+        self.raw_len += len(out)
+        yield out
+
+        while not self.eof and not self.__decompressor.needs_input:
+            out = self.__decompressor.decompress(b'', self.__max_chunk_len)
+            self.raw_len += len(out)
+            yield out
@@ -0,0 +1,380 @@
+"""
+Delta transfer of a file the receiver holds an older version of (rsync algorithm), shared by the server and the
+client (see server-client-communication.md). The receiver sends the signatures of the blocks of its version, the
+sender finds the blocks in its version with a rolling checksum and sends only the bytes that are not in any block.
+"""
+import hashlib
+import math
+import os
+import zlib
+from typing import Callable, Dict, Iterator, List, Tuple
+
+from helpers import ViewReader
+
+MIN_BLOCK_LEN = 2048
+MAX_BLOCK_LEN = 1 << 17
+
+WEAK_LEN = 4  # adler32, it can be rolled over the sender's file byte by byte
+STRONG_LEN = 16  # blake2b, to confirm the matches of the weak checksum
+SIGNATURE_LEN = WEAK_LEN + STRONG_LEN
+
+# operations of the delta stream
+OP_END = 0  # followed by the SHA-256 of the whole file
+OP_COPY = 1  # followed by the index of the first block (8B) and the number of blocks (4B)
+OP_LITERAL = 2  # followed by the length (4B) and the bytes
+COPY_LEN = 12
+LITERAL_HEADER_LEN = 4
+DIGEST_LEN = 32
+MAX_LITERAL_LEN = 1 << 20
+
+BYTEORDER = 'little'
+
+_ADLER_MOD = 65521
+
+
+def block_len_for(size: int) -> int:
+    """
+    Get the length of the blocks a file of the given size is split into: about the square root of the size, so
+    both the signatures and the rolling search stay small.
+    :param size:
+    :return:
+    """
+    return min(MAX_BLOCK_LEN, max(MIN_BLOCK_LEN, -(-math.isqrt(size) // 1024) * 1024))
+
+
+def block_count(size: int, block_len: int) -> int:
+    return -(-size // block_len)
+
+
+def _strong(data) -> bytes:
+    return hashlib.blake2b(data, digest_size=STRONG_LEN).digest()
+
+
+def signatures(read_at: Callable[[int, int], bytes], size: int, block_len: int) -> bytes:
+    """
+    Get the signatures of the blocks of the receiver's file (the last block may be shorter).
+    :param read_at: Reads (count, offset) bytes of the file.
+    :param size: Size of the file.
+    :param block_len:
+    :return: Weak and strong checksum of each block.
+    """
+    out = bytearray()
+    for offset in range(0, size, block_len):
+        block = read_at(min(block_len, size - offset), offset)
+        if len(block) != min(block_len, size - offset):
+            raise EOFError("file has been truncated")
+
+        out += zlib.adler32(block).to_bytes(WEAK_LEN, BYTEORDER) + _strong(block)
+
+    return bytes(out)
+
+
+def parse_signatures(data: bytes, size: int, block_len: int) -> Dict[int, List[Tuple[int, bytes, int]]]:
+    """
+    Index the receiver's signatures by their weak checksum.
+    :param data: The signatures.
+    :param size: Size of the receiver's file.
+    :param block_len:
+    :return: weak checksum -> [(index, strong checksum, length) of the blocks]
+    """
+    table: Dict[int, List[Tuple[int, bytes, int]]] = {}
+    for index in range(block_count(size, block_len)):
+        pos = index * SIGNATURE_LEN
+        weak = int.from_bytes(data[pos:pos + WEAK_LEN], BYTEORDER)
+        strong = bytes(data[pos + WEAK_LEN:pos + SIGNATURE_LEN])
+        table.setdefault(weak, []).append((index, strong, min(block_len, size - index * block_len)))
+
+    return table
+
+
+class Encoder:
+    """
+    Produces the delta stream of the sender's file against the receiver's signatures.
+
+    The rolling search runs byte by byte in Python, it is bounded: once `max_roll_blocks` block lengths have been
+    rolled over without a match, the rest of the unmatched run is only probed once per block length (a block of
+    the receiver is found there only if it is aligned with the probes). Without any signatures the file is sent as
+    literals right away.
+    Attributes:
+        literal_len: Number of bytes of the file sent as they are.
+        copied_len: Number of bytes of the file the receiver copies from its version.
+    """
+
+    def __init__(self, table: Dict[int, List[Tuple[int, bytes, int]]], block_len: int, read_len=4 << 20,
+                 max_roll_blocks=8):
+        """
+        :param table: The receiver's signatures (see `parse_signatures`).
+        :param block_len:
+        :param read_len: Number of bytes of the file read at once.
+        :param max_roll_blocks: Number of block lengths rolled over after a match (or the start of the file) before
+        the search falls back to probing at every block length.
+        """
+        self.__table = table
+        self.__block_len = block_len
+        self.__read_len = max(read_len, 2 * block_len)
+        self.__max_roll = max_roll_blocks * block_len
+        self.__digest = hashlib.sha256()
+        # a run of copied blocks, not sent yet, as [first block, count]
+        self.__copy: List[int] | None = None
+        # length of the receiver's last block if it is shorter than the others, it can only match the end of the file
+        self.__tail_len = next(
+            (length for candidates in table.values() for _, _, length in candidates if length < block_len), 0
+        )
+
+        self.literal_len = 0
+        self.copied_len = 0
+
+    def encode(self, read: Callable[[int], bytes]) -> Iterator[bytes]:
+        """
+        Read the whole file and produce the delta stream.
+        :param read: Reads the next (at most count) bytes of the file, empty at the end.
+        :return: Parts of the delta stream.
+        """
+        if not self.__table:
+            yield from self.__encode_literal(read)
+            return
+
+        block_len, table = self.__block_len, self.__table
+        buffer, pos, literal_start, weak, eof = b'', 0, 0, None, False
+        # number of bytes rolled over since the last match
+        rolled = 0
+
+        while True:
+            if len(buffer) - pos <= block_len and not eof:
+                # keep the unmatched bytes, the rest of the buffer has been sent already
+                yield from self.__literal(buffer[literal_start:pos])
+                chunk = read(self.__read_len)
+                self.__digest.update(chunk)
+                buffer, pos, literal_start, weak, eof = buffer[pos:] + chunk, 0, 0, None, not chunk
+                continue
+
+            if len(buffer) - pos < block_len:
+                break  # the end of the file, only the receiver's last block can match there
+
+            window = memoryview(buffer)[pos:pos + block_len]
+            if weak is None:
+                weak = zlib.adler32(window)
+
+            index = self.__match(weak, window)
+            if index is not None:
+                yield from self.__literal(buffer[literal_start:pos])
+                yield from self.__copy_block(index)
+                self.copied_len += block_len
+                pos += block_len
+                literal_start, weak, rolled = pos, None, 0
+                continue
+
+            if pos + block_len == len(buffer):
+                break  # the last full window of the file
+
+            if rolled >= self.__max_roll:
+                # probe the next block length only
+                pos, weak = pos + block_len, None
+            else:
+                # roll the checksum byte by byte until its weak checksum is known (or the limit)
+                end = min(len(buffer) - block_len, pos + self.__max_roll - rolled)
+                a, b, start = weak & 0xffff, weak >> 16, pos
+                while pos < end:
+                    out_byte, in_byte = buffer[pos], buffer[pos + block_len]
+                    a = (a - out_byte + in_byte) % _ADLER_MOD
+                    b = (b - block_len * out_byte + a - 1) % _ADLER_MOD
+                    pos += 1
+                    if ((b << 16) | a) in table:
+                        break
+                weak = (b << 16) | a
+                rolled += pos - start
+
+            if pos - literal_start >= MAX_LITERAL_LEN:
+                yield from self.__literal(buffer[literal_start:pos])
+                literal_start = pos
+
+        end = len(buffer)
+        if self.__tail_len and end - self.__tail_len >= literal_start:
+            tail = memoryview(buffer)[end - self.__tail_len:]
+            index = self.__match(zlib.adler32(tail), tail)
+            if index is not None:
+                yield from self.__literal(buffer[literal_start:end - self.__tail_len])
+                yield from self.__copy_block(index)
+                self.copied_len += self.__tail_len
+                literal_start = end
+
+        yield from self.__literal(buffer[literal_start:])
+        yield from self.__flush_copy()
+        yield bytes([OP_END]) + self.__digest.digest()
+
+    def __encode_literal(self, read: Callable[[int], bytes]) -> Iterator[bytes]:
+        """
+        Produce the delta stream of the whole file as literals (the receiver has no blocks).
+        """
+        while True:
+            chunk = read(self.__read_len)
+            if not chunk:
+                break
+
+            self.__digest.update(chunk)
+            yield from self.__literal(chunk)
+
+        yield bytes([OP_END]) + self.__digest.digest()
+
+    def __match(self, weak: int, window) -> int | None:
+        """
+        Find a block of the receiver with the same content as the window.
+        """
+        candidates = self.__table.get(weak, None)
+        if not candidates:
+            return None
+
+        strong = _strong(window)
+        for index, block_strong, length in candidates:
+            if length == len(window) and block_strong == strong:
+                return index
+
+        return None
+
+    def __copy_block(self, index: int) -> Iterator[bytes]:
+        if self.__copy is not None and self.__copy[0] + self.__copy[1] == index:
+            self.__copy[1] += 1
+            return
+
+        yield from self.__flush_copy()
+        self.__copy = [index, 1]
+
+    def __flush_copy(self) -> Iterator[bytes]:
+        if self.__copy is not None:
+            first, count = self.__copy
+            self.__copy = None
+            yield bytes([OP_COPY]) + first.to_bytes(8, BYTEORDER) + count.to_bytes(4, BYTEORDER)
+
+    def __literal(self, data: bytes) -> Iterator[bytes]:
+        if not data:
+            return
+
+        yield from self.__flush_copy()
+        self.literal_len += len(data)
+        for pos in range(0, len(data), MAX_LITERAL_LEN):
+            chunk = data[pos:pos + MAX_LITERAL_LEN]
+            yield bytes([OP_LITERAL]) + len(chunk).to_bytes(LITERAL_HEADER_LEN, BYTEORDER) + chunk
+
+
+class Decoder:
+    """
+    Parses the delta stream, received in parts of any size, into operations rebuilding the sender's file:
+    ('copy', offset, length) of a range of the receiver's file, or ('literal', data).
+    Attributes:
+        size: Size of the rebuilt file so far.
+        literal_len: Number of bytes received as they are.
+        digest: SHA-256 of the sender's file, once the whole stream has been received.
+    """
+
+    def __init__(self, basis_size: int, block_len: int):
+        """
+        :param basis_size: Size of the receiver's file.
+        :param block_len:
+        """
+        self.__basis_size = basis_size
+        self.__block_len = block_len
+        self.__op: int | None = None
+        self.__header = bytearray()
+        self.__literal_remaining = 0
+
+        self.size = 0
+        self.literal_len = 0
+        self.digest: bytes | None = None
+
+    @property
+    def done(self) -> bool:
+        """
+        Whether the whole stream has been received.
+        """
+        return self.digest is not None
+
+    def feed(self, reader: ViewReader) -> Iterator[tuple]:
+        """
+        Read the operations from the reader. Stops reading at the end of the stream.
+        :param reader: reader of the received data
+        :return: The operations.
+        :raise ValueError: If the stream is not valid.
+        """
+        while len(reader) > 0 and not self.done:
+            if self.__op is None:
+                self.__op = reader.read(1)[0]
+                if self.__op not in (OP_END, OP_COPY, OP_LITERAL):
+                    raise ValueError("Unknown operation %d" % self.__op)
+                continue
+
+            if self.__literal_remaining > 0:
+                data = bytes(reader.read(self.__literal_remaining))
+                self.__literal_remaining -= len(data)
+                self.size += len(data)
+                self.literal_len += len(data)
+                if self.__literal_remaining == 0:
+                    self.__op = None
+                yield 'literal', data
+                continue
+
+            header_len = {OP_END: DIGEST_LEN, OP_COPY: COPY_LEN, OP_LITERAL: LITERAL_HEADER_LEN}[self.__op]
+            self.__header += reader.read(header_len - len(self.__header))
+            if len(self.__header) < header_len:
+                return  # the operation is not complete yet
+
+            header, op = bytes(self.__header), self.__op
+            self.__header = bytearray()
+
+            if op == OP_END:
+                self.digest = header
+                self.__op = None
+
+            elif op == OP_COPY:
+                self.__op = None
+                first, count = int.from_bytes(header[:8], BYTEORDER), int.from_bytes(header[8:], BYTEORDER)
+                if count == 0 or first + count > block_count(self.__basis_size, self.__block_len):
+                    raise ValueError("Blocks %d-%d are out of the file" % (first, first + count))
+
+                offset = first * self.__block_len
+                length = min(count * self.__block_len, self.__basis_size - offset)
+                self.size += length
+                yield 'copy', offset, length
+
+            else:
+                self.__literal_remaining = int.from_bytes(header, BYTEORDER)
+                if not 0 < self.__literal_remaining <= MAX_LITERAL_LEN:
+                    raise ValueError("Invalid literal length %d" % self.__literal_remaining)
+
+
+def apply(basis_fd: int | None, out_fd: int, ops: List[tuple], digest, chunk_len=1 << 20) -> int:
+    """
+    Write the operations into the rebuilt file.
+    :param basis_fd: The receiver's file, None if it does not have one.
+    :param out_fd: The rebuilt file, written at its current position.
+    :param ops: See `Decoder`.
+    :param digest: The written bytes are hashed by this hash object.
+    :param chunk_len: Max number of bytes of the receiver's file copied at once.
+    :return: Number of bytes written.
+    :raise EOFError: If the receiver's file has been truncated meanwhile.
+    """
+    written = 0
+    for op in ops:
+        if op[0] == 'literal':
+            chunks = [op[1]]
+        else:
+            _, offset, length = op
+            chunks = (
+                _read_block(basis_fd, min(chunk_len, offset + length - pos), pos)
+                for pos in range(offset, offset + length, chunk_len)
+            )
+
+        for chunk in chunks:
+            digest.update(chunk)
+            view = memoryview(chunk)
+            while view:
+                view = view[os.write(out_fd, view):]
+            written += len(chunk)
+
+    return written
+
+
+def _read_block(fd: int, count: int, offset: int) -> bytes:
+    data = os.pread(fd, count, offset)
+    if len(data) != count:
+        raise EOFError("file has been truncated")
+    return data
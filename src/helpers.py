@@ -8,3 +8,32 @@ def read_buffer(buffer: bytearray, len: int):
     out = buffer[:len]
     del buffer[:len]
     return out
+
+
+class ViewReader:
+    """
+    Reads consecutive parts of a memoryview by advancing an offset, so neither the read data is copied nor the
+    remaining data is shifted (unlike `read_buffer`).
+    """
+
+    __slots__ = ('view', 'pos')
+
+    def __init__(self, view: memoryview):
+        self.view = view
+        self.pos = 0
+
+    def __len__(self):
+        """
+        :return: Number of bytes that have not been read yet.
+        """
+        return len(self.view) - self.pos
+
+    def read(self, len: int) -> memoryview:
+        """
+        Read `len` bytes and advance the offset.
+        :param len:
+        :return: At most `len` long memoryview of the remaining data.
+        """
+        out = self.view[self.pos:self.pos + len]
+        self.pos += out.nbytes
+        return out
@@ -7,6 +7,7 @@ if len(argv):
     del argv[0]
 
 switchesVarDefaults = ()
+args = []  # positional (non-switch) arguments, in order
 
 
 def parseParams(_switchesVarDefaults):
@@ -22,6 +23,9 @@ def parseParams(_switchesVarDefaults):
         while len(argv):
             sw = argv[0]
             del argv[0]
+            if not sw.startswith('-'):
+                args.append(sw)
+                continue
             paramVar, defaultVal = swVarDefaultMap[sw]
             if defaultVal:
                 val = argv[0]
@@ -0,0 +1,357 @@
+import asyncio
+import os
+import socket
+import helpers
+import reserved
+from adaptive import AdaptiveSize
+from file_server import ROOT_DIR
+from log import logger
+
+
+class AsyncFileServer:
+    """
+    File server engine built on asyncio, speaking the same protocol as `FileServer` (see
+    server-client-communication.md), so it can be embedded into other asyncio services.
+    Uploads are received by a buffered protocol, downloads are sent with `loop.sendfile`.
+    """
+
+    def __init__(self, port, max_conns, data_folder: str, byteorder="little", read_buffer_len=1024,
+                 max_read_buffer_len=None, reuse_port=False):
+        """
+        :param port:
+        :param max_conns: The backlog of the listening socket.
+        :param data_folder: Folder (relative to the server directory) where the files are stored.
+        :param byteorder:
+        :param read_buffer_len: Number of bytes read from a client at once, while it sends small messages.
+        :param max_read_buffer_len: Max number of bytes read from a client at once. Defaults to `read_buffer_len`.
+        :param reuse_port: Set SO_REUSEPORT, see `SocketServer`.
+        """
+        self.__port = port
+        self.__max_conns = max_conns
+        self.__data_folder = os.path.abspath(os.path.join(ROOT_DIR, data_folder))
+        self.__byteorder = byteorder
+        self.__read_buffer_len = read_buffer_len
+        self.__max_read_buffer_len = max_read_buffer_len or read_buffer_len
+
+        # bind right away (like SocketServer), so the socket can be shared by pre-forked workers
+        self.__socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.__socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            self.__socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.__socket.bind(('', self.__port))
+        self.__socket.setblocking(False)
+
+        self.__server: asyncio.Server | None = None
+
+    def listen(self):
+        """
+        Run an event loop serving the clients (blocks forever).
+        :return:
+        """
+        asyncio.run(self.serve_forever())
+
+    async def start(self):
+        """
+        Start serving the clients in the running event loop.
+        :return:
+        """
+        loop = asyncio.get_running_loop()
+        self.__server = await loop.create_server(
+            lambda: FileTransferProtocol(self), sock=self.__socket, backlog=self.__max_conns
+        )
+        logger.info('[server] listening on port %d (asyncio)...', self.__port)
+
+    async def serve_forever(self):
+        """
+        Start serving the clients in the running event loop and wait until the server is closed.
+        :return:
+        """
+        if self.__server is None:
+            await self.start()
+
+        try:
+            await self.__server.serve_forever()
+        except asyncio.CancelledError:
+            pass
+
+    def close(self, shutdown=True):
+        """
+        Close the server socket.
+        :param shutdown: See `SocketServer.close`.
+        :return:
+        """
+        if self.__server is not None:
+            self.__server.close()
+
+        if shutdown:
+            try:
+                self.__socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self.__socket.close()
+
+    @property
+    def byteorder(self):
+        return self.__byteorder
+
+    def new_read_size(self):
+        """
+        :return: Adaptive read size for a new connection.
+        """
+        return AdaptiveSize(self.__read_buffer_len, self.__max_read_buffer_len)
+
+    def get_file_path(self, fname: str):
+        """
+        Get the absolute path to the given fname in the data folder.
+        """
+        return os.path.abspath(os.path.join(self.__data_folder, fname))
+
+
+class FileTransferProtocol(asyncio.BufferedProtocol):
+    """
+    A single client connection of `AsyncFileServer`, holds the state of the client's current file transfer.
+    """
+
+    def __init__(self, server: AsyncFileServer):
+        self.__server = server
+        self.__byteorder = server.byteorder
+        self.__transport: asyncio.Transport | None = None
+        self.__port = 0
+
+        self.__read_size = server.new_read_size()
+        self.__buffer = bytearray(self.__read_size.size)
+        self.__view = memoryview(self.__buffer)
+        # data received while a download is in progress (the next request), processed after the download
+        self.__pending = b''
+
+        self.__reset_transfer()
+
+    # region Protocol callbacks
+
+    def connection_made(self, transport: asyncio.Transport):
+        self.__transport = transport
+        self.__port = transport.get_extra_info('peername')[1]
+        logger.debug("[%d] connected", self.__port)
+
+    def connection_lost(self, exc):
+        self.__end_transfer()
+        logger.debug("[%d] disconnected", self.__port)
+
+    def get_buffer(self, sizehint):
+        size = self.__read_size.size
+        if size > len(self.__buffer) or size < len(self.__buffer) // 4:
+            self.__buffer = bytearray(size)
+            self.__view = memoryview(self.__buffer)
+
+        return self.__view[:size]
+
+    def buffer_updated(self, nbytes):
+        self.__process(helpers.ViewReader(self.__view[:nbytes]))
+        self.__read_size.observe(nbytes)
+
+    # endregion
+
+    # region Transfer processing
+
+    def __process(self, reader: helpers.ViewReader):
+        """
+        Process the received data, it can contain the end of a request and the start of the next one.
+        :param reader:
+        :return:
+        """
+        while len(reader) > 0 and not self.__transport.is_closing():
+            if self.__downloading:
+                # the client has sent the next request already, process it once the download is done
+                self.__pending += bytes(reader.read(len(reader)))
+                return
+
+            if self.__action is None:
+                self.__action = chr(reader.read(1)[0])
+
+                if self.__action == 'U':
+                    logger.debug('[%d] -> requesting to upload a file...', self.__port)
+                elif self.__action == 'D':
+                    logger.debug('[%d] -> requesting to download a file...', self.__port)
+                else:
+                    logger.warning('[%d] unexpected action "%s"!', self.__port, self.__action)
+                    return self.__disconnect()
+
+            if self.__action == 'U':
+                self.__process_upload(reader)
+            else:
+                self.__process_download(reader)
+
+    def __process_upload(self, reader: helpers.ViewReader):
+        if self.__read_filename(reader) > 0 or self.__read_fsize(reader) > 0:
+            return  # the header is not complete yet
+
+        if self.__fd is None:
+            logger.debug('[%d] -> file is "%s" with size (%dB)', self.__port, self.__fname, self.__fsize)
+
+            if not 0 < self.__fsize < 2 ** 64:
+                self.__send_confirmation(False, "Invalid file size!")
+                return self.__disconnect()
+
+            self.__send_confirmation(True)
+            self.__fd = os.open(self.__server.get_file_path(self.__fname), os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+
+            logger.debug("[%d] -> sending file (%dB)...", self.__port, self.__fsize)
+
+        chunk = reader.read(self.__fsize - self.__fpos)
+        while chunk:
+            written = os.write(self.__fd, chunk)
+            self.__fpos += written
+            chunk = chunk[written:]
+
+        if self.__fpos < self.__fsize:
+            return  # the file is not complete yet
+
+        logger.debug("[%d] -> file has been received: %s", self.__port, self.__server.get_file_path(self.__fname))
+        self.__send_confirmation(True)
+        self.__end_transfer()
+
+    def __process_download(self, reader: helpers.ViewReader):
+        if self.__read_filename(reader) > 0:
+            return  # the filename is not complete yet
+
+        path = self.__server.get_file_path(self.__fname)
+        logger.debug('[%d] -> file is: %s', self.__port, path)
+
+        try:
+            file = open(path, 'rb')
+        except OSError:
+            self.__send_confirmation(False, "File not found!")
+            return self.__disconnect()
+
+        self.__send_confirmation(True)
+
+        # the client is not supposed to send anything until the download is done
+        self.__downloading = True
+        self.__transport.pause_reading()
+        asyncio.get_running_loop().create_task(self.__send_file(file))
+
+    async def __send_file(self, file):
+        """
+        Send the opened file to the client and continue processing the requests afterwards.
+        :param file:
+        :return:
+        """
+        with file:
+            fsize = os.fstat(file.fileno()).st_size
+            self.__transport.write(int.to_bytes(fsize, 8, self.__byteorder))
+            logger.debug("[%d] <- sending file (%dB)...", self.__port, fsize)
+
+            try:
+                # sendfile where possible, falls back to reading and writing the file otherwise
+                await asyncio.get_running_loop().sendfile(self.__transport, file, 0, fsize)
+            except (ConnectionError, RuntimeError):
+                return  # the client is gone (or the transport has been closed)
+
+        logger.debug("[%d] file has been sent", self.__port)
+        self.__end_transfer()
+
+        if not self.__transport.is_closing():
+            self.__transport.resume_reading()
+            if self.__pending:
+                pending, self.__pending = self.__pending, b''
+                self.__process(helpers.ViewReader(memoryview(pending)))
+
+    # endregion
+
+    # region Framing/un-framing
+
+    def __read_filename(self, reader: helpers.ViewReader):
+        """
+        Reads the fname until the fname is complete. The server's own files are not transferred, the client is
+        disconnected if it requests one.
+        :param reader:
+        :return: Number of bytes remaining for the fname to be complete (the fname length if the client has been
+        disconnected).
+        """
+        if self.__fname_len == 0:
+            if len(reader) == 0:
+                return 1
+
+            self.__fname_len = int.from_bytes(reader.read(1), self.__byteorder)
+            if self.__fname_len <= 0:
+                raise Exception("Invalid filename length %d" % self.__fname_len)
+
+        diff = self.__fname_len - len(self.__fname)
+        if diff > 0:
+            self.__fname += str(reader.read(diff), "utf-8")
+            diff = self.__fname_len - len(self.__fname)
+            if diff == 0 and reserved.is_reserved(self.__fname):
+                logger.warning('[%d] reserved file name "%s"!', self.__port, self.__fname)
+                self.__send_confirmation(False, "Reserved file name!")
+                self.__disconnect()
+                return self.__fname_len
+
+        return diff
+
+    def __read_fsize(self, reader: helpers.ViewReader):
+        """
+        Reads the fsize until the fsize is complete.
+        :param reader:
+        :return: Number of bytes remaining for the fsize to be complete.
+        """
+        diff = 8 - len(self.__fsize_buffer)
+        if diff > 0:
+            self.__fsize_buffer += reader.read(diff)
+            diff = 8 - len(self.__fsize_buffer)
+
+            if diff == 0:
+                self.__fsize = int.from_bytes(self.__fsize_buffer, self.__byteorder)
+
+        return diff
+
+    def __send_confirmation(self, ok: bool, error: str = None):
+        """
+        Send a confirmation message to the client.
+        :param ok: if "OK" or "ERROR"
+        :param error: Error message in case of `not ok`.
+        :return:
+        """
+        if not ok and (error is None or not 0 < len(error) < 256):
+            raise Exception("Missing or invalid error message for a confirmation!")
+
+        msg = int.to_bytes(0 if ok else 1, 1, self.__byteorder)
+        if not ok:
+            msg += int.to_bytes(len(error), 1, self.__byteorder) + bytes(error.encode("utf-8"))
+
+        self.__transport.write(msg)
+        if ok:
+            logger.debug("[%d] <- OK", self.__port)
+        else:
+            logger.info("[%d] <- ERROR: %s", self.__port, error)
+
+    # endregion
+
+    # region Transfer state management
+
+    def __disconnect(self):
+        logger.debug("[%d] disconnecting by server...", self.__port)
+        # the transport sends the buffered data (e.g. the error confirmation) before closing
+        self.__transport.close()
+
+    def __reset_transfer(self):
+        """
+        Prepare the state for the next request of the client.
+        :return:
+        """
+        self.__action = None
+        self.__fname, self.__fname_len = '', 0
+        self.__fsize, self.__fsize_buffer = 0, bytearray(0)
+        self.__fpos, self.__fd = 0, None
+        self.__downloading = False
+
+    def __end_transfer(self):
+        """
+        End the file transfer of the client (if any).
+        :return:
+        """
+        if self.__fd is not None:
+            os.close(self.__fd)
+
+        self.__reset_transfer()
+
+    # endregion
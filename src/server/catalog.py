@@ -0,0 +1,346 @@
+import bisect
+import json
+import os
+import stat
+import time
+from typing import Dict, Iterable, List, Set, Tuple
+
+import reserved
+
+# (name, size, mtime_ns) of a listed file
+Entry = Tuple[str, int, int]
+
+# the mtimes of the file system may lag behind the clock (coarse timestamps), a directory changed this recently (ns)
+# when it is listed may change again without its mtime changing, it is listed again on the next check
+MTIME_SLACK = 1_000_000_000
+
+# the recorded mtime of a directory that has to be listed again on the next check
+UNCHECKED = -1
+
+
+class Catalog:
+    """
+    In-memory catalog of the files of the data folder (name, size, mtime), kept sorted by name so a listing is
+    a binary search and a slice, never a scan of the folder. The file server updates it as the uploads complete.
+
+    Each completed upload is also appended to a journal in the data folder, shared by the pre-forked workers: a worker
+    reads the uploads of the others from it before listing the files. The journal also covers the uploads since
+    the last snapshot if the server has not been closed cleanly.
+
+    The catalog is persisted into the data folder on `save` and loaded from there on startup, with the mtime of
+    each directory when it was last listed. On both, only the directories changed since then are listed again and
+    only their new files are stat-ed (files added or removed behind the server's back, e.g. by the server running
+    without the catalog); on load the journal is replayed as well (files overwritten since). Only a file overwritten
+    or replaced by something else than the server with the catalog keeps its old size and mtime. Every file is only
+    stat-ed if there is no valid snapshot.
+    """
+    SNAPSHOT_FNAME = reserved.CATALOG_FNAME
+    JOURNAL_FNAME = reserved.CATALOG_JOURNAL_FNAME
+
+    def __init__(self, data_folder: str):
+        """
+        :param data_folder: Absolute path of the data folder.
+        """
+        self.__data_folder = data_folder
+        # __entries[fname] = (size, mtime_ns) of the file (fname is relative to the data folder)
+        self.__entries: Dict[str, Tuple[int, int]] = {}
+        # the fnames, sorted
+        self.__names: List[str] = []
+        # __by_dir[dir] = fnames of the files directly in the directory (dir is relative to the data folder)
+        self.__by_dir: Dict[str, Set[str]] = {}
+        # __dirs[dir] = mtime_ns of the directory when it was listed (UNCHECKED if it has to be listed again)
+        self.__dirs: Dict[str, int] = {}
+        # the journal (opened for appending by `load`) and the position up to which it has been read
+        self.__journal: int | None = None
+        self.__journal_pos = 0
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def load(self):
+        """
+        Load the persisted snapshot and bring it up to date, or index the data folder if there is no snapshot. Then
+        start a new journal (the snapshot is saved with everything it has covered), the workers forked afterwards
+        share it.
+        :return:
+        """
+        try:
+            with open(os.path.join(self.__data_folder, self.SNAPSHOT_FNAME)) as f:
+                snapshot = json.load(f)
+            journal_ino, journal_pos = snapshot['journal']
+            entries = {fname: (size, mtime_ns) for fname, (size, mtime_ns) in snapshot['entries'].items()}
+            dirs = {rel_dir: int(mtime_ns) for rel_dir, mtime_ns in snapshot['dirs'].items()}
+        except (OSError, ValueError, TypeError, KeyError):
+            self.scan()
+        else:
+            self.__entries, self.__names, self.__by_dir, self.__dirs = {}, [], {}, dirs
+            self.__add_entries(entries)
+            self.__check_dirs()
+            self.__replay_journal(journal_ino, journal_pos)
+
+        # a new (empty) journal, the snapshot has all the entries of the old one
+        os.makedirs(os.path.join(self.__data_folder, reserved.STATE_FOLDER), exist_ok=True)
+        path = os.path.join(self.__data_folder, self.JOURNAL_FNAME)
+        tmp = '%s.%d.catalog-tmp' % (path, os.getpid())
+        if self.__journal is not None:
+            os.close(self.__journal)
+        self.__journal = os.open(tmp, os.O_RDWR | os.O_APPEND | os.O_CREAT | os.O_TRUNC)
+        os.replace(tmp, path)
+        self.__journal_pos = 0
+        self.__save()
+
+    def scan(self):
+        """
+        Index the files of the data folder.
+        :return:
+        """
+        self.__entries, self.__names, self.__by_dir, self.__dirs = {}, [], {}, {}
+        added = {}
+        self.__list_dir(os.curdir, added, set())
+        self.__add_entries(added)
+
+    def save(self):
+        """
+        Persist the catalog into the data folder (with the uploads of the other workers, and the files changed
+        behind the server's back).
+        :return:
+        """
+        self.refresh()
+        self.__save()
+
+    def refresh(self):
+        """
+        Apply the uploads appended to the journal (by any of the workers) since the last refresh.
+        :return:
+        """
+        if self.__journal is not None:
+            self.__journal_pos = self.__apply_journal(self.__journal, self.__journal_pos)
+
+    def update(self, fname: str):
+        """
+        Add a file to the catalog, or update its size and mtime (an upload of the file has completed).
+        :param fname: Path of the file, relative to the data folder.
+        :return:
+        """
+        fname = self.__normalize(fname)
+        if self.__refresh_entry(fname) and self.__journal is not None:
+            # a single write of the append-only journal, the lines of the workers are not interleaved
+            os.write(self.__journal, (json.dumps(fname) + '\n').encode())
+
+    def discard(self, fname: str):
+        """
+        Remove a file from the catalog.
+        :param fname: Path of the file, relative to the data folder.
+        :return:
+        """
+        fname = self.__normalize(fname)
+        if self.__entries.pop(fname, None) is None:
+            return
+
+        self.__by_dir[self.__dir_of(fname)].discard(fname)
+        del self.__names[bisect.bisect_left(self.__names, fname)]
+
+    def list(self, prefix: str, after: str, limit: int) -> Tuple[List[Entry], bool]:
+        """
+        Get a page of the files with names starting with the prefix, in the order of their names.
+        :param prefix: '' for all the files.
+        :param after: Only the files with names after this one (the last name of the previous page), '' for the first
+        page.
+        :param limit: Max number of files of the page.
+        :return: (the files, whether there are more files after the page)
+        """
+        self.refresh()
+
+        start = bisect.bisect_left(self.__names, prefix)
+        if after:
+            start = max(start, bisect.bisect_right(self.__names, after))
+
+        page = []
+        for fname in self.__names[start:start + limit + 1]:
+            if not fname.startswith(prefix):
+                return page, False
+            if len(page) == limit:
+                return page, True
+            page.append((fname, *self.__entries[fname]))
+
+        return page, False
+
+    def __save(self):
+        """
+        Bring the directories up to date and write the snapshot.
+        """
+        self.__check_dirs()
+
+        journal = [os.fstat(self.__journal).st_ino, self.__journal_pos] if self.__journal is not None else [0, 0]
+        # each pre-forked worker saves its own catalog, they have all read the same journal
+        tmp = os.path.join(self.__data_folder, '%s.%d.catalog-tmp' % (self.SNAPSHOT_FNAME, os.getpid()))
+        with open(tmp, 'w') as f:
+            json.dump({
+                'journal': journal, 'dirs': self.__dirs,
+                'entries': {fname: [size, mtime_ns] for fname, (size, mtime_ns) in self.__entries.items()}
+            }, f)
+        os.replace(tmp, os.path.join(self.__data_folder, self.SNAPSHOT_FNAME))
+
+    def __check_dirs(self):
+        """
+        List again the directories changed since they were listed (a file added, removed or renamed changes the mtime
+        of its directory), and drop the files of the removed directories. An unchanged directory costs a stat.
+        """
+        added, removed = {}, set()
+        for rel_dir, mtime_ns in list(self.__dirs.items()):
+            try:
+                st = os.stat(os.path.join(self.__data_folder, rel_dir))
+            except OSError:
+                st = None
+
+            if st is None or not stat.S_ISDIR(st.st_mode):
+                self.__drop_dir(rel_dir, removed)  # its subdirectories are dropped as they are checked
+            elif st.st_mtime_ns != mtime_ns:
+                self.__list_dir(rel_dir, added, removed)
+
+        self.__discard_entries(removed)
+        self.__add_entries(added)
+
+    def __list_dir(self, rel_dir: str, added: Dict[str, Tuple[int, int]], removed: Set[str]):
+        """
+        List a directory: find its new files (and the files of its new subdirectories) and the removed ones.
+        :param added: The new files are collected here, to be added at once.
+        :param removed: The removed files are collected here, to be discarded at once.
+        """
+        path = os.path.join(self.__data_folder, rel_dir)
+        try:
+            # before the listing, a change made while listing is found on the next check
+            mtime_ns = os.stat(path).st_mtime_ns
+            with os.scandir(path) as it:
+                files, subdirs = [], []
+                for entry in it:
+                    fname = os.path.normpath(os.path.join(rel_dir, entry.name))
+                    if not entry.is_dir():
+                        files.append(fname)
+                    elif not entry.is_symlink() and not reserved.is_reserved(fname):
+                        subdirs.append(fname)
+        except OSError:
+            return self.__drop_dir(rel_dir, removed)  # removed meanwhile
+
+        self.__dirs[rel_dir] = mtime_ns if time.time_ns() - mtime_ns >= MTIME_SLACK else UNCHECKED
+
+        present = set(files)
+        listed = self.__by_dir.get(rel_dir, set())
+        removed.update(listed - present)
+        for fname in present - listed:
+            entry = self.__stat(fname)
+            if entry is not None:
+                added[fname] = entry
+
+        for subdir in subdirs:
+            if subdir not in self.__dirs:
+                self.__list_dir(subdir, added, removed)
+
+    def __drop_dir(self, rel_dir: str, removed: Set[str]):
+        """
+        Forget a removed directory, its files are collected to be discarded.
+        """
+        self.__dirs.pop(rel_dir, None)
+        removed.update(self.__by_dir.get(rel_dir, ()))
+
+    def __replay_journal(self, journal_ino: int, journal_pos: int):
+        """
+        Apply the uploads journaled after the snapshot was taken.
+        """
+        try:
+            fd = os.open(os.path.join(self.__data_folder, self.JOURNAL_FNAME), os.O_RDONLY)
+        except FileNotFoundError:
+            return
+
+        try:
+            # a journal started after the snapshot is replayed from its start
+            self.__apply_journal(fd, journal_pos if os.fstat(fd).st_ino == journal_ino else 0)
+        finally:
+            os.close(fd)
+
+    def __apply_journal(self, fd: int, pos: int) -> int:
+        """
+        Update the entries of the files journaled from the given position on.
+        :return: The position up to which the journal has been read.
+        """
+        data = os.pread(fd, max(0, os.fstat(fd).st_size - pos), pos)
+        # a line being appended by another worker is read next time
+        complete = data[:data.rfind(b'\n') + 1]
+        for line in complete.splitlines():
+            self.__refresh_entry(json.loads(line))
+
+        return pos + len(complete)
+
+    def __refresh_entry(self, fname: str) -> bool:
+        """
+        Stat a file and update its entry (add it, or drop it if it does not exist).
+        :return: Whether the file is listed.
+        """
+        entry = self.__stat(fname)
+        if entry is None:
+            self.discard(fname)
+            return False
+
+        if fname not in self.__entries:
+            bisect.insort(self.__names, fname)
+            self.__by_dir.setdefault(self.__dir_of(fname), set()).add(fname)
+        self.__entries[fname] = entry
+        return True
+
+    def __add_entries(self, entries: Dict[str, Tuple[int, int]]):
+        """
+        Add many new files at once (a single merge into the sorted names).
+        """
+        if not entries:
+            return
+
+        self.__entries.update(entries)
+        for fname in entries:
+            self.__by_dir.setdefault(self.__dir_of(fname), set()).add(fname)
+        self.__names.extend(sorted(entries))
+        self.__names.sort()  # two sorted runs, merged in linear time
+
+    def __discard_entries(self, fnames: Iterable[str]):
+        """
+        Remove many files at once (a single pass over the sorted names).
+        """
+        removed = {fname for fname in fnames if self.__entries.pop(fname, None) is not None}
+        if not removed:
+            return
+
+        for fname in removed:
+            fnames = self.__by_dir[self.__dir_of(fname)]
+            fnames.discard(fname)
+            if not fnames:
+                del self.__by_dir[self.__dir_of(fname)]
+        self.__names = [fname for fname in self.__names if fname not in removed]
+
+    def __stat(self, fname: str) -> Tuple[int, int] | None:
+        """
+        :return: (size, mtime_ns) of a listed file, None if the file is not listed or does not exist.
+        """
+        if not self.__is_listed(fname):
+            return None
+
+        try:
+            st = os.stat(os.path.join(self.__data_folder, fname))
+        except OSError:
+            return None
+
+        return st.st_size, st.st_mtime_ns
+
+    def __is_listed(self, fname: str) -> bool:
+        """
+        Whether a file is a file of the clients, not an internal file of the server (or outside the data folder).
+        """
+        if fname == os.pardir or fname.startswith(os.pardir + os.sep) or len(fname.encode()) > 255:
+            return False
+
+        return not reserved.is_reserved(fname)
+
+    @staticmethod
+    def __dir_of(fname: str) -> str:
+        return os.path.dirname(fname) or os.curdir
+
+    def __normalize(self, fname: str) -> str:
+        return os.path.relpath(os.path.abspath(os.path.join(self.__data_folder, fname)), self.__data_folder)
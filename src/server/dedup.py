@@ -0,0 +1,223 @@
+import hashlib
+import json
+import os
+import shutil
+from typing import Dict, Set, Tuple
+
+import reserved
+
+DIGEST_LEN = 32  # SHA-256
+
+# suffix of the temporary files the duplicates are created as, before they replace the target
+TMP_SUFFIX = '.dedup-tmp'
+
+
+def hash_file(path: str, chunk_len=1 << 20) -> bytes:
+    """
+    Get the SHA-256 of the content of a file.
+    :param path:
+    :param chunk_len:
+    :return:
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(chunk_len):
+            digest.update(chunk)
+
+    return digest.digest()
+
+
+def unshare(path: str, keep: int):
+    """
+    Give a file that is hard linked to a duplicate its own copy of the content, so writing into it does not
+    change the duplicate. Only the first `keep` bytes are copied, the rest is about to be overwritten anyway.
+    :param path:
+    :param keep:
+    :return:
+    """
+    if keep == 0:
+        os.unlink(path)
+        return
+
+    tmp = path + TMP_SUFFIX
+    with open(path, 'rb') as src, open(tmp, 'wb') as dst:
+        shutil.copyfileobj(src, dst, keep)
+        dst.truncate(keep)
+    os.replace(tmp, path)
+
+
+class HashIndex:
+    """
+    Index of the files of the data folder by the SHA-256 of their content, so content the server already has is
+    linked (or copied) server-side instead of being uploaded again.
+
+    An entry remembers the size and mtime of its file; a file that has changed since it was hashed is not used as
+    a source. The index is kept in memory and persisted into the data folder on `save`, so a restart only hashes
+    the files that have changed meanwhile.
+    """
+    INDEX_FNAME = reserved.HASH_INDEX_FNAME
+
+    def __init__(self, data_folder: str):
+        """
+        :param data_folder: Absolute path of the data folder.
+        """
+        self.__data_folder = data_folder
+        # __entries[fname] = (digest, size, mtime_ns) of the file (fname is relative to the data folder)
+        self.__entries: Dict[str, Tuple[bytes, int, int]] = {}
+        # __by_digest[digest] = fnames with the content
+        self.__by_digest: Dict[bytes, Set[str]] = {}
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def scan(self):
+        """
+        Index the files of the data folder, reusing the persisted digests of the files that have not changed.
+        :return:
+        """
+        persisted = self.__load()
+        self.__entries.clear()
+        self.__by_digest.clear()
+
+        for dirpath, dirnames, filenames in os.walk(self.__data_folder):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                fname = os.path.relpath(path, self.__data_folder)
+                if reserved.is_reserved(fname):
+                    continue
+
+                try:
+                    st = os.stat(path)
+                    entry = persisted.get(fname, None)
+                    if entry is not None and entry[1:] == (st.st_size, st.st_mtime_ns):
+                        digest = entry[0]
+                    else:
+                        digest = hash_file(path)
+                except OSError:
+                    continue  # removed meanwhile
+
+                self.__put(fname, (digest, st.st_size, st.st_mtime_ns))
+
+    def save(self):
+        """
+        Persist the index into the data folder.
+        :return:
+        """
+        # each pre-forked worker saves its own index, the last one wins
+        os.makedirs(os.path.join(self.__data_folder, reserved.STATE_FOLDER), exist_ok=True)
+        tmp = os.path.join(self.__data_folder, '%s.%d%s' % (self.INDEX_FNAME, os.getpid(), TMP_SUFFIX))
+        with open(tmp, 'w') as f:
+            json.dump({
+                fname: [digest.hex(), size, mtime_ns] for fname, (digest, size, mtime_ns) in self.__entries.items()
+            }, f)
+        os.replace(tmp, os.path.join(self.__data_folder, self.INDEX_FNAME))
+
+    def lookup(self, digest: bytes, size: int) -> str | None:
+        """
+        Find a file with the given content.
+        :param digest:
+        :param size:
+        :return: Absolute path of the file, None if there is no (unchanged) file with the content.
+        """
+        for fname in list(self.__by_digest.get(digest, ())):
+            entry = self.__entries[fname]
+            if entry[1] != size:
+                continue
+
+            path = self.__get_path(fname)
+            try:
+                st = os.stat(path)
+            except OSError:
+                st = None
+
+            if st is None or (st.st_size, st.st_mtime_ns) != entry[1:]:
+                self.discard(fname)  # changed behind the index' back
+                continue
+
+            return path
+
+        return None
+
+    def add(self, fname: str, digest: bytes, hashed: os.stat_result | None = None):
+        """
+        Index a file of the data folder with the given content.
+        :param fname: Path of the file, relative to the data folder.
+        :param digest:
+        :param hashed: Status of the file when it was hashed, the file is not indexed if it has changed since.
+        :return:
+        """
+        fname = self.__normalize(fname)
+        try:
+            st = os.stat(self.__get_path(fname))
+        except OSError:
+            return self.discard(fname)
+
+        if hashed is not None and (hashed.st_size, hashed.st_mtime_ns) != (st.st_size, st.st_mtime_ns):
+            return self.discard(fname)
+
+        self.__put(fname, (digest, st.st_size, st.st_mtime_ns))
+
+    def discard(self, fname: str):
+        """
+        Remove a file from the index, its content is about to change.
+        :param fname: Path of the file, relative to the data folder.
+        :return:
+        """
+        fname = self.__normalize(fname)
+        entry = self.__entries.pop(fname, None)
+        if entry is None:
+            return
+
+        fnames = self.__by_digest[entry[0]]
+        fnames.discard(fname)
+        if not fnames:
+            del self.__by_digest[entry[0]]
+
+    @staticmethod
+    def materialize(source: str, path: str):
+        """
+        Make the file at `path` a duplicate of the `source` file: a hard link if the filesystem allows it, a copy
+        otherwise. The file is replaced atomically, it never has partial content.
+        :param source: Absolute path of the source file.
+        :param path: Absolute path of the duplicate.
+        :return:
+        """
+        if os.path.exists(path) and os.path.samefile(source, path):
+            return
+
+        tmp = path + TMP_SUFFIX
+        try:
+            os.unlink(tmp)
+        except FileNotFoundError:
+            pass
+
+        try:
+            os.link(source, tmp)
+        except OSError:
+            # a different device, too many links, a filesystem without hard links...
+            shutil.copyfile(source, tmp)
+        os.replace(tmp, path)
+
+    def __put(self, fname: str, entry: Tuple[bytes, int, int]):
+        self.discard(fname)
+        self.__entries[fname] = entry
+        self.__by_digest.setdefault(entry[0], set()).add(fname)
+
+    def __load(self) -> Dict[str, Tuple[bytes, int, int]]:
+        """
+        Load the persisted index, an empty one if it is missing or broken.
+        """
+        try:
+            with open(os.path.join(self.__data_folder, self.INDEX_FNAME)) as f:
+                return {
+                    fname: (bytes.fromhex(digest), size, mtime_ns)
+                    for fname, (digest, size, mtime_ns) in json.load(f).items()
+                }
+        except (OSError, ValueError, TypeError):
+            return {}
+
+    def __normalize(self, fname: str) -> str:
+        return os.path.relpath(self.__get_path(fname), self.__data_folder)
+
+    def __get_path(self, fname: str) -> str:
+        return os.path.abspath(os.path.join(self.__data_folder, fname))
@@ -0,0 +1,113 @@
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Deque, Dict, Hashable, Tuple
+from socket_server import SocketServer
+
+# a job: (function, arguments, callback(result, error))
+Job = Tuple[Callable, tuple, Callable[[Any, BaseException | None], None] | None]
+
+
+class DiskExecutor:
+    """
+    Runs disk operations (open/read/write/close...) on a thread pool, so a slow disk does not block the network
+    I/O of the event loop. The results are delivered back to the event loop through a wakeup pipe polled by
+    the socket server, so the callbacks run on the event loop thread.
+
+    Jobs submitted with the same key (e.g. the same transfer) run one after another in the order of submission,
+    and their callbacks are called in the same order. Jobs with different keys run in parallel.
+    """
+
+    def __init__(self, socket_server: SocketServer, threads=4):
+        """
+        :param socket_server: The socket server whose event loop runs the callbacks.
+        :param threads: Number of threads doing the disk I/O.
+        """
+        self.__socket_server = socket_server
+        self.__pool = ThreadPoolExecutor(threads, thread_name_prefix='disk-io')
+
+        # __queues[key] = jobs of the key that have not completed yet, the first one is running
+        self.__queues: Dict[Hashable, Deque[Job]] = {}
+        self.__lock = threading.Lock()
+        # (callback, result, error) of the completed jobs, waiting to be delivered on the event loop
+        self.__done: Deque[tuple] = deque()
+
+        self.__wakeup_r, self.__wakeup_w = os.pipe()
+        os.set_blocking(self.__wakeup_r, False)
+        os.set_blocking(self.__wakeup_w, False)
+        self.__socket_server.add_reader(self.__wakeup_r, self.__on_wakeup)
+
+    def submit(self, key: Hashable, fn: Callable, *args, callback: Callable[[Any, BaseException | None], None] = None):
+        """
+        Run `fn(*args)` on the thread pool, after all the jobs previously submitted with the same key.
+        :param key: Jobs with the same key are ordered.
+        :param fn:
+        :param args:
+        :param callback: Called on the event loop with (result, error) once `fn` has completed (error is None on
+        success).
+        :return:
+        """
+        job = (fn, args, callback)
+        with self.__lock:
+            queue = self.__queues.setdefault(key, deque())
+            queue.append(job)
+            if len(queue) > 1:
+                return  # started once the previous jobs of the key complete
+
+        self.__pool.submit(self.__run, key, job)
+
+    def close(self):
+        """
+        Wait for the submitted jobs and stop the threads.
+        :return:
+        """
+        self.__pool.shutdown(wait=True)
+        self.__socket_server.remove_reader(self.__wakeup_r)
+        os.close(self.__wakeup_r)
+        os.close(self.__wakeup_w)
+
+    def __run(self, key: Hashable, job: Job):
+        """
+        Run a job (on a pool thread) and start the next job of the key.
+        :param key:
+        :param job:
+        :return:
+        """
+        fn, args, callback = job
+        try:
+            result, error = fn(*args), None
+        except BaseException as e:
+            result, error = None, e
+
+        with self.__lock:
+            # append under the lock, so the callbacks of a key are delivered in the order of its jobs
+            self.__done.append((callback, result, error))
+
+            queue = self.__queues[key]
+            queue.popleft()
+            if queue:
+                self.__pool.submit(self.__run, key, queue[0])
+            else:
+                del self.__queues[key]
+
+        try:
+            os.write(self.__wakeup_w, b'\0')
+        except BlockingIOError:
+            pass  # the pipe is full, the event loop is going to wake up anyway
+
+    def __on_wakeup(self):
+        """
+        The wakeup pipe is readable, deliver the results of the completed jobs.
+        :return:
+        """
+        try:
+            while os.read(self.__wakeup_r, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+        while self.__done:
+            callback, result, error = self.__done.popleft()
+            if callback is not None:
+                callback(result, error)
@@ -0,0 +1,133 @@
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, Tuple, TypedDict
+
+# (inode, size, mtime_ns) of a file, a cached file is valid while it is the same
+Signature = Tuple[int, int, int]
+
+
+class CacheStats(TypedDict):
+    """
+    Counters of a file cache.
+    Attributes:
+        hits: Number of downloads served from the cache.
+        misses: Number of downloads of small enough files that have been read from the disk.
+        bypassed: Number of downloads of files too large to be cached.
+        evictions: Number of files dropped to stay within the budget.
+        invalidations: Number of files dropped because they have been overwritten.
+        files: Number of cached files.
+        bytes: Total size of the cached files.
+        max_bytes: The budget.
+    """
+    hits: int
+    misses: int
+    bypassed: int
+    evictions: int
+    invalidations: int
+    files: int
+    bytes: int
+    max_bytes: int
+
+
+class FileCache:
+    """
+    Keeps the content of small downloaded files in memory, the least recently used files are evicted once their
+    total size exceeds the budget. A cached file is served after a single stat (no open/read/close), as long as its
+    inode, size and mtime have not changed. Files overwritten by the server are dropped right away.
+    Safe to use from the disk executor's threads.
+    """
+
+    def __init__(self, max_bytes: int, max_file_len=1 << 20):
+        """
+        :param max_bytes: Budget of the cached content.
+        :param max_file_len: Only the files up to this size are cached.
+        """
+        self.__max_bytes = max_bytes
+        self.__max_file_len = min(max_file_len, max_bytes)
+        # __entries[path] = (signature, content), the least recently used first
+        self.__entries: OrderedDict[str, Tuple[Signature, bytes]] = OrderedDict()
+        self.__bytes = 0
+        self.__lock = threading.Lock()
+        self.__counters: Dict[str, int] = {
+            'hits': 0, 'misses': 0, 'bypassed': 0, 'evictions': 0, 'invalidations': 0
+        }
+
+    def load(self, path: str) -> bytes | None:
+        """
+        Get the content of a file, from the cache if it is there (and still valid), from the disk otherwise.
+        :param path: Absolute path of the file.
+        :return: The content, None if the file is too large to be cached (it is not read then).
+        :raise OSError: If the file can not be read (e.g. it does not exist).
+        """
+        signature = self.__signature(os.stat(path))
+        with self.__lock:
+            entry = self.__entries.get(path, None)
+            if entry is not None and entry[0] == signature:
+                self.__entries.move_to_end(path)
+                self.__counters['hits'] += 1
+                return entry[1]
+
+        if signature[1] > self.__max_file_len:
+            with self.__lock:
+                self.__counters['bypassed'] += 1
+            return None
+
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            signature = self.__signature(os.fstat(fd))
+            if signature[1] > self.__max_file_len:
+                with self.__lock:
+                    self.__counters['bypassed'] += 1
+                return None
+
+            data = os.pread(fd, signature[1], 0)
+            # a file written meanwhile is served as it has been read, but not cached
+            cacheable = len(data) == signature[1] and self.__signature(os.fstat(fd)) == signature
+        finally:
+            os.close(fd)
+
+        with self.__lock:
+            self.__counters['misses'] += 1
+            if cacheable:
+                self.__put(path, signature, data)
+
+        return data
+
+    def invalidate(self, path: str):
+        """
+        Drop a file from the cache, it is being overwritten.
+        :param path: Absolute path of the file.
+        :return:
+        """
+        with self.__lock:
+            entry = self.__entries.pop(path, None)
+            if entry is not None:
+                self.__bytes -= len(entry[1])
+                self.__counters['invalidations'] += 1
+
+    def stats(self) -> CacheStats:
+        with self.__lock:
+            return {
+                **self.__counters, 'files': len(self.__entries), 'bytes': self.__bytes, 'max_bytes': self.__max_bytes
+            }
+
+    def __put(self, path: str, signature: Signature, data: bytes):
+        """
+        Cache the content of a file and evict the least recently used files over the budget (under the lock).
+        """
+        old = self.__entries.pop(path, None)
+        if old is not None:
+            self.__bytes -= len(old[1])
+
+        self.__entries[path] = (signature, data)
+        self.__bytes += len(data)
+
+        while self.__bytes > self.__max_bytes:
+            _, (_, evicted) = self.__entries.popitem(last=False)
+            self.__bytes -= len(evicted)
+            self.__counters['evictions'] += 1
+
+    @staticmethod
+    def __signature(st: os.stat_result) -> Signature:
+        return st.st_ino, st.st_size, st.st_mtime_ns
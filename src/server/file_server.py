@@ -1,45 +1,204 @@
+import errno
 import socket
 import os
+import stat
+import hashlib
+import json
+import time
+import helpers
+import zero_copy
+import compression
+import dedup
+import delta
+import reserved
+from adaptive import AdaptiveSize
+from collections import deque
 from socket_server import SocketServer
-from typing import Literal, Dict, TypedDict
+from disk_io import DiskExecutor
+from zero_copy import SpliceSink
+from compression import Compressor, Decompressor
+from dedup import HashIndex
+from file_cache import FileCache
+from mmap_pool import MappingPool, SharedMapping
+from catalog import Catalog
+from stats import TransferStats, ActiveTransfer
+import log
+from log import logger
+from delta import Decoder
+from typing import Any, Literal, Dict, Deque, List, Tuple, TypedDict
 
 # directory of this file
 ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
 
+# max number of files in a bundle ('M', 'G' actions)
+MAX_BUNDLE_FILES = 1 << 16
+
+# max number of files in a page of a listing ('L' action)
+MAX_LIST_LIMIT = 10000
+
+
+class BundleState(TypedDict):
+    """
+    Represents the state of a bundle of files ('M', 'G' actions).
+    Attributes:
+        count: Number of files in the bundle, None until read.
+        done: Number of files received (uploads) or sent (downloads) so far.
+        names: The files of the bundle (the requested files of a download).
+        results: The error of each uploaded file, None if it has been stored.
+    """
+    count: int | None
+    done: int
+    names: List[str]
+    results: List[str | None]
+
+
+class ListingState(TypedDict):
+    """
+    Represents a listing request ('L' action), the fields are None until read.
+    Attributes:
+        prefix_len: Length of the prefix.
+        prefix: Only the files with names starting with the prefix are listed.
+        after_len: Length of the name the page starts after.
+        after: The page starts after this name (the last name of the previous page), '' for the first page.
+        limit: Max number of files of the page.
+    """
+    prefix_len: int | None
+    prefix: str | None
+    after_len: int | None
+    after: str | None
+    limit: int | None
+
 
 class TransferState(TypedDict):
     """
     Represents the state of a file transfer.
     Attributes:
-        action: 'U' - client is sending (Uploading) a file, 'D' - client is receiving (Downloading) a file
-        fname: The name of the file.
+        action: 'U' - client is sending (Uploading) a file, 'D' - client is receiving (Downloading) a file,
+            'R' - client is Resuming an upload from an offset, 'O' - client is downloading a file from an Offset,
+            'P' - client is downloading a Part (byte range) of a file, 'S' - client is asking for the State (size)
+            of a file, 'C' - client is requesting a Compressed upload/download (replaced by 'U'/'D' once read),
+            'H' - client is uploading a file with a known Hash, the server may already have its content,
+            'B' - client is uploading the changed Blocks of a file the server holds an older version of (delta),
+            'M' - client is uploading Many files in a bundle, 'G' - client is Getting (downloading) many files in
+            a bundle, 'L' - client is Listing the files, 'T' - client is asking for the sTats of the server
+        fname: The name of the file (the current file of a bundle).
         fname_len: The length of the filename (as reported by the client).
+        requested: Whether the whole request has been received (the header of the current file of a bundle upload).
         confirmed: Whether the action for the file has been confirmed by the server.
         fsize: The size of the file.
-        fpos: The current position in the file.
+        offset: The offset to resume the transfer from ('R', 'O' actions), or the start of the range ('P' action).
+        length: The length of the range ('P' action).
+        verify_len: Number of bytes of the file to hash ('S' action), 0 if the hash is not requested.
+        digest: SHA-256 of the uploaded file as reported by the client ('H' action).
+        hasher: Hashes the uploaded file as it is written, to check the reported digest ('H', 'B' actions).
+        basis: The server's version of a file uploaded as a delta, if it has one ('B' action).
+        delta: Parses the delta of the uploaded file ('B' action).
+        bundle: The files of a bundle ('M', 'G' actions).
+        listing: The listing request ('L' action).
+        started: time.monotonic() of the request.
+        header_buffer: Received bytes of an incomplete field of the request.
+        codec: Compression codec requested by the client (see `compression.CODECS`), 0 if not compressed, None
+            until read.
+        compressor: Compresses a downloaded file, None if the file is not worth compressing.
+        decompressor: Decompresses an uploaded file.
+        fpos: The current position in the file (bytes written for uploads, bytes queued for downloads).
+        fd: The opened file, if any (the file being rebuilt for the 'B' action).
+        content: Content of a downloaded file in memory (from the file cache, or a mapping of the file), the file
+            is not opened then.
+        mapping: The shared mapping of a downloaded file, released once the download ends ('mmap' download mode).
+        sink: Moves the rest of an uploaded file from the socket to the file in the kernel, if used.
+        window: Number of bytes of a downloaded file queued per writable event.
+        in_flight: Bytes handed to the disk executor that have not been written/sent yet (disk executor only).
+        ahead: Parts of a downloaded file read ahead by the disk executor, waiting to be sent, as (number of bytes of
+            the file, data to send) (disk executor only).
+        reading: Whether a read of a downloaded file is in progress (disk executor only).
+        drained: Whether the client has received all the parts sent so far (disk executor only).
     """
-    action: Literal['U', 'D']
+    action: Literal['U', 'D', 'R', 'O', 'P', 'S', 'C', 'H', 'B', 'M', 'G', 'L', 'T']
     fname: str
     fname_len: int
+    requested: bool
     confirmed: bool
     fsize: int
     fsize_buffer: bytearray
+    offset: int | None
+    length: int | None
+    verify_len: int | None
+    digest: bytes | None
+    hasher: Any
+    basis: int | None
+    delta: Decoder | None
+    bundle: BundleState | None
+    listing: ListingState | None
+    started: float
+    header_buffer: bytearray
+    codec: int | None
+    compressor: Compressor | None
+    decompressor: Decompressor | None
     fpos: int
     fd: int | None
+    content: bytes | memoryview | None
+    mapping: SharedMapping | None
+    sink: SpliceSink | None
+    window: AdaptiveSize
+    in_flight: int
+    ahead: Deque[Tuple[int, bytes]]
+    reading: bool
+    drained: bool
 
 
 class FileServer:
-    def __init__(self, socket_server: SocketServer, data_folder: str, byteorder="little"):
+    def __init__(self, socket_server: SocketServer, data_folder: str, byteorder="little", download_window=65536,
+                 splice_min_len=65536, max_download_window=None, disk: DiskExecutor | None = None,
+                 max_in_flight=4 << 20, dedup_index: HashIndex | None = None, cache: FileCache | None = None,
+                 download_mode: Literal['sendfile', 'mmap'] = 'sendfile', catalog: Catalog | None = None):
+        """
+        :param socket_server:
+        :param data_folder: Folder (relative to this file) where the files are stored.
+        :param byteorder:
+        :param download_window: Number of bytes of a downloaded file queued per writable event at the start of
+        a download, so that a large download does not monopolize the event loop.
+        :param max_download_window: The window grows up to this size while the client's socket accepts whole
+        windows at once. Defaults to `download_window`.
+        :param splice_min_len: Uploads with at least this many bytes remaining after the header are moved to the file
+        with splice (where available), 0 to disable.
+        :param disk: Run the disk I/O (opens, reads, writes, closes) on this executor instead of the event loop.
+        Both sendfile and splice are disabled then, since they block the loop on a slow disk as well.
+        :param max_in_flight: Max number of bytes of a transfer waiting in memory for the disk executor, reading from
+        an uploading client is paused above it.
+        :param dedup_index: Index of the content of the data folder, a file uploaded with its hash ('H' action) is
+        linked/copied from a file with the same content instead of being transferred. The other received files are
+        hashed once complete, to be sources too. Deduplication is disabled if None.
+        :param cache: Serve the (uncompressed) downloads of small files from memory.
+        :param download_mode: How the (uncompressed) downloads are sent: 'sendfile' - from the page cache by sendfile
+        (by pread on the disk executor, if used), 'mmap' - slices of a memory mapping of the file, shared by the
+        concurrent downloads of the file.
+        :param catalog: Catalog of the data folder, updated as the uploads complete and used to list the files ('L'
+        action). Listing is disabled if None.
+        """
         self.__socket_server = socket_server
         self.__data_folder = os.path.abspath(os.path.join(ROOT_DIR, data_folder))
         self.__byteorder = byteorder
+        self.__download_window = download_window
+        self.__max_download_window = max_download_window or download_window
+        self.__splice_min_len = splice_min_len
+        self.__disk = disk
+        self.__max_in_flight = max_in_flight
+        self.__dedup_index = dedup_index
+        self.__cache = cache
+        self.__mappings = MappingPool() if download_mode == 'mmap' else None
+        self.__catalog = catalog
+        self.__stats = TransferStats()
 
         self.__socket_server.on("data", self.__on_data)
         self.__socket_server.on("connect", self.__on_connect)
         self.__socket_server.on("disconnect", self.__on_disconnect)
+        self.__socket_server.on("drain", self.__on_drain)
 
         # __transfers[port] = state of the file transfer for the client at port
         self.__transfers: Dict[int, TransferState] = {}
+        # __pending[port] = data of the next request(s) received during the client's current transfer
+        self.__pending: Dict[int, bytes] = {}
 
     # region File server methods
 
@@ -57,8 +216,11 @@ class FileServer:
         :param fd: The client socket to disconnect.
         :return:
         """
-        addr, port = fd.getpeername()
-        print("[%d] disconnecting by server..." % port)
+        addr, port = self.__socket_server.getpeername(fd)
+        logger.debug("[%d] disconnecting by server...", port)
+        # no disconnect event follows a disconnect by the server, forget the client's state right away
+        self.__end_transfer(port)
+        self.__pending.pop(port, None)
         self.__socket_server.disconnect(fd)
 
     # endregion
@@ -66,7 +228,7 @@ class FileServer:
     # region Socket event handlers
 
     def __on_connect(self, addr):
-        print("[%d] connected" % (addr[1]))
+        logger.debug("[%d] connected", addr[1])
 
     def __on_disconnect(self, addr):
         """
@@ -76,151 +238,1111 @@ class FileServer:
         """
         addr, port = addr
         self.__end_transfer(port)
-        print("[%d] disconnected" % port)
+        self.__pending.pop(port, None)
+        logger.debug("[%d] disconnected", port)
 
-    def __on_data(self, fd: socket.socket, data: bytes):
-        arr = bytearray(data)
-        addr, port = fd.getpeername()
+    def __on_data(self, fd: socket.socket, data: memoryview):
+        self.__process_requests(fd, helpers.ViewReader(data))
 
-        active_transfer = self.__transfers.get(port, None)
-        if active_transfer is None:
-            # client has no active transfer
-            action = chr(data[0])
-            del arr[:1]
-
-            active_transfer = self.__prepare_transfer(port, action)
+    def __on_drain(self, fd: socket.socket):
+        """
+        The client has received everything queued so far, continue its download (if any).
+        :param fd:
+        :return:
+        """
+        addr, port = self.__socket_server.getpeername(fd)
+        transfer = self.__transfers.get(port, None)
+        if transfer is not None and transfer['action'] == 'G' and transfer['requested']:
+            return self.__send_bundle_window(fd, transfer)
 
-            if action == 'U':
-                print('[%d] -> requesting to upload a file...' % port)
-            elif action == 'D':
-                print('[%d] -> requesting to download a file...' % port)
-            else:
-                # user sent an unexpected action, disconnect them
-                print('[%d] unexpected action "%s"!' % (port, action))
-                return self.disconnect(fd)
+        if transfer is None or transfer['action'] not in ('D', 'O', 'P') \
+                or (transfer['fd'] is None and transfer['content'] is None):
+            return
 
-        # continue client's transfer...
-        if active_transfer['action'] == 'U':
-            self.__process_upload(fd, arr)
+        if self.__disk:
+            transfer['drained'] = True
+            return self.__pump_download(fd, transfer)
 
-        elif active_transfer['action'] == 'D':
-            self.__process_download(fd, arr)
+        self.__send_file_window(fd, transfer)
 
     # endregion
 
     # region Transfer processing
 
-    def __process_upload(self, fd: socket.socket, data: bytes):
-        if len(data) <= 0:
+    def __process_requests(self, fd: socket.socket, reader: helpers.ViewReader):
+        """
+        Process the received data, it can contain the end of a request and the start of the next one(s), since
+        a client may pipeline its requests over a single connection.
+        :param fd:
+        :param reader: reader of the received data
+        :return:
+        """
+        addr, port = self.__socket_server.getpeername(fd)
+
+        while len(reader) > 0 and self.__socket_server.is_open(fd):
+            active_transfer = self.__transfers.get(port, None)
+
+            if active_transfer is not None and not self.__accepts_data(active_transfer):
+                # the client has sent its next request already, process it once the current transfer is done
+                self.__pending[port] = self.__pending.get(port, b'') + bytes(reader.read(len(reader)))
+                self.__socket_server.pause_reading(fd)
+                return
+
+            if active_transfer is None:
+                # client has no active transfer
+                action = chr(reader.read(1)[0])
+
+                active_transfer = self.__prepare_transfer(port, action)
+
+                if action == 'U':
+                    logger.debug('[%d] -> requesting to upload a file...', port)
+                elif action == 'D':
+                    logger.debug('[%d] -> requesting to download a file...', port)
+                elif action == 'R':
+                    logger.debug('[%d] -> requesting to resume an upload...', port)
+                elif action == 'O':
+                    logger.debug('[%d] -> requesting to download a file from an offset...', port)
+                elif action == 'P':
+                    logger.debug('[%d] -> requesting to download a part of a file...', port)
+                elif action == 'S':
+                    logger.debug('[%d] -> requesting the state of a file...', port)
+                elif action == 'C':
+                    logger.debug('[%d] -> requesting a compressed transfer...', port)
+                elif action == 'H':
+                    logger.debug('[%d] -> requesting to upload a file with a known hash...', port)
+                elif action == 'B':
+                    logger.debug('[%d] -> requesting to upload the changed blocks of a file...', port)
+                elif action == 'M':
+                    logger.debug('[%d] -> requesting to upload a bundle of files...', port)
+                elif action == 'G':
+                    logger.debug('[%d] -> requesting to download a bundle of files...', port)
+                elif action == 'L':
+                    logger.debug('[%d] -> requesting to list the files...', port)
+                elif action == 'T':
+                    logger.debug('[%d] -> requesting the stats of the server...', port)
+                else:
+                    # user sent an unexpected action, disconnect them
+                    logger.warning('[%d] unexpected action "%s"!', port, action)
+                    self.__end_transfer(port)
+                    return self.disconnect(fd)
+
+            # continue client's transfer...
+            if active_transfer['action'] in ('U', 'R', 'H'):
+                self.__process_upload(fd, reader)
+
+            elif active_transfer['action'] in ('D', 'O', 'P'):
+                self.__process_download(fd, reader)
+
+            elif active_transfer['action'] == 'S':
+                self.__process_stat(fd, reader)
+
+            elif active_transfer['action'] == 'C':
+                self.__process_compressed(fd, reader)
+
+            elif active_transfer['action'] == 'B':
+                self.__process_delta(fd, reader)
+
+            elif active_transfer['action'] == 'M':
+                self.__process_bundle_upload(fd, reader)
+
+            elif active_transfer['action'] == 'G':
+                self.__process_bundle_download(fd, reader)
+
+            elif active_transfer['action'] == 'L':
+                self.__process_listing(fd, reader)
+
+            elif active_transfer['action'] == 'T':
+                self.__process_stats(fd)
+
+    @staticmethod
+    def __accepts_data(transfer: TransferState) -> bool:
+        """
+        Whether the transfer still expects data from the client. Data received after that belongs to the next
+        request of the client.
+        """
+        if transfer['action'] in ('U', 'R', 'H'):
+            if not transfer['requested']:
+                return True
+
+            # nothing is expected while the server is deciding whether it has the content already ('H' action)
+            return transfer['confirmed'] and (
+                transfer['fpos'] < transfer['fsize'] or not FileServer.__received_all(transfer)
+            )
+
+        if transfer['action'] == 'B':
+            return not transfer['requested'] or (transfer['confirmed'] and not transfer['delta'].done)
+
+        if transfer['action'] == 'M':
+            return transfer['bundle']['count'] is None or transfer['bundle']['done'] < transfer['bundle']['count']
+
+        if transfer['action'] == 'C':
+            return True
+
+        # downloads and stats only read their request
+        return not transfer['requested']
+
+    @staticmethod
+    def __received_all(transfer: TransferState) -> bool:
+        """
+        Whether the whole (compressed) stream of an uploaded file has been received.
+        """
+        return transfer['decompressor'] is None or transfer['decompressor'].eof
+
+    def __process_compressed(self, fd: socket.socket, reader: helpers.ViewReader):
+        """
+        Read the codec and the action of a compressed transfer, the transfer continues as the read action.
+        :param fd:
+        :param reader: reader of the received data
+        :return:
+        """
+        addr, port = self.__socket_server.getpeername(fd)
+        transfer = self.__transfers[port]
+
+        if transfer['codec'] is None:
+            transfer['codec'] = self.__read_uint(transfer, reader, 1)
+            if transfer['codec'] is None:
+                return  # the codec is not complete yet
+
+        if len(reader) <= 0:
+            return  # the action is not complete yet
+
+        action = chr(reader.read(1)[0])
+        if transfer['codec'] not in compression.CODECS or action not in ('U', 'D'):
+            logger.warning('[%d] unexpected compressed action "%s" (codec %d)!', port, action, transfer['codec'])
+            self.__send_confirmation(fd, False, "Unsupported compression!")
+            self.__end_transfer(port)
+            return self.disconnect(fd)
+
+        transfer['action'] = action
+        logger.debug('[%d] -> requesting to %s a file (%s)...',
+                     port, 'upload' if action == 'U' else 'download', compression.CODECS[transfer['codec']])
+
+        if action == 'U':
+            transfer['decompressor'] = Decompressor(transfer['codec'])
+
+    def __process_upload(self, fd: socket.socket, reader: helpers.ViewReader):
+        if len(reader) <= 0:
             return
 
-        buffer = bytearray(data)
-        addr, port = fd.getpeername()
+        addr, port = self.__socket_server.getpeername(fd)
         transfer = self.__transfers[port]
 
-        if self.__read_filename(transfer, buffer) > 0:
+        if self.__read_filename(fd, transfer, reader) > 0:
             return  # the filename is not complete yet
 
-        if self.__read_fsize(transfer, buffer) > 0:
+        if self.__read_fsize(transfer, reader) > 0:
             return  # the fsize is not complete yet
 
-        if not transfer['confirmed']:
-            print('[%d] -> file is "%s" with size (%dB)' % (port, transfer['fname'], transfer['fsize']))
+        if transfer['action'] == 'R' and not self.__read_offset(transfer, reader):
+            return  # the offset is not complete yet
+
+        if transfer['action'] == 'H' and transfer['digest'] is None:
+            transfer['digest'] = self.__read_bytes(transfer, reader, dedup.DIGEST_LEN)
+            if transfer['digest'] is None:
+                return  # the digest is not complete yet
+
+        if not transfer['requested']:
+            transfer['requested'] = True
+            logger.debug('[%d] -> file is "%s" with size (%dB)', port, transfer['fname'], transfer['fsize'])
 
             # check the reported file size
             if not 0 < transfer['fsize'] < 2 ** 64:
                 self.__send_confirmation(fd, False, "Invalid file size!")
                 return self.disconnect(fd)
 
+            if transfer['action'] == 'R':
+                # the upload can only continue right after the bytes the server holds
+                logger.debug('[%d] -> resuming from %dB', port, transfer['offset'])
+                if not transfer['offset'] <= min(transfer['fsize'], self.__get_file_size(transfer)):
+                    self.__send_confirmation(fd, False, "Invalid offset!")
+                    return self.disconnect(fd)
+
+                transfer['fpos'] = transfer['offset']
+
             # check other stuff...
 
+            if transfer['action'] == 'H':
+                transfer['hasher'] = hashlib.sha256()
+                if self.__deduplicate(fd, port, transfer):
+                    return  # the server has the content, or is finding out (see `__on_deduplicated`)
+
             # requested file is valid, send a confirmation
-            self.__send_confirmation(fd, True)
-            transfer['confirmed'] = True
+            self.__confirm_upload(fd, port, transfer)
+
+        if not transfer['confirmed']:
+            return  # waiting for the deduplication
 
-            print("[%d] -> sending file (%dB)..." % (port, transfer['fsize']))
+        if transfer['decompressor'] is not None:
+            return self.__inflate_upload(fd, transfer, reader)
+
+        if self.__disk:
+            return self.__write_file_async(fd, transfer, reader)
 
         # read the file from the client
-        if self.__read_file(transfer, buffer) > 0:
+        diff = self.__read_file(transfer, reader)
+        if diff > 0:
+            if transfer['sink'] is None and transfer['hasher'] is None \
+                    and 0 < self.__splice_min_len <= diff and zero_copy.splice_available:
+                # move the rest of the file in the kernel, it does not go through the data event anymore
+                transfer['sink'] = SpliceSink(transfer['fd'], transfer['fpos'], diff)
+                self.__socket_server.set_read_handler(fd, self.__on_splice)
+            return  # the file is not complete yet
+
+        self.__finish_upload(fd, transfer)
+
+    def __confirm_upload(self, fd: socket.socket, port: int, transfer: TransferState):
+        """
+        Ask the client for the content of the uploaded file and open the file.
+        :param fd:
+        :param port:
+        :param transfer:
+        :return:
+        """
+        if self.__dedup_index is not None:
+            self.__dedup_index.discard(transfer['fname'])  # the content of the file is about to change
+        self.__invalidate_cache(transfer)
+
+        self.__send_confirmation(fd, True)
+        transfer['confirmed'] = True
+
+        logger.debug("[%d] -> sending file (%dB)...", port, transfer['fsize'] - transfer['fpos'])
+
+        if self.__disk:
+            self.__disk.submit(
+                port, self.__open_upload, transfer, transfer['fpos'],
+                callback=lambda result, error: self.__on_disk_error(fd, port, transfer, error)
+            )
+            if transfer['fpos'] == transfer['fsize']:
+                self.__finish_upload_async(fd, port, transfer)
+
+    def __deduplicate(self, fd: socket.socket, port: int, transfer: TransferState) -> bool:
+        """
+        Create the uploaded file from a file with the same content, if the server has one.
+        :param fd:
+        :param port:
+        :param transfer:
+        :return: Whether a file with the same content has been found, the upload is finished by
+        `__on_deduplicated` then.
+        """
+        if self.__dedup_index is None:
+            return False
+
+        source = self.__dedup_index.lookup(transfer['digest'], transfer['fsize'])
+        if source is None:
+            return False
+
+        logger.debug('[%d] -> content is the same as: %s', port, source)
+        path = self.__get_file_path(transfer)
+
+        if self.__disk:
+            # copying the file (if it can not be linked) would block the event loop for long
+            self.__socket_server.pause_reading(fd)
+            self.__disk.submit(
+                port, HashIndex.materialize, source, path,
+                callback=lambda result, error: self.__on_deduplicated(fd, port, transfer, error)
+            )
+            return True
+
+        try:
+            HashIndex.materialize(source, path)
+            error = None
+        except OSError as e:
+            error = e
+
+        self.__on_deduplicated(fd, port, transfer, error)
+        return True
+
+    def __on_deduplicated(self, fd: socket.socket, port: int, transfer: TransferState, error: BaseException | None):
+        """
+        The uploaded file has been linked/copied from a file with the same content: the client does not send the
+        content then. If that has failed, the file is uploaded as usual.
+        """
+        if not self.__is_active(port, transfer):
+            return
+
+        if error is not None:
+            logger.warning("[%d] could not deduplicate the file: %s", port, error)
+            self.__confirm_upload(fd, port, transfer)
+            # the data received meanwhile (if any) is the content of the file
+            return self.__resume_requests(fd, port)
+
+        self.__dedup_index.add(transfer['fname'], transfer['digest'])
+        self.__invalidate_cache(transfer)
+        self.__update_catalog(transfer['fname'])
+        logger.debug("[%d] -> file has been deduplicated: %s", port, self.__get_file_path(transfer))
+        self.__send_duplicate_confirmation(fd)
+        self.__complete_transfer(fd, port)
+
+    def __inflate_upload(self, fd: socket.socket, transfer: TransferState, reader: helpers.ViewReader):
+        """
+        Decompress the received part of a compressed upload and write it to the file.
+        :param fd:
+        :param transfer:
+        :param reader: reader of the received data
+        :return:
+        """
+        addr, port = self.__socket_server.getpeername(fd)
+        decompressor = transfer['decompressor']
+
+        try:
+            for chunk in decompressor.feed(reader):
+                chunk_reader = helpers.ViewReader(memoryview(chunk))
+                if self.__disk:
+                    self.__write_file_async(fd, transfer, chunk_reader)
+                else:
+                    self.__read_file(transfer, chunk_reader)
+
+                if len(chunk_reader) > 0:
+                    raise ValueError("The file is longer than %dB" % transfer['fsize'])
+
+            if decompressor.eof and transfer['fpos'] < transfer['fsize']:
+                raise ValueError("The file is shorter than %dB" % transfer['fsize'])
+        except ValueError as e:
+            logger.warning("[%d] invalid compressed upload: %s", port, e)
+            self.__send_confirmation(fd, False, "Invalid compressed data!")
+            self.__end_transfer(port)
+            return self.disconnect(fd)
+
+        if not decompressor.eof:
             return  # the file is not complete yet
 
-        print("[%d] -> file has been received: %s" % (port, self.__get_file_path(transfer)))
+        self.__print_ratio(port, decompressor.raw_len, decompressor.compressed_len)
+
+        if not self.__disk:
+            self.__finish_upload(fd, transfer)
+        elif transfer['in_flight'] == 0:
+            self.__finish_upload_async(fd, port, transfer)
+        # else: finished once the last part is written
+
+    def __on_splice(self, fd: socket.socket) -> int:
+        """
+        Read handler of an upload that is being spliced from the socket to the file.
+        :param fd:
+        :return: Number of bytes moved, 0 if the client has disconnected.
+        """
+        addr, port = self.__socket_server.getpeername(fd)
+        transfer = self.__transfers[port]
+
+        moved = transfer['sink'].receive(fd)
+        transfer['fpos'] += moved
+
+        if moved > 0 and transfer['fpos'] == transfer['fsize']:
+            self.__socket_server.set_read_handler(fd, None)
+            os.close(transfer['fd'])
+            transfer['fd'] = None
+            self.__finish_upload(fd, transfer)
+
+        return moved
+
+    def __finish_upload(self, fd: socket.socket, transfer: TransferState):
+        """
+        The whole file has been received, confirm it and end the transfer.
+        :param fd:
+        :param transfer:
+        :return:
+        """
+        addr, port = self.__socket_server.getpeername(fd)
+
+        if transfer['hasher'] is not None:
+            digest = transfer['hasher'].digest()
+            if digest != transfer['digest']:
+                logger.warning("[%d] the content of the file does not match its hash!", port)
+                self.__send_confirmation(fd, False, "Hash mismatch!")
+                self.__end_transfer(port)
+                return self.disconnect(fd)
+
+            if self.__dedup_index is not None:
+                self.__dedup_index.add(transfer['fname'], digest)
+        else:
+            self.__index_received(transfer['fname'])
+
+        self.__invalidate_cache(transfer)
+        self.__update_catalog(transfer['fname'])
+        logger.debug("[%d] -> file has been received: %s", port, self.__get_file_path(transfer))
 
         self.__send_confirmation(fd, True)
 
         # end the transfer
-        self.__end_transfer(port)
+        self.__complete_transfer(fd, port)
 
-    def __process_download(self, fd: socket.socket, data: bytes):
-        if len(data) <= 0:
+    def __process_download(self, fd: socket.socket, reader: helpers.ViewReader):
+        if len(reader) <= 0:
             return
 
-        buffer = bytearray(data)
-        addr, port = fd.getpeername()
+        addr, port = self.__socket_server.getpeername(fd)
         transfer = self.__transfers[port]
 
-        if self.__read_filename(transfer, buffer) > 0:
+        if self.__read_filename(fd, transfer, reader) > 0:
             return  # the filename is not complete yet, wait for more data
 
+        if transfer['action'] in ('O', 'P'):
+            if not self.__read_offset(transfer, reader):
+                return  # the offset is not complete yet
+
+            transfer['fpos'] = transfer['offset']
+
+        if transfer['action'] == 'P' and transfer['length'] is None:
+            transfer['length'] = self.__read_uint(transfer, reader, 8)
+            if transfer['length'] is None:
+                return  # the length is not complete yet
+
+        transfer['requested'] = True
+
+        if self.__disk and not transfer['confirmed'] and not transfer['reading']:
+            # the file is opened (and validated) by the disk executor
+            logger.debug('[%d] -> file is: %s', port, self.__get_file_path(transfer))
+            transfer['reading'] = True
+            self.__socket_server.pause_reading(fd)
+            self.__disk.submit(
+                port, self.__open_download, transfer,
+                callback=lambda fsize, error: self.__on_download_opened(fd, port, transfer, fsize, error)
+            )
+            return
+
         # validate the request and send a confirmation
         if not transfer['confirmed']:
-            print('[%d] -> file is: %s' % (port, self.__get_file_path(transfer)))
+            logger.debug('[%d] -> file is: %s', port, self.__get_file_path(transfer))
 
             # check the file existence
-            if not os.path.exists(self.__get_file_path(transfer)):
+            try:
+                fsize = self.__open_download(transfer)
+            except OSError:
                 self.__send_confirmation(fd, False, "File not found!")
                 return self.disconnect(fd)
 
+            if transfer['fpos'] > fsize:
+                self.__send_confirmation(fd, False, "Invalid offset!")
+                return self.disconnect(fd)
+
             # check other stuff...
 
             # requested file is valid, send a confirmation
             self.__send_confirmation(fd, True)
             transfer['confirmed'] = True
 
-        # write the file to the client
-        self.__send_file(fd, transfer)
+            # start writing the file to the client, the rest is sent as the client drains its socket
+            self.__send_file(fd, transfer, fsize)
 
-        # end the transfer
-        self.__end_transfer(port)
+    def __process_stat(self, fd: socket.socket, reader: helpers.ViewReader):
+        if len(reader) <= 0:
+            return
+
+        addr, port = self.__socket_server.getpeername(fd)
+        transfer = self.__transfers[port]
+
+        if self.__read_filename(fd, transfer, reader) > 0:
+            return  # the filename is not complete yet
+
+        if transfer['verify_len'] is None:
+            transfer['verify_len'] = self.__read_uint(transfer, reader, 8)
+            if transfer['verify_len'] is None:
+                return  # the length is not complete yet
+
+        transfer['requested'] = True
+        logger.debug('[%d] -> file is: %s', port, self.__get_file_path(transfer))
+
+        if self.__disk:
+            # hashing a large file would block the event loop for long
+            self.__disk.submit(
+                port, self.__stat_job, transfer,
+                callback=lambda result, error: self.__on_stat(fd, port, transfer, result, error)
+            )
+            return
+
+        try:
+            result, error = self.__stat_job(transfer), None
+        except OSError as e:
+            result, error = None, e
+
+        self.__on_stat(fd, port, transfer, result, error)
+
+    def __stat_job(self, transfer: TransferState) -> Tuple[int, bytes | None]:
+        """
+        Get the size of the file and the SHA-256 of its first `verify_len` bytes (runs on the disk executor, if used).
+        A missing file is reported as an empty file, so a client can (re)start its upload from 0.
+        :return: (size, digest), digest is None if it has not been requested.
+        """
+        digest = hashlib.sha256() if transfer['verify_len'] > 0 else None
+        try:
+            file_fd = os.open(self.__get_file_path(transfer), os.O_RDONLY)
+        except FileNotFoundError:
+            return 0, digest and digest.digest()
+
+        try:
+            size = os.fstat(file_fd).st_size
+            if digest is not None:
+                pos, end = 0, min(size, transfer['verify_len'])
+                while pos < end:
+                    chunk = os.pread(file_fd, min(end - pos, 1 << 20), pos)
+                    if not chunk:
+                        break  # the file has been truncated meanwhile
+                    digest.update(chunk)
+                    pos += len(chunk)
+
+            return size, digest and digest.digest()
+        finally:
+            os.close(file_fd)
+
+    def __on_stat(self, fd: socket.socket, port: int, transfer: TransferState, result: Tuple[int, bytes | None],
+                  error: BaseException | None):
+        """
+        Reply to a stat request.
+        """
+        if not self.__is_active(port, transfer):
+            return
+
+        if error is not None:
+            logger.error("[%d] disk error: %s", port, error)
+            self.__send_confirmation(fd, False, "Could not access the file!")
+            self.__end_transfer(port)
+            return self.disconnect(fd)
+
+        size, digest = result
+        self.__send_confirmation(fd, True)
+        self.__socket_server.send(fd, int.to_bytes(size, 8, self.__byteorder) + (digest or b''))
+        logger.debug("[%d] <- file size is %dB", port, size)
+
+        self.__complete_transfer(fd, port)
+
+    def __process_delta(self, fd: socket.socket, reader: helpers.ViewReader):
+        if len(reader) <= 0:
+            return
+
+        addr, port = self.__socket_server.getpeername(fd)
+        transfer = self.__transfers[port]
+
+        if self.__read_filename(fd, transfer, reader) > 0:
+            return  # the filename is not complete yet
+
+        if self.__read_fsize(transfer, reader) > 0:
+            return  # the fsize is not complete yet
+
+        if not transfer['requested']:
+            transfer['requested'] = True
+            logger.debug('[%d] -> file is "%s" with size (%dB)', port, transfer['fname'], transfer['fsize'])
+
+            if not 0 < transfer['fsize'] < 2 ** 64:
+                self.__send_confirmation(fd, False, "Invalid file size!")
+                return self.disconnect(fd)
+
+            if self.__disk:
+                # hashing the blocks of a large file would block the event loop for long
+                self.__socket_server.pause_reading(fd)
+                self.__disk.submit(
+                    port, self.__open_delta, transfer, port,
+                    callback=lambda result, error: self.__on_delta_opened(fd, port, transfer, result, error)
+                )
+                return
+
+            try:
+                result, error = self.__open_delta(transfer, port), None
+            except (OSError, EOFError) as e:
+                result, error = None, e
+
+            return self.__on_delta_opened(fd, port, transfer, result, error)
+
+        if not transfer['confirmed']:
+            return  # waiting for the signatures
+
+        decoder = transfer['delta']
+        try:
+            ops = list(decoder.feed(reader))
+            if decoder.size > transfer['fsize'] or (decoder.done and decoder.size != transfer['fsize']):
+                raise ValueError("The rebuilt file has %dB instead of %dB" % (decoder.size, transfer['fsize']))
+        except ValueError as e:
+            logger.warning("[%d] invalid delta: %s", port, e)
+            self.__send_confirmation(fd, False, "Invalid delta!")
+            self.__end_transfer(port)
+            return self.disconnect(fd)
+
+        if self.__disk:
+            if ops:
+                # the literal bytes wait in memory until they are written
+                literal_len = sum(len(op[1]) for op in ops if op[0] == 'literal')
+                transfer['in_flight'] += literal_len
+                self.__disk.submit(
+                    port, delta.apply, transfer['basis'], transfer['fd'], ops, transfer['hasher'],
+                    callback=lambda written, error: self.__on_delta_written(fd, port, transfer, literal_len, error)
+                )
+                if transfer['in_flight'] >= self.__max_in_flight:
+                    self.__socket_server.pause_reading(fd)
+
+            if decoder.done:
+                # after the writes of the transfer
+                self.__disk.submit(
+                    port, self.__finish_delta_job, transfer, port,
+                    callback=lambda result, error: self.__on_delta_finished(fd, port, transfer, error)
+                )
+            return
+
+        try:
+            delta.apply(transfer['basis'], transfer['fd'], ops, transfer['hasher'])
+            if decoder.done:
+                self.__finish_delta_job(transfer, port)
+        except (OSError, EOFError, ValueError) as e:
+            return self.__on_delta_finished(fd, port, transfer, e)
+
+        if decoder.done:
+            self.__on_delta_finished(fd, port, transfer, None)
+
+    def __open_delta(self, transfer: TransferState, port: int) -> Tuple[int, int, bytes]:
+        """
+        Open the server's version of a file uploaded as a delta and get the signatures of its blocks, and create
+        the file it is rebuilt in (runs on the disk executor, if used).
+        :return: (size of the server's version, block length, signatures)
+        """
+        try:
+            transfer['basis'] = os.open(self.__get_file_path(transfer), os.O_RDONLY)
+            basis_size = os.fstat(transfer['basis']).st_size
+        except FileNotFoundError:
+            basis_size = 0  # the whole file is sent as literal bytes then
+
+        block_len = delta.block_len_for(basis_size)
+        signatures = delta.signatures(
+            lambda count, offset: os.pread(transfer['basis'], count, offset), basis_size, block_len
+        )
+
+        transfer['fd'] = os.open(self.__get_delta_path(transfer, port), os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+        return basis_size, block_len, signatures
+
+    def __on_delta_opened(self, fd: socket.socket, port: int, transfer: TransferState,
+                          result: Tuple[int, int, bytes] | None, error: BaseException | None):
+        """
+        Confirm a delta upload and send the signatures of the server's version of the file to the client.
+        """
+        if not self.__is_active(port, transfer):
+            return
+
+        if error is not None:
+            logger.error("[%d] disk error: %s", port, error)
+            self.__send_confirmation(fd, False, "Could not access the file!")
+            self.__end_transfer(port)
+            return self.disconnect(fd)
+
+        basis_size, block_len, signatures = result
+        transfer['delta'] = Decoder(basis_size, block_len)
+        transfer['hasher'] = hashlib.sha256()
+
+        self.__send_confirmation(fd, True)
+        transfer['confirmed'] = True
+        self.__socket_server.send(
+            fd,
+            int.to_bytes(basis_size, 8, self.__byteorder) + int.to_bytes(block_len, 4, self.__byteorder) + signatures
+        )
+        logger.debug("[%d] <- signatures of %d blocks of %dB", port, delta.block_count(basis_size, block_len), block_len)
+
+        # the data received meanwhile (if any) is the delta
+        self.__resume_requests(fd, port)
+
+    def __on_delta_written(self, fd: socket.socket, port: int, transfer: TransferState, literal_len: int,
+                           error: BaseException | None):
+        """
+        A part of the delta has been written by the disk executor.
+        """
+        if self.__on_disk_error(fd, port, transfer, error) or not self.__is_active(port, transfer):
+            return
+
+        transfer['in_flight'] -= literal_len
+        if transfer['in_flight'] < self.__max_in_flight // 2 and port not in self.__pending:
+            self.__socket_server.resume_reading(fd)
+
+    def __finish_delta_job(self, transfer: TransferState, port: int):
+        """
+        Check the rebuilt file against the hash of the client's file and replace the server's version with it
+        (runs on the disk executor, if used).
+        :raise ValueError: If the rebuilt file differs from the client's file.
+        """
+        self.__close_job(transfer)
+        if transfer['hasher'].digest() != transfer['delta'].digest:
+            raise ValueError("the rebuilt file does not match its hash")
+
+        os.replace(self.__get_delta_path(transfer, port), self.__get_file_path(transfer))
+
+    def __discard_delta_job(self, transfer: TransferState, port: int):
+        """
+        Remove the temporary file of a delta upload, unless it has replaced the server's version (runs on the disk
+        executor, if used).
+        """
+        try:
+            os.unlink(self.__get_delta_path(transfer, port))
+        except FileNotFoundError:
+            pass
+
+    def __on_delta_finished(self, fd: socket.socket, port: int, transfer: TransferState,
+                            error: BaseException | None):
+        """
+        The file uploaded as a delta has been rebuilt, confirm the upload.
+        """
+        if not self.__is_active(port, transfer):
+            return
+
+        if isinstance(error, ValueError):
+            logger.warning("[%d] invalid delta: %s", port, error)
+            self.__send_confirmation(fd, False, "Invalid delta!")
+            self.__end_transfer(port)
+            return self.disconnect(fd)
+
+        if self.__on_disk_error(fd, port, transfer, error):
+            return
+
+        decoder = transfer['delta']
+        if self.__dedup_index is not None:
+            self.__dedup_index.add(transfer['fname'], decoder.digest)
+        self.__invalidate_cache(transfer)
+        self.__update_catalog(transfer['fname'])
+
+        logger.debug("[%d] -> file has been rebuilt: %s (%dB of %dB received as they are)",
+                     port, self.__get_file_path(transfer), decoder.literal_len, decoder.size)
+        self.__send_confirmation(fd, True)
+        self.__complete_transfer(fd, port)
+
+    def __process_bundle_upload(self, fd: socket.socket, reader: helpers.ViewReader):
+        """
+        Read the files of a bundle upload: the number of files, then the name, size and content of each file. A file
+        that can not be written is still read (and dropped), its error is reported in the summary sent at the end.
+        :param fd:
+        :param reader: reader of the received data
+        :return:
+        """
+        addr, port = self.__socket_server.getpeername(fd)
+        transfer = self.__transfers[port]
+        bundle = transfer['bundle']
+
+        if bundle['count'] is None:
+            bundle['count'] = self.__read_uint(transfer, reader, 4)
+            if bundle['count'] is None:
+                return  # the number of files is not complete yet
+
+            logger.debug('[%d] -> bundle of %d files', port, bundle['count'])
+            if bundle['count'] > MAX_BUNDLE_FILES:
+                self.__send_confirmation(fd, False, "Invalid number of files!")
+                self.__end_transfer(port)
+                return self.disconnect(fd)
+
+        while bundle['done'] < bundle['count'] and len(reader) > 0:
+            if self.__read_filename(fd, transfer, reader) > 0:
+                return  # the filename is not complete yet
+
+            if self.__read_fsize(transfer, reader) > 0:
+                return  # the fsize is not complete yet
+
+            if not transfer['requested']:
+                transfer['requested'] = True
+                # the content of the file is about to change
+                if self.__dedup_index is not None:
+                    self.__dedup_index.discard(transfer['fname'])
+                self.__invalidate_cache(transfer)
+
+                bundle['names'].append(transfer['fname'])
+                bundle['results'].append(None)
+                self.__run_bundle_job(
+                    fd, port, transfer, 0, self.__open_bundle_file_job, transfer, bundle['done'],
+                    self.__get_file_path(transfer)
+                )
+
+            data = reader.read(transfer['fsize'] - transfer['fpos'])
+            if data:
+                transfer['fpos'] += len(data)
+                # the receive buffer is reused once we return, the data has to be copied for the executor
+                data = bytes(data) if self.__disk else data
+                self.__run_bundle_job(fd, port, transfer, len(data), self.__write_bundle_file_job, transfer,
+                                      bundle['done'], data)
+
+            if transfer['fpos'] < transfer['fsize']:
+                return  # the file is not complete yet
+
+            self.__run_bundle_job(fd, port, transfer, 0, self.__close_job, transfer)
+            bundle['done'] += 1
+
+            # the next file
+            transfer.update({
+                'fname': '', 'fname_len': 0, 'fsize': 0, 'fsize_buffer': bytearray(0), 'fpos': 0, 'requested': False
+            })
+
+        if bundle['done'] < bundle['count']:
+            return  # the bundle is not complete yet
+
+        if self.__disk:
+            # once all the files are written
+            self.__disk.submit(port, self.__close_job, transfer, callback=lambda result, error: (
+                self.__on_disk_error(fd, port, transfer, error) or self.__finish_bundle_upload(fd, port, transfer)
+            ))
+        else:
+            self.__finish_bundle_upload(fd, port, transfer)
+
+    def __run_bundle_job(self, fd: socket.socket, port: int, transfer: TransferState, count: int, job, *args):
+        """
+        Run a job of a bundle upload, on the disk executor if used. Reading from the client is paused while too much
+        of its data is waiting to be written.
+        :param count: Number of received bytes the job holds in memory.
+        """
+        if not self.__disk:
+            return job(*args)
+
+        transfer['in_flight'] += count
+        self.__disk.submit(
+            port, job, *args,
+            callback=lambda result, error: self.__on_bundle_written(fd, port, transfer, count, error)
+        )
+
+        if transfer['in_flight'] >= self.__max_in_flight:
+            self.__socket_server.pause_reading(fd)
+
+    def __on_bundle_written(self, fd: socket.socket, port: int, transfer: TransferState, count: int,
+                            error: BaseException | None):
+        """
+        A job of a bundle upload has been run by the disk executor.
+        """
+        if self.__on_disk_error(fd, port, transfer, error) or not self.__is_active(port, transfer):
+            return
+
+        transfer['in_flight'] -= count
+        if count > 0 and transfer['in_flight'] < self.__max_in_flight // 2 and port not in self.__pending:
+            self.__socket_server.resume_reading(fd)
+
+    def __finish_bundle_upload(self, fd: socket.socket, port: int, transfer: TransferState):
+        """
+        All the files of a bundle upload have been received, send the result of each of them and end the transfer.
+        """
+        results = transfer['bundle']['results']
+        summary = bytearray(int.to_bytes(len(results), 4, self.__byteorder))
+        for fname, error in zip(transfer['bundle']['names'], results):
+            if error is None:
+                self.__update_catalog(fname)
+                self.__index_received(fname)
+                summary += int.to_bytes(0, 1, self.__byteorder)
+            else:
+                summary += int.to_bytes(1, 1, self.__byteorder) + int.to_bytes(len(error), 1, self.__byteorder) \
+                           + error.encode("utf-8")
+
+        failed = sum(error is not None for error in results)
+        logger.debug("[%d] -> bundle has been received: %d files, %d failed", port, len(results), failed)
+
+        self.__send_confirmation(fd, True)
+        self.__socket_server.send(fd, summary)
+        self.__complete_transfer(fd, port)
+
+    def __process_bundle_download(self, fd: socket.socket, reader: helpers.ViewReader):
+        """
+        Read the files of a bundle download: the number of files, then the name of each file. The files are sent
+        one after another, each with its own status.
+        :param fd:
+        :param reader: reader of the received data
+        :return:
+        """
+        addr, port = self.__socket_server.getpeername(fd)
+        transfer = self.__transfers[port]
+        bundle = transfer['bundle']
+
+        if bundle['count'] is None:
+            bundle['count'] = self.__read_uint(transfer, reader, 4)
+            if bundle['count'] is None:
+                return  # the number of files is not complete yet
+
+            logger.debug('[%d] -> bundle of %d files', port, bundle['count'])
+            if bundle['count'] > MAX_BUNDLE_FILES:
+                self.__send_confirmation(fd, False, "Invalid number of files!")
+                self.__end_transfer(port)
+                return self.disconnect(fd)
+
+        while len(bundle['names']) < bundle['count']:
+            if len(reader) <= 0 or self.__read_filename(fd, transfer, reader) > 0:
+                return  # the filename is not complete yet
+
+            bundle['names'].append(transfer['fname'])
+            transfer['fname'], transfer['fname_len'] = '', 0
+
+        transfer['requested'] = True
+
+        # the client is not supposed to send anything until the bundle is done
+        self.__socket_server.pause_reading(fd)
+        self.__send_confirmation(fd, True)
+        logger.debug("[%d] <- sending %d files...", port, bundle['count'])
+        self.__send_bundle_window(fd, transfer)
+
+    def __send_bundle_window(self, fd: socket.socket, transfer: TransferState):
+        """
+        Send the next files of a bundle download (about the current window of them) and wait for the client to drain
+        them, or end the transfer if all the files have been sent.
+        :param fd:
+        :param transfer:
+        :return:
+        """
+        addr, port = self.__socket_server.getpeername(fd)
+        bundle = transfer['bundle']
+
+        if transfer['reading']:
+            return  # the next files are being read
+
+        if bundle['done'] == bundle['count']:
+            logger.debug("[%d] bundle has been sent", port)
+            return self.__complete_transfer(fd, port)
+
+        if self.__disk:
+            transfer['reading'] = True
+            self.__disk.submit(
+                port, self.__read_bundle_job, transfer, bundle['done'],
+                callback=lambda result, error: self.__on_bundle_read(fd, port, transfer, result, error)
+            )
+            return
+
+        self.__on_bundle_read(fd, port, transfer, self.__read_bundle_job(transfer, bundle['done']), None)
+
+    def __on_bundle_read(self, fd: socket.socket, port: int, transfer: TransferState, result: Tuple[bytes, int],
+                         error: BaseException | None):
+        """
+        The next files of a bundle download have been read, send them.
+        """
+        if not self.__is_active(port, transfer):
+            return
+
+        transfer['reading'] = False
+        if error is not None:
+            logger.error("[%d] disk error: %s", port, error)
+            self.__end_transfer(port)
+            return self.disconnect(fd)
+
+        data, transfer['bundle']['done'] = result
+        self.__socket_server.send(fd, data)
+        self.__socket_server.wait_writable(fd)
+
+    def __process_listing(self, fd: socket.socket, reader: helpers.ViewReader):
+        """
+        Read a listing request (the prefix, the name the page starts after and the max number of files) and reply
+        with a page of the catalog.
+        :param fd:
+        :param reader: reader of the received data
+        :return:
+        """
+        addr, port = self.__socket_server.getpeername(fd)
+        transfer = self.__transfers[port]
+        listing = transfer['listing']
+
+        for field in ('prefix', 'after'):
+            if listing[field + '_len'] is None:
+                listing[field + '_len'] = self.__read_uint(transfer, reader, 1)
+                if listing[field + '_len'] is None:
+                    return  # the length is not complete yet
+
+            if listing[field] is None:
+                value = self.__read_bytes(transfer, reader, listing[field + '_len'])
+                if value is None:
+                    return  # the field is not complete yet
+                try:
+                    listing[field] = str(value, "utf-8")
+                except UnicodeDecodeError:
+                    logger.warning("[%d] invalid listing %s", port, field)
+                    self.__send_confirmation(fd, False, "Invalid request!")
+                    self.__end_transfer(port)
+                    return self.disconnect(fd)
+
+        if listing['limit'] is None:
+            listing['limit'] = self.__read_uint(transfer, reader, 4)
+            if listing['limit'] is None:
+                return  # the limit is not complete yet
+
+        transfer['requested'] = True
+        limit = min(listing['limit'] or MAX_LIST_LIMIT, MAX_LIST_LIMIT)
+        logger.debug('[%d] -> prefix "%s", after "%s", at most %d files', port, listing['prefix'], listing['after'], limit)
+
+        if self.__catalog is None:
+            self.__send_confirmation(fd, False, "Listing is disabled!")
+            self.__end_transfer(port)
+            return self.disconnect(fd)
+
+        entries, more = self.__catalog.list(listing['prefix'], listing['after'], limit)
+
+        page = bytearray(int.to_bytes(len(entries), 4, self.__byteorder))
+        for fname, size, mtime_ns in entries:
+            name = fname.encode("utf-8")
+            page += int.to_bytes(len(name), 1, self.__byteorder) + name
+            page += int.to_bytes(size, 8, self.__byteorder) + int.to_bytes(mtime_ns, 8, self.__byteorder)
+        page += int.to_bytes(1 if more else 0, 1, self.__byteorder)
+
+        self.__send_confirmation(fd, True)
+        self.__socket_server.send(fd, page)
+        logger.debug("[%d] <- %d files%s", port, len(entries), ", more to list" if more else "")
+
+        self.__complete_transfer(fd, port)
+
+    def __process_stats(self, fd: socket.socket):
+        """
+        Reply with a JSON snapshot of the counters of the server: the traffic of the connections, the transfers in
+        progress, the finished transfers of each action and the state of the caches.
+        :param fd:
+        :return:
+        """
+        addr, port = self.__socket_server.getpeername(fd)
+        self.__transfers[port]['requested'] = True
+
+        now = time.monotonic()
+        active: List[ActiveTransfer] = [
+            {
+                'port': p, 'action': t['action'], 'fname': t['fname'], 'fsize': t['fsize'], 'fpos': t['fpos'],
+                'elapsed': round(now - t['started'], 3)
+            }
+            for p, t in self.__transfers.items() if p != port
+        ]
+        snapshot = {
+            'pid': os.getpid(), 'uptime': round(self.__stats.uptime, 3),
+            'server': self.__socket_server.stats(),
+            'transfers': {'active': active, 'actions': self.__stats.snapshot()},
+            'cache': self.__cache.stats() if self.__cache is not None else None,
+            'mappings': self.__mappings.stats() if self.__mappings is not None else None,
+            'catalog': len(self.__catalog) if self.__catalog is not None else None,
+            'dedup': len(self.__dedup_index) if self.__dedup_index is not None else None,
+        }
+        data = json.dumps(snapshot, separators=(',', ':')).encode("utf-8")
+
+        self.__send_confirmation(fd, True)
+        self.__socket_server.send(fd, int.to_bytes(len(data), 4, self.__byteorder) + data)
+        logger.debug("[%d] <- stats (%dB)", port, len(data))
+
+        self.__complete_transfer(fd, port)
 
     # endregion
 
     # region Framing/un-framing
 
-    def __read_filename(self, transfer: TransferState, buffer: bytearray):
+    def __read_filename(self, fd: socket.socket, transfer: TransferState, reader: helpers.ViewReader):
         """
-        Reads the fname from the socket until the fname is complete.
+        Reads the fname from the socket until the fname is complete. The server's own files are not transferred,
+        the client is disconnected if it requests one.
+        :param fd:
         :param transfer:
-        :param buffer: mutable bytearray containing the received data
-        :return: Number of bytes remaining for the fname to be complete.
+        :param reader: reader of the received data
+        :return: Number of bytes remaining for the fname to be complete (the fname length if the client has been
+        disconnected).
         """
         if transfer['fname_len'] == 0:
-            transfer['fname_len'] = int.from_bytes(buffer[:1], self.__byteorder)
+            transfer['fname_len'] = int.from_bytes(reader.read(1), self.__byteorder)
             if transfer['fname_len'] <= 0:
                 raise Exception("Invalid filename length %d" % transfer['fname_len'])
 
-            del buffer[:1]
-
         diff = transfer['fname_len'] - len(transfer['fname'])
         if diff > 0:
-            transfer['fname'] += buffer[:diff].decode("utf-8")
-            del buffer[:diff]
+            transfer['fname'] += str(reader.read(diff), "utf-8")
 
             diff = transfer['fname_len'] - len(transfer['fname'])
+            if diff == 0 and reserved.is_reserved(transfer['fname']):
+                logger.warning('[%d] reserved file name "%s"!', self.__socket_server.getpeername(fd)[1],
+                               transfer['fname'])
+                self.__send_confirmation(fd, False, "Reserved file name!")
+                self.disconnect(fd)
+                return transfer['fname_len']
 
         return diff
 
-    def __read_fsize(self, transfer: TransferState, buffer: bytearray):
+    def __read_fsize(self, transfer: TransferState, reader: helpers.ViewReader):
         """
         Reads the fsize from the socket until the fsize is complete.
         :param transfer:
-        :param buffer: mutable bytearray containing the received data
+        :param reader: reader of the received data
         :return: Number of bytes remaining for the fsize to be complete.
         """
         diff = 8 - len(transfer['fsize_buffer'])
         if diff > 0:
-            transfer['fsize_buffer'] += buffer[:diff]
-            del buffer[:diff]
+            transfer['fsize_buffer'] += reader.read(diff)
 
             diff = 8 - len(transfer['fsize_buffer'])
 
@@ -231,20 +1353,65 @@ class FileServer:
 
         return diff
 
-    def __read_file(self, transfer: TransferState, buffer: bytearray):
+    def __read_uint(self, transfer: TransferState, reader: helpers.ViewReader, n: int) -> int | None:
+        """
+        Reads an n-byte unsigned number of the request from the socket.
+        :param transfer:
+        :param reader: reader of the received data
+        :param n:
+        :return: The number once it is complete, None if more data is needed.
+        """
+        value = self.__read_bytes(transfer, reader, n)
+        return None if value is None else int.from_bytes(value, self.__byteorder)
+
+    @staticmethod
+    def __read_bytes(transfer: TransferState, reader: helpers.ViewReader, n: int) -> bytes | None:
+        """
+        Reads an n-byte field of the request from the socket.
+        :param transfer:
+        :param reader: reader of the received data
+        :param n:
+        :return: The field once it is complete, None if more data is needed.
+        """
+        transfer['header_buffer'] += reader.read(n - len(transfer['header_buffer']))
+        if len(transfer['header_buffer']) < n:
+            return None
+
+        value = bytes(transfer['header_buffer'])
+        transfer['header_buffer'] = bytearray(0)
+        return value
+
+    def __read_offset(self, transfer: TransferState, reader: helpers.ViewReader) -> bool:
+        """
+        Reads the offset from the socket until the offset is complete.
+        :param transfer:
+        :param reader: reader of the received data
+        :return: Whether the offset is complete.
+        """
+        if transfer['offset'] is None:
+            transfer['offset'] = self.__read_uint(transfer, reader, 8)
+
+        return transfer['offset'] is not None
+
+    def __read_file(self, transfer: TransferState, reader: helpers.ViewReader):
         """
         Read the file from the socket and write it to the filesystem.
         :param transfer:
-        :param buffer: mutable bytearray containing the received data
+        :param reader: reader of the received data, the data is written straight from the receive buffer
         :return:
         """
         if transfer['fd'] is None:
-            transfer['fd'] = os.open(self.__get_file_path(transfer), os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+            self.__open_upload(transfer, transfer['fpos'])
 
         diff = transfer['fsize'] - transfer['fpos']
         if diff > 0:
-            transfer['fpos'] += os.write(transfer['fd'], buffer[:diff])
-            del buffer[:diff]
+            chunk = reader.read(diff)
+            if transfer['hasher'] is not None:
+                transfer['hasher'].update(chunk)
+            while chunk:
+                written = os.write(transfer['fd'], chunk)
+                transfer['fpos'] += written
+                chunk = chunk[written:]
 
             diff = transfer['fsize'] - transfer['fpos']
 
@@ -254,6 +1421,31 @@ class FileServer:
 
         return diff
 
+    def __send_download_header(self, fd: socket.socket, transfer: TransferState):
+        """
+        Send the size of the downloaded file (its part that is about to be sent) and the codec of its compression,
+        if a compressed download has been requested.
+        :param fd:
+        :param transfer:
+        :return:
+        """
+        addr, port = self.__socket_server.getpeername(fd)
+
+        header = int.to_bytes(transfer['fsize'] - transfer['fpos'], 8, self.__byteorder)
+        if transfer['codec']:
+            # the file is sent uncompressed if it is not worth compressing
+            codec = transfer['codec'] if transfer['compressor'] is not None else compression.NONE
+            header += int.to_bytes(codec, 1, self.__byteorder)
+            logger.debug("[%d] <- compression: %s", port, compression.CODECS.get(codec, 'none'))
+
+        self.__socket_server.send(fd, header)
+        logger.debug("[%d] <- sending file (%dB)...", port, transfer['fsize'] - transfer['fpos'])
+
+    @staticmethod
+    def __print_ratio(port: int, raw_len: int, compressed_len: int):
+        logger.debug("[%d] compressed %dB to %dB (%.1fx)",
+                     port, raw_len, compressed_len, compression.ratio(raw_len, compressed_len))
+
     def __send_confirmation(self, fd: socket.socket, ok: bool, error: str = None):
         """
         Send a confirmation message to the client.
@@ -262,7 +1454,7 @@ class FileServer:
         :param error: Error message in case of `not ok`.
         :return:
         """
-        addr, port = fd.getpeername()
+        addr, port = self.__socket_server.getpeername(fd)
         if not ok and (error is None or not 0 < len(error) < 256):
             raise Exception("Missing or invalid error message for a confirmation!")
 
@@ -271,46 +1463,423 @@ class FileServer:
             int.to_bytes(0 if ok else 1, 1, self.__byteorder)
         )
 
-        msg = "OK" if ok else "ERROR"
+        if ok:
+            logger.debug("[%d] <- OK", port)
+            return
 
-        if not ok:
-            self.__socket_server.send(
-                fd,
-                int.to_bytes(len(error), 1, self.__byteorder) + bytes(error.encode("utf-8"))
-            )
+        self.__socket_server.send(
+            fd,
+            int.to_bytes(len(error), 1, self.__byteorder) + bytes(error.encode("utf-8"))
+        )
 
-            msg += ": %s" % error
+        # the errors are rare, they are logged by default
+        logger.info("[%d] <- ERROR: %s", port, error)
+
+    def __send_duplicate_confirmation(self, fd: socket.socket):
+        """
+        Tell the client that the server has the content of its uploaded file already, the content is not sent.
+        :param fd:
+        :return:
+        """
+        addr, port = self.__socket_server.getpeername(fd)
+        self.__socket_server.send(fd, int.to_bytes(2, 1, self.__byteorder))
+        logger.debug("[%d] <- HAVE IT", port)
+
+    def __send_file(self, fd: socket.socket, transfer: TransferState, fsize: int):
+        """
+        Send the size of the opened file to the client and start sending its contents.
+        :param fd:
+        :param transfer:
+        :param fsize: Size of the file.
+        :return:
+        """
+        transfer['fsize'] = self.__get_range_end(transfer, fsize)
+        self.__send_download_header(fd, transfer)
 
-        print("[%d] <- %s" % (port, msg))
+        # the client is not supposed to send anything until the download is done
+        self.__socket_server.pause_reading(fd)
+        self.__send_file_window(fd, transfer)
 
-    def __send_file(self, fd: socket.socket, transfer: TransferState):
+    def __send_file_window(self, fd: socket.socket, transfer: TransferState):
         """
-        Read the requested file from the filesystem and send it to the client.
+        Send the next part of the downloaded file (at most the current window) and wait for the client to
+        drain it, or end the transfer if the whole file has been sent.
         :param fd:
         :param transfer:
         :return:
         """
-        addr, port = fd.getpeername()
+        addr, port = self.__socket_server.getpeername(fd)
+
+        diff = transfer['fsize'] - transfer['fpos']
+        if diff > 0:
+            count = min(diff, transfer['window'].size)
+            if transfer['compressor'] is not None:
+                try:
+                    data = self.__read_job(transfer, count, transfer['fpos'])
+                except (OSError, EOFError) as e:
+                    # the file size has already been sent, the client can not be told about the error
+                    logger.error("[%d] disk error: %s", port, e)
+                    self.__end_transfer(port)
+                    return self.disconnect(fd)
+
+                self.__socket_server.send(fd, data)
+            elif transfer['content'] is not None:
+                self.__socket_server.send(fd, self.__read_job(transfer, count, transfer['fpos']))
+            else:
+                self.__socket_server.send_file(fd, transfer['fd'], transfer['fpos'], count)
+            self.__socket_server.wait_writable(fd)
+            transfer['fpos'] += count
+
+            # grow the window if the socket has taken it all right away
+            transfer['window'].observe(count if self.__socket_server.pending(fd) == 0 else 0)
+            return
+
+        # the whole file has been sent
+        logger.debug("[%d] file has been sent", port)
+        if transfer['compressor'] is not None:
+            self.__print_ratio(port, transfer['compressor'].raw_len, transfer['compressor'].compressed_len)
+
+        self.__complete_transfer(fd, port)
+
+    # endregion
+
+    # region Disk executor transfers
+
+    def __open_download(self, transfer: TransferState) -> int:
+        """
+        Open the downloaded file, or get its content from the file cache or its shared mapping. If a compressed download
+        has been requested, compress it only if its first bytes compress well (runs on the disk executor, if used).
+        :return: Size of the opened file.
+        """
+        if self.__cache is not None and not transfer['codec']:
+            transfer['content'] = self.__cache.load(self.__get_file_path(transfer))
+            if transfer['content'] is not None:
+                return len(transfer['content'])
+
+        if self.__mappings is not None and not transfer['codec']:
+            transfer['mapping'] = self.__mappings.acquire(self.__get_file_path(transfer))
+            if transfer['mapping'] is not None:
+                transfer['content'] = transfer['mapping'].view
+                return transfer['mapping'].size
+
         transfer['fd'] = os.open(self.__get_file_path(transfer), os.O_RDONLY)
-        transfer['fsize'] = os.fstat(transfer['fd']).st_size
+        st = os.fstat(transfer['fd'])
+        if not stat.S_ISREG(st.st_mode):
+            # e.g. a directory, there is nothing to send
+            raise OSError(errno.EINVAL, "Not a regular file", self.__get_file_path(transfer))
 
-        # write the size of the file that is about to be sent
-        self.__socket_server.send(
-            fd,
-            int.to_bytes(transfer['fsize'], 8, self.__byteorder)
+        if transfer['codec']:
+            sample = os.pread(transfer['fd'], compression.SAMPLE_LEN, transfer['fpos'])
+            if compression.worth_compressing(transfer['codec'], sample):
+                transfer['compressor'] = Compressor(transfer['codec'])
+
+        return st.st_size
+
+    @staticmethod
+    def __read_job(transfer: TransferState, count: int, offset: int) -> bytes:
+        """
+        Read a part of the downloaded file, compressed (framed) if the download is compressed (runs on the disk
+        executor, if used).
+        :return:
+        """
+        if transfer['content'] is not None:
+            return memoryview(transfer['content'])[offset:offset + count]
+
+        data = os.pread(transfer['fd'], count, offset)
+        if len(data) != count:
+            raise EOFError("file has been truncated")
+
+        if transfer['compressor'] is None:
+            return data
+
+        out = transfer['compressor'].compress(data)
+        if offset + count == transfer['fsize']:
+            out += transfer['compressor'].flush()
+        return out
+
+    def __open_upload(self, transfer: TransferState, offset: int, path: str = None):
+        """
+        Open the uploaded file for writing at the given offset, anything after the offset is dropped (runs on the disk
+        executor, if used).
+        :param path: Path of the file, the file of the transfer by default.
+        """
+        path = path or self.__get_file_path(transfer)
+        try:
+            if os.stat(path).st_nlink > 1 or (self.__mappings is not None and self.__mappings.is_mapped(path)):
+                # the file shares its content with a deduplicated file, or is being sent from its mapping, neither
+                # of them may change
+                dedup.unshare(path, offset)
+        except FileNotFoundError:
+            pass
+
+        transfer['fd'] = os.open(path, os.O_WRONLY | os.O_CREAT)
+        os.ftruncate(transfer['fd'], offset)
+        os.lseek(transfer['fd'], offset, os.SEEK_SET)
+
+    @staticmethod
+    def __write_job(transfer: TransferState, data: bytes) -> int:
+        """
+        Write a received part of the uploaded file (runs on the disk executor).
+        :return: Number of bytes written.
+        """
+        if transfer['hasher'] is not None:
+            transfer['hasher'].update(data)
+
+        view = memoryview(data)
+        while view:
+            view = view[os.write(transfer['fd'], view):]
+        return len(data)
+
+    def __close_job(self, transfer: TransferState):
+        """
+        Close the files of a transfer and release its mapping, if they have been opened (runs on the disk executor,
+        if used).
+        """
+        if transfer['fd'] is not None:
+            os.close(transfer['fd'])
+            transfer['fd'] = None
+        if transfer['basis'] is not None:
+            os.close(transfer['basis'])
+            transfer['basis'] = None
+        if transfer['mapping'] is not None:
+            self.__mappings.release(transfer['mapping'])
+            transfer['mapping'] = None
+
+    def __open_bundle_file_job(self, transfer: TransferState, index: int, path: str):
+        """
+        Open a file of a bundle upload for writing (runs on the disk executor, if used). An error is recorded as
+        the result of the file, its content is dropped then.
+        """
+        try:
+            self.__open_upload(transfer, 0, path)
+        except OSError:
+            transfer['bundle']['results'][index] = "Could not write the file!"
+
+    @staticmethod
+    def __write_bundle_file_job(transfer: TransferState, index: int, data) -> int:
+        """
+        Write a received part of a file of a bundle upload (runs on the disk executor, if used). An error is recorded
+        as the result of the file, the rest of its content is dropped then.
+        :return: Number of bytes written.
+        """
+        if transfer['fd'] is None:
+            return 0  # the file could not be opened
+
+        try:
+            view = memoryview(data)
+            while view:
+                view = view[os.write(transfer['fd'], view):]
+        except OSError:
+            transfer['bundle']['results'][index] = "Could not write the file!"
+            os.close(transfer['fd'])
+            transfer['fd'] = None
+            return 0
+
+        return len(data)
+
+    def __read_bundle_job(self, transfer: TransferState, start: int) -> Tuple[bytearray, int]:
+        """
+        Read the next files of a bundle download, until about a window of them is read (runs on the disk executor,
+        if used). Each file is preceded by its status: 0 and its size, or 1 and the error.
+        :param start: Index of the first file to read.
+        :return: (the files, index of the file to read next)
+        """
+        out = bytearray()
+        index = start
+        while index < len(transfer['bundle']['names']) and (index == start or len(out) < self.__max_download_window):
+            path = os.path.abspath(os.path.join(self.__data_folder, transfer['bundle']['names'][index]))
+            index += 1
+            try:
+                data = self.__read_bundle_file(path)
+            except OSError:
+                data, error = None, "File not found!"
+            else:
+                error = "File too large for a bundle!" if data is None else None
+
+            if error is not None:
+                out += int.to_bytes(1, 1, self.__byteorder) + int.to_bytes(len(error), 1, self.__byteorder) \
+                       + error.encode("utf-8")
+                continue
+
+            out += int.to_bytes(0, 1, self.__byteorder) + int.to_bytes(len(data), 8, self.__byteorder)
+            out += data
+
+        return out, index
+
+    def __read_bundle_file(self, path: str) -> bytes | None:
+        """
+        Read the whole content of a file of a bundle download, from the file cache if used.
+        :return: The content, None if the file is larger than `max_in_flight`.
+        """
+        if self.__cache is not None:
+            data = self.__cache.load(path)
+            if data is not None:
+                return data
+
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size > self.__max_in_flight:
+                return None
+            return f.read()
+
+    def __is_active(self, port: int, transfer: TransferState) -> bool:
+        """
+        Whether the transfer is still the active transfer of the client, a disk job can complete after the client
+        has disconnected (or has started another transfer).
+        """
+        return self.__transfers.get(port, None) is transfer
+
+    def __on_disk_error(self, fd: socket.socket, port: int, transfer: TransferState, error: BaseException | None):
+        """
+        Fail the transfer if a disk job has failed.
+        :return: Whether the job has failed.
+        """
+        if error is None:
+            return False
+
+        if self.__is_active(port, transfer):
+            logger.error("[%d] disk error: %s", port, error)
+            self.__send_confirmation(fd, False, "Could not access the file!")
+            self.__end_transfer(port)
+            self.disconnect(fd)
+
+        return True
+
+    def __write_file_async(self, fd: socket.socket, transfer: TransferState, reader: helpers.ViewReader):
+        """
+        Hand the received part of the uploaded file to the disk executor. Reading from the client is paused while
+        too much of its data is waiting to be written.
+        :param fd:
+        :param transfer:
+        :param reader: reader of the received data
+        :return:
+        """
+        addr, port = self.__socket_server.getpeername(fd)
+
+        # the receive buffer is reused once we return, the data has to be copied for the executor
+        data = bytes(reader.read(transfer['fsize'] - transfer['fpos']))
+        if not data:
+            return
+
+        transfer['fpos'] += len(data)
+        transfer['in_flight'] += len(data)
+        self.__disk.submit(
+            port, self.__write_job, transfer, data,
+            callback=lambda written, error: self.__on_written(fd, port, transfer, len(data), error)
+        )
+
+        if transfer['in_flight'] >= self.__max_in_flight:
+            self.__socket_server.pause_reading(fd)
+
+    def __on_written(self, fd: socket.socket, port: int, transfer: TransferState, written: int,
+                     error: BaseException | None):
+        """
+        A part of the uploaded file has been written by the disk executor.
+        """
+        if self.__on_disk_error(fd, port, transfer, error) or not self.__is_active(port, transfer):
+            return
+
+        transfer['in_flight'] -= written
+        if transfer['in_flight'] < self.__max_in_flight // 2 and port not in self.__pending:
+            self.__socket_server.resume_reading(fd)
+
+        if transfer['fpos'] == transfer['fsize'] and transfer['in_flight'] == 0 and self.__received_all(transfer):
+            self.__finish_upload_async(fd, port, transfer)
+
+    def __finish_upload_async(self, fd: socket.socket, port: int, transfer: TransferState):
+        """
+        The whole uploaded file has been written, close it and confirm the upload.
+        """
+        self.__disk.submit(
+            port, self.__close_job, transfer,
+            callback=lambda result, error: (
+                self.__on_disk_error(fd, port, transfer, error) or self.__finish_upload(fd, transfer)
+            )
         )
 
-        print("[%d] <- sending file (%dB)..." % (port, transfer['fsize']))
+    def __on_download_opened(self, fd: socket.socket, port: int, transfer: TransferState, fsize: int,
+                             error: BaseException | None):
+        """
+        The downloaded file has been opened by the disk executor, confirm the download and start sending the file.
+        """
+        if not self.__is_active(port, transfer):
+            return
+
+        transfer['reading'] = False
+        if error is not None or transfer['fpos'] > fsize:
+            self.__send_confirmation(fd, False, "File not found!" if error is not None else "Invalid offset!")
+            self.__end_transfer(port)
+            return self.disconnect(fd)
+
+        self.__send_confirmation(fd, True)
+        transfer['confirmed'] = True
+        transfer['fsize'] = self.__get_range_end(transfer, fsize)
+        transfer['drained'] = True
+
+        self.__send_download_header(fd, transfer)
 
-        # write all the file contents
-        while True:
-            buffer = os.read(transfer['fd'], 1024)
-            if not buffer:
-                break
+        self.__pump_download(fd, transfer)
 
-            self.__socket_server.send(fd, buffer)
+    def __pump_download(self, fd: socket.socket, transfer: TransferState):
+        """
+        Send the part of the downloaded file that has been read ahead once the client has drained the previous one,
+        and keep the disk executor reading ahead (at most `max_in_flight` bytes).
+        :param fd:
+        :param transfer:
+        :return:
+        """
+        addr, port = self.__socket_server.getpeername(fd)
+
+        if transfer['content'] is not None and not transfer['ahead'] and transfer['fpos'] < transfer['fsize']:
+            # in memory already, no need to read ahead
+            count = min(transfer['fsize'] - transfer['fpos'], transfer['window'].size)
+            transfer['ahead'].append((count, self.__read_job(transfer, count, transfer['fpos'])))
+            transfer['fpos'] += count
+            transfer['in_flight'] += count
+
+        if transfer['drained'] and transfer['ahead']:
+            count, data = transfer['ahead'].popleft()
+            transfer['in_flight'] -= count
+            transfer['drained'] = False
+            self.__socket_server.send(fd, data)
+            self.__socket_server.wait_writable(fd)
+            transfer['window'].observe(len(data) - self.__socket_server.pending(fd))
+
+        if not transfer['reading'] and transfer['content'] is None and transfer['fpos'] < transfer['fsize'] \
+                and transfer['in_flight'] < self.__max_in_flight:
+            count = min(transfer['fsize'] - transfer['fpos'], transfer['window'].size)
+            offset = transfer['fpos']
+            transfer['fpos'] += count
+            transfer['in_flight'] += count
+            transfer['reading'] = True
+            self.__disk.submit(
+                port, self.__read_job, transfer, count, offset,
+                callback=lambda data, error: self.__on_read(fd, port, transfer, count, data, error)
+            )
 
-        print("[%d] file has been sent" % port)
+        if transfer['drained'] and not transfer['ahead'] and not transfer['reading'] \
+                and transfer['fpos'] == transfer['fsize']:
+            logger.debug("[%d] file has been sent", port)
+            if transfer['compressor'] is not None:
+                self.__print_ratio(port, transfer['compressor'].raw_len, transfer['compressor'].compressed_len)
+            self.__complete_transfer(fd, port)
+
+    def __on_read(self, fd: socket.socket, port: int, transfer: TransferState, count: int, data: bytes,
+                  error: BaseException | None):
+        """
+        A part of the downloaded file has been read by the disk executor.
+        """
+        if not self.__is_active(port, transfer):
+            return
+
+        transfer['reading'] = False
+        if error is not None:
+            # the file size has already been sent, the client can not be told about the error
+            logger.error("[%d] disk error: %s", port, error)
+            self.__end_transfer(port)
+            return self.disconnect(fd)
+
+        transfer['ahead'].append((count, data))
+        self.__pump_download(fd, transfer)
 
     # endregion
 
@@ -325,23 +1894,76 @@ class FileServer:
         """
         self.__transfers[port] = {
             'action': action,
-            'fname': '', 'fname_len': 0, 'confirmed': False,
+            'fname': '', 'fname_len': 0, 'requested': False, 'confirmed': False,
             'fsize': 0, 'fsize_buffer': bytearray(0),
-            'fpos': 0, 'fd': None
+            'offset': None, 'length': None, 'verify_len': None,
+            'digest': None, 'hasher': None, 'basis': None, 'delta': None,
+            'bundle': {'count': None, 'done': 0, 'names': [], 'results': []} if action in ('M', 'G') else None,
+            'listing': {
+                'prefix_len': None, 'prefix': None, 'after_len': None, 'after': None, 'limit': None
+            } if action == 'L' else None,
+            'started': time.monotonic(),
+            'header_buffer': bytearray(0),
+            'codec': None if action == 'C' else compression.NONE, 'compressor': None, 'decompressor': None,
+            'fpos': 0, 'fd': None, 'content': None, 'mapping': None, 'sink': None,
+            'window': AdaptiveSize(self.__download_window, self.__max_download_window),
+            'in_flight': 0, 'ahead': deque(), 'reading': False, 'drained': False
         }
         return self.__transfers[port]
 
-    def __end_transfer(self, port: int):
+    def __complete_transfer(self, fd: socket.socket, port: int):
+        """
+        End a successfully completed file transfer and continue with the next request of the client, if it has
+        been received already.
+        :param fd:
+        :param port:
+        :return:
+        """
+        self.__end_transfer(port, ok=True)
+        self.__resume_requests(fd, port)
+
+    def __resume_requests(self, fd: socket.socket, port: int):
+        """
+        Resume reading from the client and process the data held back meanwhile.
+        :param fd:
+        :param port:
+        :return:
+        """
+        self.__socket_server.resume_reading(fd)
+
+        pending = self.__pending.pop(port, None)
+        if pending:
+            self.__process_requests(fd, helpers.ViewReader(memoryview(pending)))
+
+    def __end_transfer(self, port: int, ok=False):
         """
         End a file transfer for a client.
         :param port:
+        :param ok: Whether the transfer has completed, or has failed (for the stats).
         :return:
         """
         if port not in self.__transfers:
             return
 
-        # TODO: close opened files etc.
-        del self.__transfers[port]
+        transfer = self.__transfers.pop(port)
+        duration = time.monotonic() - transfer['started']
+        if transfer['action'] != 'T':
+            self.__stats.finish(transfer['action'], duration, ok)
+        log.access({
+            'port': port, 'action': transfer['action'], 'fname': transfer['fname'], 'fsize': transfer['fsize'],
+            'status': 'ok' if ok else 'failed', 'duration_ms': round(duration * 1000, 3)
+        })
+        if self.__disk:
+            # after the pending jobs of the transfer, the file may not even be opened yet
+            self.__disk.submit(port, self.__close_job, transfer)
+            if transfer['action'] == 'B':
+                self.__disk.submit(port, self.__discard_delta_job, transfer, port)
+        else:
+            self.__close_job(transfer)
+            if transfer['action'] == 'B':
+                self.__discard_delta_job(transfer, port)
+        if transfer['sink'] is not None:
+            transfer['sink'].close()
 
     def __get_file_path(self, transfer: TransferState):
         """
@@ -349,4 +1971,87 @@ class FileServer:
         """
         return os.path.abspath(os.path.join(self.__data_folder, transfer['fname']))
 
+    def __update_catalog(self, fname: str):
+        """
+        Record a received file in the catalog, if used.
+        """
+        if self.__catalog is not None:
+            self.__catalog.update(fname)
+
+    def __index_received(self, fname: str):
+        """
+        Index a received file that has not been hashed as it was received, if deduplicating, so it can be the source
+        of later uploads (hashing runs on the disk executor, if used).
+        """
+        if self.__dedup_index is None:
+            return
+
+        path = os.path.abspath(os.path.join(self.__data_folder, fname))
+        if self.__disk:
+            # keyed by the file, the next transfers of the client do not wait for it
+            self.__disk.submit(
+                path, self.__hash_job, path,
+                callback=lambda result, error: self.__on_hashed(fname, result, error)
+            )
+            return
+
+        try:
+            result, error = self.__hash_job(path), None
+        except OSError as e:
+            result, error = None, e
+
+        self.__on_hashed(fname, result, error)
+
+    @staticmethod
+    def __hash_job(path: str) -> Tuple[bytes, os.stat_result]:
+        """
+        Get the SHA-256 of a received file (runs on the disk executor, if used).
+        :return: (digest, status of the file before it has been hashed)
+        """
+        st = os.stat(path)
+        return dedup.hash_file(path), st
+
+    def __on_hashed(self, fname: str, result: Tuple[bytes, os.stat_result], error: BaseException | None):
+        """
+        A received file has been hashed, index it (unless it has changed meanwhile, e.g. it is being uploaded again).
+        """
+        if error is not None:
+            logger.warning("could not index %s: %s", fname, error)
+            return
+
+        digest, st = result
+        self.__dedup_index.add(fname, digest, st)
+
+    def __invalidate_cache(self, transfer: TransferState):
+        """
+        Drop the file of an upload from the file cache, it is being (or has been) overwritten.
+        """
+        if self.__cache is not None:
+            self.__cache.invalidate(self.__get_file_path(transfer))
+
+    def __get_delta_path(self, transfer: TransferState, port: int):
+        """
+        Get the absolute path to the temporary file a file uploaded as a delta is rebuilt in.
+        """
+        return '%s.%d-%d.delta-tmp' % (self.__get_file_path(transfer), os.getpid(), port)
+
+    @staticmethod
+    def __get_range_end(transfer: TransferState, fsize: int):
+        """
+        Get the position in a downloaded file where the transfer ends: the end of the requested range, or of the file.
+        """
+        if transfer['length'] is None:
+            return fsize
+
+        return min(fsize, transfer['offset'] + transfer['length'])
+
+    def __get_file_size(self, transfer: TransferState):
+        """
+        Get the size of the file that is managed by the given transfer state, 0 if it does not exist.
+        """
+        try:
+            return os.path.getsize(self.__get_file_path(transfer))
+        except OSError:
+            return 0
+
     # endregion
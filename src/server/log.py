@@ -0,0 +1,150 @@
+"""
+Logging of the server. The records are handed to a background thread through a queue, which formats and writes them,
+so the event loop never waits for the output. The per-transfer lines are logged at the debug level (off by default),
+records below the warning level can be sampled, and each finished transfer can be written to an access log as
+a JSON line.
+"""
+import itertools
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+from typing import Dict
+
+logger = logging.getLogger('server')
+# one record per finished transfer, see `access`
+access_logger = logging.getLogger('server.access')
+
+LEVELS = {'debug': logging.DEBUG, 'info': logging.INFO, 'warning': logging.WARNING, 'error': logging.ERROR}
+
+_listener: logging.handlers.QueueListener | None = None
+_handler: logging.Handler | None = None
+_pid: int | None = None
+
+
+class _SampleFilter(logging.Filter):
+    """
+    Passes only every n-th debug/access record, the other records are always passed.
+    """
+
+    def __init__(self, every: int):
+        super().__init__()
+        self.__every = every
+        self.__counter = itertools.count()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > logging.DEBUG and record.name != access_logger.name:
+            return True
+
+        return next(self.__counter) % self.__every == 0
+
+
+class _BackgroundHandler(logging.handlers.QueueHandler):
+    """
+    Queues the records as they are, they are formatted by the background thread (the queue does not leave
+    the process, unlike the records of the default `QueueHandler`).
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+class _MultiHandler(logging.Handler):
+    """
+    Hands the records to the handlers right away (without the background thread).
+    """
+
+    def __init__(self, handlers):
+        super().__init__()
+        self.__handlers = handlers
+
+    def emit(self, record: logging.LogRecord):
+        for handler in self.__handlers:
+            handler.handle(record)
+
+    def flush(self):
+        for handler in self.__handlers:
+            handler.flush()
+
+
+class _AccessFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        return json.dumps({
+            'time': self.formatTime(record, '%Y-%m-%dT%H:%M:%S'), 'pid': record.process, **record.access
+        }, separators=(',', ':'))
+
+
+def setup(level='info', sample=1, access_log: str | None = None, background=True):
+    """
+    Start the background writer of the process. Called again in a forked process, the writer thread of the parent
+    does not exist there.
+    :param level: One of `LEVELS`.
+    :param sample: Log only every n-th debug/access record.
+    :param access_log: Path of the access log, '-' for stdout, None to disable it.
+    :param background: Whether to write the records by a background thread, or right away (a process that forks
+    must not have the thread, a forked process could inherit the output locked by it).
+    :return:
+    """
+    global _listener, _handler, _pid
+
+    if _pid == os.getpid():
+        shutdown()
+    if _handler is not None:
+        logger.removeHandler(_handler)
+
+    console = logging.StreamHandler(sys.stdout)
+    console.setFormatter(logging.Formatter('%(message)s'))
+    console.addFilter(lambda record: record.name != access_logger.name)
+    handlers = [console]
+
+    if access_log is not None:
+        access = logging.StreamHandler(sys.stdout) if access_log == '-' else logging.FileHandler(access_log)
+        access.setFormatter(_AccessFormatter())
+        access.addFilter(lambda record: record.name == access_logger.name)
+        handlers.append(access)
+
+    if background:
+        records = queue.SimpleQueue()
+        _handler = _BackgroundHandler(records)
+        _listener = logging.handlers.QueueListener(records, *handlers)
+        _listener.start()
+    else:
+        _handler = _MultiHandler(handlers)
+
+    if sample > 1:
+        _handler.addFilter(_SampleFilter(sample))
+
+    logger.addHandler(_handler)
+    logger.setLevel(LEVELS[level])
+    logger.propagate = False
+    # the access log does not depend on the level of the other records
+    access_logger.setLevel(logging.INFO if access_log is not None else logging.CRITICAL + 1)
+    _pid = os.getpid()
+
+
+def shutdown():
+    """
+    Write the queued records and stop the background writer.
+    :return:
+    """
+    global _listener
+
+    if _listener is not None and _pid == os.getpid():
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.flush()
+    elif _handler is not None:
+        _handler.flush()
+    _listener = None
+
+
+def access(record: Dict[str, object]):
+    """
+    Log a finished transfer into the access log.
+    :param record: Fields of the JSON line.
+    :return:
+    """
+    if access_logger.isEnabledFor(logging.INFO):
+        access_logger.info('', extra={'access': record})
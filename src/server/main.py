@@ -1,16 +1,41 @@
 #! /usr/bin/env python3
-import signal, sys, os
+import signal, sys, os, tempfile
 
 dir = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(os.path.abspath(os.path.join(dir, '..')))
 
 import lib.params as params
+import log
+from log import logger
 from socket_server import SocketServer
 from file_server import FileServer
+from async_file_server import AsyncFileServer
+from prefork import Supervisor
+from disk_io import DiskExecutor
+from dedup import HashIndex
+from file_cache import FileCache
+from catalog import Catalog
+from profiling import Profiler
 
 flags = (
     (('-l', '--listenPort'), 'listenPort', 50001),
     (('-c', '--connections'), 'connections', 100),
+    (('-p', '--poller'), 'poller', 'auto'),  # auto/epoll/poll/select
+    (('-b', '--minBuffer'), 'minBuffer', 1024),  # read/send chunk size for headers
+    (('-B', '--maxBuffer'), 'maxBuffer', 1 << 20),  # chunk sizes grow up to this for bulk payload
+    (('-w', '--workers'), 'workers', 1),  # number of pre-forked worker processes
+    (('-r', '--reusePort'), 'reusePort', False),  # workers bind their own sockets with SO_REUSEPORT
+    (('-e', '--engine'), 'engine', 'select'),  # select (SocketServer/FileServer) or asyncio (AsyncFileServer)
+    (('-t', '--diskThreads'), 'diskThreads', '0'),  # threads doing the disk I/O, 0 = in the event loop
+    (('-d', '--dedup'), 'dedup', False),  # link/copy uploads with a known hash from files with the same content
+    (('-m', '--cacheBytes'), 'cacheBytes', '0'),  # budget of the in-memory cache of small downloaded files, 0 = off
+    (('-M', '--cacheFileLen'), 'cacheFileLen', 1 << 20),  # only the files up to this size are cached
+    (('-D', '--downloadMode'), 'downloadMode', 'sendfile'),  # sendfile or mmap (shared mappings of the files)
+    (('-L', '--catalog'), 'catalog', False),  # keep a catalog of the files, clients can list them
+    (('-v', '--logLevel'), 'logLevel', 'info'),  # debug (per-transfer lines)/info/warning/error
+    (('-S', '--logSample'), 'logSample', '1'),  # log only every n-th debug/access line
+    (('-A', '--accessLog'), 'accessLog', 'none'),  # path of the access log (a JSON line per transfer), - = stdout
+    (('-P', '--profileDir'), 'profileDir', 'auto'),  # output of SIGUSR1 (cProfile)/SIGUSR2 (tracemalloc), auto = tmp
     (('-?', '--usage'), "usage", False),  # boolean (set if present)
 )
 
@@ -19,17 +44,138 @@ if param_map['usage']:
     params.usage()
     sys.exit(0)
 
-socket_server = SocketServer(param_map['listenPort'], param_map['connections'])
-file_server = FileServer(socket_server, "../../data/server", "little")
+min_buffer, max_buffer = int(param_map['minBuffer']), int(param_map['maxBuffer'])
+workers, reuse_port = int(param_map['workers']), param_map['reusePort']
+disk_threads = int(param_map['diskThreads'])
+cache_bytes, cache_file_len = int(param_map['cacheBytes']), int(param_map['cacheFileLen'])
+access_log = None if param_map['accessLog'] == 'none' else param_map['accessLog']
+profile_dir = param_map['profileDir']
+if profile_dir == 'auto':
+    profile_dir = os.path.join(tempfile.gettempdir(), 'file-server-profiles')
+
+if param_map['logLevel'] not in log.LEVELS:
+    print('Unknown log level "%s"' % param_map['logLevel'])
+    params.usage()
+
+# the supervisor writes the lines right away, a background thread must not run while it forks
+log.setup(param_map['logLevel'], int(param_map['logSample']), access_log, background=workers <= 1)
+
+if param_map['engine'] not in ('select', 'asyncio'):
+    print('Unknown engine "%s"' % param_map['engine'])
+    params.usage()
+
+if param_map['downloadMode'] not in ('sendfile', 'mmap'):
+    print('Unknown download mode "%s"' % param_map['downloadMode'])
+    params.usage()
+
+if param_map['dedup'] and param_map['engine'] != 'select':
+    print('Deduplication is not supported by the "%s" engine' % param_map['engine'])
+    params.usage()
+
+if param_map['catalog'] and param_map['engine'] != 'select':
+    print('The catalog is not supported by the "%s" engine' % param_map['engine'])
+    params.usage()
+
+dedup_index = None
+file_cache = None
+if param_map['dedup']:
+    # indexed before forking, the workers start with the same index
+    dedup_index = HashIndex(os.path.abspath(os.path.join(dir, "../../data/server")))
+    dedup_index.scan()
+    logger.info('Indexed %d files for deduplication' % len(dedup_index))
+
+catalog = None
+if param_map['catalog']:
+    # loaded before forking, the workers start with the same catalog
+    catalog = Catalog(os.path.abspath(os.path.join(dir, "../../data/server")))
+    catalog.load()
+    logger.info('Catalog of %d files' % len(catalog))
+
+
+# SIGUSR1/SIGUSR2 toggle the profiling of the running server (of each worker)
+profiler = Profiler(profile_dir)
+
+
+def create_socket_server():
+    """
+    Bind the server socket.
+    """
+    if param_map['engine'] == 'asyncio':
+        # the asyncio engine is both the socket server and the file server
+        return AsyncFileServer(
+            int(param_map['listenPort']), int(param_map['connections']), "../../data/server", "little",
+            read_buffer_len=min_buffer, max_read_buffer_len=max_buffer, reuse_port=reuse_port
+        )
+
+    return SocketServer(
+        int(param_map['listenPort']), int(param_map['connections']), poller=param_map['poller'],
+        read_buffer_len=min_buffer, max_read_buffer_len=max_buffer, reuse_port=reuse_port
+    )
+
+
+def create_file_server(socket_server):
+    """
+    Create the file server for the given socket server, in the process that runs it (the disk executor's threads
+    and wakeup pipe must not be shared by pre-forked workers).
+    """
+    global file_cache
+    if param_map['engine'] == 'asyncio':
+        return socket_server
+
+    file_cache = FileCache(cache_bytes, cache_file_len) if cache_bytes > 0 else None
+    return FileServer(
+        socket_server, "../../data/server", "little",
+        download_window=min_buffer, max_download_window=max_buffer,
+        disk=DiskExecutor(socket_server, disk_threads) if disk_threads > 0 else None, dedup_index=dedup_index,
+        cache=file_cache, download_mode=param_map['downloadMode'], catalog=catalog
+    )
 
 
 def signal_handler(sig, frame):
     global socket_server
-    print('Closing socket server and exitting...')
-    socket_server.close()
+    logger.info('Closing socket server and exitting...')
+    profiler.stop()
+    # the workers sharing the supervisor's socket must not shut it down for each other
+    socket_server.close(shutdown=workers <= 1 or reuse_port)
+    if dedup_index is not None:
+        dedup_index.save()
+    if catalog is not None:
+        catalog.save()
+    if file_cache is not None:
+        logger.info('File cache: %s' % file_cache.stats())
+    log.shutdown()
     sys.exit(0)
 
 
-signal.signal(signal.SIGINT, signal_handler)
+def run_worker(worker_id):
+    """
+    Run the event loop of a pre-forked worker, with its own socket or with the socket bound by the supervisor.
+    """
+    global socket_server
+    # the worker writes its lines by its own background thread
+    log.setup(param_map['logLevel'], int(param_map['logSample']), access_log)
+    try:
+        socket_server = create_socket_server() if reuse_port else shared_server
+        file_server = create_file_server(socket_server)
+
+        signal.signal(signal.SIGINT, signal_handler)
+        signal.signal(signal.SIGTERM, signal_handler)
+        profiler.install()
+        file_server.listen()
+    finally:
+        log.shutdown()
+
+
+if workers <= 1:
+    socket_server = create_socket_server()
+    file_server = create_file_server(socket_server)
+    signal.signal(signal.SIGINT, signal_handler)
+    profiler.install()
+    file_server.listen()
+else:
+    # bind the shared socket before forking, so the workers accept connections from the same socket
+    shared_server = None if reuse_port else create_socket_server()
+    Supervisor(workers, run_worker, forward_signals=(Profiler.CPU_SIGNAL, Profiler.MEMORY_SIGNAL)).run()
 
-file_server.listen()
+    if shared_server:
+        shared_server.close()
@@ -0,0 +1,141 @@
+import mmap
+import os
+import threading
+from typing import Dict, Tuple, TypedDict
+
+
+class SharedMapping:
+    """
+    A read-only mapping of a file, shared by the downloads of the file.
+    Attributes:
+        path: Absolute path of the file.
+        size: Size of the mapped file.
+        view: The content of the file, slices of it are sent without copying.
+    """
+
+    def __init__(self, path: str, st: os.stat_result, fd: int):
+        self.path = path
+        self.size = st.st_size
+        self.signature = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+        self.refs = 1
+        self.__mmap = mmap.mmap(fd, st.st_size, prot=mmap.PROT_READ)
+        self.view = memoryview(self.__mmap)
+
+    @property
+    def inode(self) -> Tuple[int, int]:
+        return self.signature[0], self.signature[1]
+
+    def close(self):
+        """
+        Unmap the file, unless slices of it are still queued to be sent (it is unmapped once they are gone then).
+        """
+        try:
+            self.view.release()
+            self.__mmap.close()
+        except BufferError:
+            pass
+
+
+class MappingStats(TypedDict):
+    """
+    Attributes:
+        mappings: Number of mapped files.
+        refs: Number of downloads using the mappings.
+        bytes: Total size of the mapped files.
+    """
+    mappings: int
+    refs: int
+    bytes: int
+
+
+class MappingPool:
+    """
+    Memory maps the downloaded files, concurrent downloads of the same (unchanged) file share a single mapping.
+    A mapping is reference counted and unmapped once the last download releases it.
+
+    A mapped file must not be truncated in place, reading the truncated pages would crash the server: the server
+    gives a mapped file a new inode before writing into it (see `is_mapped`). Safe to use from the disk executor's
+    threads.
+    """
+
+    def __init__(self):
+        # __by_path[path] = the mapping of the current version of the file
+        self.__by_path: Dict[str, SharedMapping] = {}
+        # __inodes[(dev, ino)] = number of mappings of the inode (including old versions of the files)
+        self.__inodes: Dict[Tuple[int, int], int] = {}
+        self.__mappings: Dict[int, SharedMapping] = {}
+        self.__lock = threading.Lock()
+
+    def acquire(self, path: str) -> SharedMapping | None:
+        """
+        Get a mapping of the file, the one already used by other downloads if the file has not changed.
+        :param path: Absolute path of the file.
+        :return: The mapping, None if the file is empty (it can not be mapped).
+        :raise OSError: If the file can not be opened.
+        """
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            st = os.fstat(fd)
+            if st.st_size == 0:
+                return None
+
+            signature = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+            with self.__lock:
+                mapping = self.__by_path.get(path, None)
+                if mapping is not None and mapping.signature == signature:
+                    mapping.refs += 1
+                    return mapping
+
+            mapping = SharedMapping(path, st, fd)
+        finally:
+            os.close(fd)  # the mapping stays valid without the descriptor
+
+        with self.__lock:
+            self.__by_path[path] = mapping
+            self.__mappings[id(mapping)] = mapping
+            self.__inodes[mapping.inode] = self.__inodes.get(mapping.inode, 0) + 1
+
+        return mapping
+
+    def release(self, mapping: SharedMapping):
+        """
+        A download does not use the mapping anymore.
+        :param mapping:
+        :return:
+        """
+        with self.__lock:
+            mapping.refs -= 1
+            if mapping.refs > 0:
+                return
+
+            del self.__mappings[id(mapping)]
+            if self.__by_path.get(mapping.path, None) is mapping:
+                del self.__by_path[mapping.path]
+
+            self.__inodes[mapping.inode] -= 1
+            if self.__inodes[mapping.inode] == 0:
+                del self.__inodes[mapping.inode]
+
+        mapping.close()
+
+    def is_mapped(self, path: str) -> bool:
+        """
+        Whether the file (its inode) is mapped by a download.
+        :param path: Absolute path of the file.
+        :return:
+        """
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return False
+
+        with self.__lock:
+            return (st.st_dev, st.st_ino) in self.__inodes
+
+    def stats(self) -> MappingStats:
+        with self.__lock:
+            return {
+                'mappings': len(self.__mappings),
+                'refs': sum(mapping.refs for mapping in self.__mappings.values()),
+                'bytes': sum(mapping.size for mapping in self.__mappings.values()),
+            }
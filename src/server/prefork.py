@@ -0,0 +1,136 @@
+import os
+import signal
+import sys
+import time
+import traceback
+from typing import Callable, Dict, Iterable
+
+from log import logger
+
+
+class Supervisor:
+    """
+    Pre-forks worker processes (each running its own event loop) and restarts the ones that crash.
+    The workers either share a socket bound before forking or bind their own sockets with SO_REUSEPORT.
+    """
+
+    def __init__(self, workers: int, run_worker: Callable[[int], None], restart_delay=1.0,
+                 forward_signals: Iterable[int] = ()):
+        """
+        :param workers: Number of worker processes.
+        :param run_worker: Called in each forked worker with the worker's id (0..workers-1), should not return until
+        the worker is done.
+        :param restart_delay: Min number of seconds between starts of the same worker, so a worker that crashes right
+        away does not spin.
+        :param forward_signals: Signals received by the supervisor that are sent to all the workers (they are ignored
+        by a worker until it sets its own handler).
+        """
+        self.__workers = workers
+        self.__run_worker = run_worker
+        self.__restart_delay = restart_delay
+        self.__forward_signals = tuple(forward_signals)
+
+        # __pids[pid] = id of the worker running in the process
+        self.__pids: Dict[int, int] = {}
+        # __started[worker_id] = when the worker has been (re)started the last time
+        self.__started: Dict[int, float] = {}
+        self.__stopping = False
+
+    def run(self):
+        """
+        Start the workers and supervise them until `stop` is called (or SIGINT/SIGTERM is received).
+        :return:
+        """
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGTERM, self.stop)
+        for sig in self.__forward_signals:
+            signal.signal(sig, self.__forward)
+
+        for worker_id in range(self.__workers):
+            self.__spawn(worker_id)
+
+        logger.info('[supervisor] started %d workers', self.__workers)
+
+        while self.__pids:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+
+            worker_id = self.__pids.pop(pid, None)
+            if worker_id is None or self.__stopping:
+                continue
+
+            if os.waitstatus_to_exitcode(status) == 0:
+                logger.info('[supervisor] worker %d (pid %d) has exited', worker_id, pid)
+                continue
+
+            logger.warning('[supervisor] worker %d (pid %d) has crashed (status %d), restarting...',
+                           worker_id, pid, os.waitstatus_to_exitcode(status))
+
+            delay = self.__started[worker_id] + self.__restart_delay - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+            if not self.__stopping:
+                self.__spawn(worker_id)
+
+        logger.info('[supervisor] all workers have exited')
+
+    def stop(self, sig=None, frame=None):
+        """
+        Stop all the workers (with SIGTERM), `run` returns once they have exited.
+        :return:
+        """
+        if self.__stopping:
+            return
+
+        logger.info('[supervisor] stopping workers...')
+        self.__stopping = True
+        for pid in self.__pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def __forward(self, sig, frame):
+        """
+        Send a received signal to all the workers.
+        """
+        for pid in self.__pids:
+            try:
+                os.kill(pid, sig)
+            except ProcessLookupError:
+                pass
+
+    def __spawn(self, worker_id: int):
+        """
+        Fork a worker process.
+        :param worker_id:
+        :return:
+        """
+        self.__started[worker_id] = time.monotonic()
+
+        # do not let the worker inherit (and print again) the supervisor's buffered output
+        sys.stdout.flush()
+        pid = os.fork()
+        if pid > 0:
+            self.__pids[pid] = worker_id
+            return
+
+        # worker process, never return to the supervisor's code
+        code = 0
+        try:
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            for sig in self.__forward_signals:
+                signal.signal(sig, signal.SIG_IGN)
+            self.__run_worker(worker_id)
+        except SystemExit as e:
+            code = e.code if isinstance(e.code, int) else 0
+        except BaseException:
+            traceback.print_exc()
+            code = 1
+        finally:
+            sys.stdout.flush()
+            os._exit(code)
@@ -0,0 +1,100 @@
+import cProfile
+import io
+import os
+import pstats
+import signal
+import time
+import tracemalloc
+
+from log import logger
+
+
+class Profiler:
+    """
+    On-demand profiling of a running server: SIGUSR1 starts/stops `cProfile`, SIGUSR2 starts/stops `tracemalloc`.
+    When a session is stopped, its data is written into the output folder and the top entries are logged.
+
+    The signal handlers run in the main thread (the event loop), only its calls are profiled, not the disk
+    executor's threads. Each pre-forked worker has its own profiler, the supervisor forwards the signals to the
+    workers (see `prefork.Supervisor`).
+    """
+    CPU_SIGNAL = signal.SIGUSR1
+    MEMORY_SIGNAL = signal.SIGUSR2
+
+    def __init__(self, out_dir: str, top=20):
+        """
+        :param out_dir: Folder of the profiles (`.prof`, see `pstats`) and allocation snapshots (`.tracemalloc`, see
+        `tracemalloc.Snapshot.load`).
+        :param top: Number of the entries logged when a session is stopped.
+        """
+        self.__out_dir = out_dir
+        self.__top = top
+        self.__profile: cProfile.Profile | None = None
+
+    def install(self):
+        """
+        Handle the signals in this process.
+        :return:
+        """
+        signal.signal(self.CPU_SIGNAL, lambda sig, frame: self.toggle_cpu())
+        signal.signal(self.MEMORY_SIGNAL, lambda sig, frame: self.toggle_memory())
+
+    def toggle_cpu(self):
+        """
+        Start profiling the calls, or stop it and write the profile.
+        :return:
+        """
+        if self.__profile is None:
+            self.__profile = cProfile.Profile()
+            self.__profile.enable()
+            logger.info('[profiler] CPU profiling started (pid %d)', os.getpid())
+            return
+
+        profile, self.__profile = self.__profile, None
+        profile.disable()
+
+        path = self.__path('prof')
+        profile.dump_stats(path)
+
+        out = io.StringIO()
+        pstats.Stats(profile, stream=out).sort_stats(pstats.SortKey.CUMULATIVE).print_stats(self.__top)
+        logger.info('[profiler] CPU profile written to %s\n%s', path, out.getvalue().strip())
+
+    def toggle_memory(self):
+        """
+        Start tracing the allocations, or stop it and write a snapshot of the traced allocations.
+        :return:
+        """
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(16)  # frames per allocation, enough to get from the buffers to the handlers
+            logger.info('[profiler] allocation tracing started (pid %d)', os.getpid())
+            return
+
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        path = self.__path('tracemalloc')
+        snapshot.dump(path)
+
+        stats = snapshot.filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, '<frozen importlib._bootstrap>')
+        )).statistics('lineno')
+        logger.info('[profiler] allocation snapshot written to %s (current %dB, peak %dB)\n%s',
+                    path, current, peak, '\n'.join(str(stat) for stat in stats[:self.__top]))
+
+    def stop(self):
+        """
+        Stop the running sessions and write their data (the server is closing).
+        :return:
+        """
+        if self.__profile is not None:
+            self.toggle_cpu()
+        if tracemalloc.is_tracing():
+            self.toggle_memory()
+
+    def __path(self, extension: str) -> str:
+        os.makedirs(self.__out_dir, exist_ok=True)
+        return os.path.join(
+            self.__out_dir, 'server-%d-%s.%s' % (os.getpid(), time.strftime('%Y%m%d-%H%M%S'), extension)
+        )
@@ -0,0 +1,29 @@
+"""
+Names of the server's own files in the data folder (the hash index, the catalog snapshot and journal, and the
+temporary files).
+The clients can not upload, download or list them, so they can not read or forge the server's state.
+"""
+import os
+import re
+
+# folder of the server's state in the data folder, writing the state does not change the mtime of the data folder
+# itself (see catalog)
+STATE_FOLDER = '.server'
+
+HASH_INDEX_FNAME = os.path.join(STATE_FOLDER, 'hash-index.json')
+CATALOG_FNAME = os.path.join(STATE_FOLDER, 'catalog.json')
+CATALOG_JOURNAL_FNAME = os.path.join(STATE_FOLDER, 'catalog.journal')
+
+# the temporary files next to the clients' files: <file>.dedup-tmp (see dedup), <file>.<pid>-<port>.delta-tmp
+# (see file_server)
+TMP_NAME = re.compile(r'(\.dedup-tmp|\.\d+-\d+\.delta-tmp)$')
+
+
+def is_reserved(fname: str) -> bool:
+    """
+    Whether a file is an internal file of the server.
+    :param fname: Path of the file, relative to the data folder.
+    :return:
+    """
+    parts = os.path.normpath(fname).split(os.sep)
+    return STATE_FOLDER in parts or TMP_NAME.search(parts[-1]) is not None
@@ -1,5 +1,91 @@
-import socket, select
-from typing import List
+import socket, selectors, time
+from collections import deque
+from typing import Callable, Dict, Deque, List, TypedDict, Union
+from adaptive import AdaptiveSize
+from zero_copy import FileSegment, send_segment
+from log import logger
+
+# available poller backends, `auto` picks the most efficient one of the platform (epoll/kqueue/devpoll/poll/select)
+POLLERS = {'auto': selectors.DefaultSelector, 'select': selectors.SelectSelector}
+if hasattr(selectors, 'PollSelector'):
+    POLLERS['poll'] = selectors.PollSelector
+if hasattr(selectors, 'EpollSelector'):
+    POLLERS['epoll'] = selectors.EpollSelector
+if hasattr(selectors, 'KqueueSelector'):
+    POLLERS['kqueue'] = selectors.KqueueSelector
+
+
+class Connection(TypedDict):
+    """
+    Represents a connected client.
+    Attributes:
+        fd: The client socket.
+        addr: (addr, port) of the client, the peer may not be queryable once it has reset.
+        out_queue: Data waiting to be sent to the client.
+        reading: Whether the client should be polled for reads (false if paused or being disconnected).
+        writing: Whether the client should be polled for writability (has pending output or waits for `drain`).
+        closing: Whether the client was disconnected by the server, but still has pending output.
+        broken: Whether sending to the client has failed, further output is dropped.
+        events: The events the client is currently registered for in the poller (0 if not registered).
+        buffer: Preallocated buffer the data is received into.
+        view: memoryview of the buffer, the `data` event gets slices of it.
+        read_size: Number of bytes read at once, adapted to the throughput of the client.
+        read_handler: Custom handler reading the socket instead of the `data` event, see `set_read_handler`.
+        connected_at: time.monotonic() of the connection.
+        bytes_in: Number of bytes received from the client.
+        bytes_out: Number of bytes sent to the client.
+    """
+    fd: socket.socket
+    addr: tuple
+    out_queue: Deque[Union[memoryview, FileSegment]]
+    reading: bool
+    writing: bool
+    closing: bool
+    broken: bool
+    events: int
+    buffer: bytearray
+    view: memoryview
+    read_size: AdaptiveSize
+    read_handler: Callable[[socket.socket], int] | None
+    connected_at: float
+    bytes_in: int
+    bytes_out: int
+
+
+class ConnectionStats(TypedDict):
+    """
+    Counters of a connected client.
+    Attributes:
+        port: Port of the client.
+        age: Number of seconds since the client has connected.
+        bytes_in: Number of bytes received from the client.
+        bytes_out: Number of bytes sent to the client.
+        throughput: Bytes per second in both directions, over the whole connection.
+        queued: Number of bytes waiting to be sent to the client.
+    """
+    port: int
+    age: float
+    bytes_in: int
+    bytes_out: int
+    throughput: float
+    queued: int
+
+
+class ServerStats(TypedDict):
+    """
+    Counters of the socket server.
+    Attributes:
+        accepted: Number of connections accepted since the start.
+        open: Number of connected clients.
+        bytes_in: Number of bytes received from all the clients since the start.
+        bytes_out: Number of bytes sent to all the clients since the start.
+        connections: Counters of each connected client.
+    """
+    accepted: int
+    open: int
+    bytes_in: int
+    bytes_out: int
+    connections: List[ConnectionStats]
 
 
 class SocketServer:
@@ -7,22 +93,50 @@ class SocketServer:
     A wrapper class around a socket server. Handles read/write events and new connections.
     """
 
-    def __init__(self, port, max_conns, read_buffer_len=1024):
+    def __init__(self, port, max_conns, read_buffer_len=1024, poller='auto', max_read_buffer_len=None,
+                 reuse_port=False):
+        """
+        :param port:
+        :param max_conns: The backlog of the listening socket.
+        :param read_buffer_len: Number of bytes read from a client at once, while it sends small messages.
+        :param poller: The poller backend, one of `POLLERS` (`select` is limited to FD_SETSIZE descriptors).
+        :param max_read_buffer_len: Max number of bytes read from a client at once, the read size grows up to it
+        while the client keeps filling the buffer (bulk data). Defaults to `read_buffer_len`.
+        :param reuse_port: Set SO_REUSEPORT, so multiple processes can bind their own socket to the port and the
+        kernel balances the connections between them.
+        """
+        if poller not in POLLERS:
+            raise ValueError("Unsupported poller \"%s\", available: %s" % (poller, ', '.join(POLLERS)))
+
         self.__read_buffer_len = read_buffer_len
+        self.__max_read_buffer_len = max_read_buffer_len or read_buffer_len
         self.__max_conns = max_conns
         self.__port = port
+        self.__poller = poller
 
         self.__socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.__socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            self.__socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.__socket.bind(('', self.__port))
+        self.__socket.setblocking(False)
 
-        self.__readfds: List[socket.socket] = [self.__socket]
+        # __conns[fileno] = the connected client, the selector is created by `start` (so it is not shared by forks)
+        self.__conns: Dict[int, Connection] = {}
+        # __readers[fd] = callback for a non-client file descriptor polled for reads, see `add_reader`
+        self.__readers: Dict[int, Callable[[], None]] = {}
+        self.__selector: selectors.BaseSelector | None = None
         self.__is_listening = False
+        # totals since the start, see `stats`
+        self.__accepted = 0
+        self.__bytes_in = 0
+        self.__bytes_out = 0
 
         self.__events = {
             'connect': None,
             'disconnect': None,
-            'data': None
+            'data': None,
+            'drain': None
         }
 
     def listen(self):
@@ -31,47 +145,219 @@ class SocketServer:
         :return:
         """
         if self.__is_listening:
-            print('[server] warning: already listening!')
+            logger.warning('[server] already listening!')
             return
 
+        self.start()
+
+        while True:
+            self.poll()
+
+    def start(self):
+        """
+        Start listening for new connections without entering the event loop, the events are then handled by
+        calling `poll`.
+        :return:
+        """
         self.__socket.listen(self.__max_conns)
+        self.__selector = POLLERS[self.__poller]()
+        self.__selector.register(self.__socket, selectors.EVENT_READ)
+        for fd, callback in self.__readers.items():
+            self.__selector.register(fd, selectors.EVENT_READ, callback)
         self.__is_listening = True
 
-        print('[server] listening on port %d...' % self.__port)
+        logger.info('[server] listening on port %d (%s)...', self.__port, type(self.__selector).__name__)
 
         if self.__events['data'] is None:
-            print('[server] warning: no data event handler set!')
+            logger.warning('[server] no data event handler set!')
 
-        while True:
-            rlist, wlist, xlist = select.select(
-                self.__readfds, [], []
-            )
-            self.__handle_select(rlist, wlist, xlist)
+    def poll(self, timeout: float | None = None):
+        """
+        Wait for the read/write events and handle them (a single iteration of the event loop).
+        :param timeout: Max number of seconds to wait, None to wait until there is an event.
+        :return:
+        """
+        self.__handle_select(self.__selector.select(timeout))
 
     def send(self, fd: socket.socket, data: bytes):
         """
-        Send all the given data to a client.
+        Queue the given data to be sent to a client. Never blocks, the data is sent as soon as the client's
+        socket becomes writable. Mutable data (e.g. a view of the received data) is copied if it can not be sent
+        right away.
         :param fd: The client socket to send data to.
         :param data: The data to send.
         :return:
         """
-        return fd.sendall(data)
+        conn = self.__conns.get(fd.fileno(), None)
+        if conn is None or conn['broken'] or len(data) == 0:
+            return  # the client is already gone
+
+        self.__enqueue(conn, memoryview(data))
+
+    def send_file(self, fd: socket.socket, file_fd: int, offset: int, count: int):
+        """
+        Queue a part of an opened file to be sent to a client. The file contents are sent directly from the page
+        cache using sendfile (where available). The file must stay open until the part has been sent.
+        :param fd: The client socket to send the file to.
+        :param file_fd: The opened file.
+        :param offset: Position in the file to start sending from.
+        :param count: Number of bytes to send.
+        :return:
+        """
+        conn = self.__conns.get(fd.fileno(), None)
+        if conn is None or conn['broken'] or count <= 0:
+            return  # the client is already gone
+
+        self.__enqueue(conn, FileSegment(file_fd, offset, count))
+
+    def wait_writable(self, fd: socket.socket):
+        """
+        Emit the `drain` event for the client once all of its output has been sent and the socket is writable
+        again. Used by handlers that produce their output incrementally.
+        :param fd: The client socket.
+        :return:
+        """
+        conn = self.__conns.get(fd.fileno(), None)
+        if conn is not None and not conn['broken']:
+            conn['writing'] = True
+            self.__update_events(conn)
+
+    def pause_reading(self, fd: socket.socket):
+        """
+        Stop reading from a client, the incoming data is left in the socket until `resume_reading` is called.
+        :param fd: The client socket.
+        :return:
+        """
+        conn = self.__conns.get(fd.fileno(), None)
+        if conn is not None and not conn['broken']:
+            conn['reading'] = False
+            self.__update_events(conn)
+
+    def resume_reading(self, fd: socket.socket):
+        """
+        Resume reading from a client paused by `pause_reading`.
+        :param fd: The client socket.
+        :return:
+        """
+        conn = self.__conns.get(fd.fileno(), None)
+        if conn is not None and not conn['closing']:
+            conn['reading'] = True
+            self.__update_events(conn)
+
+    def add_reader(self, fd: int, callback: Callable[[], None]):
+        """
+        Poll a file descriptor other than a client socket (e.g. a wakeup pipe) for reads in the event loop.
+        :param fd: The file descriptor.
+        :param callback: Called (without arguments) when the file descriptor is readable.
+        :return:
+        """
+        self.__readers[fd] = callback
+        if self.__selector is not None:
+            self.__selector.register(fd, selectors.EVENT_READ, callback)
+
+    def remove_reader(self, fd: int):
+        """
+        Stop polling a file descriptor added by `add_reader`.
+        :param fd:
+        :return:
+        """
+        if self.__readers.pop(fd, None) is not None and self.__selector is not None:
+            self.__selector.unregister(fd)
+
+    def set_read_handler(self, fd: socket.socket, handler: Callable[[socket.socket], int] | None):
+        """
+        Let a custom handler read the client socket instead of receiving the data and emitting the `data` event,
+        e.g. to move the data to a file in the kernel. The handler is called with the socket when it is readable
+        and returns the number of bytes it has consumed, 0 meaning the client has disconnected.
+        :param fd: The client socket.
+        :param handler: The handler, None to restore the `data` event.
+        :return:
+        """
+        conn = self.__conns.get(fd.fileno(), None)
+        if conn is not None:
+            conn['read_handler'] = handler
+
+    def pending(self, fd: socket.socket) -> int:
+        """
+        Get the number of bytes queued for a client that have not been sent yet.
+        :param fd: The client socket.
+        :return:
+        """
+        conn = self.__conns.get(fd.fileno(), None)
+        if conn is None:
+            return 0
+
+        return sum(len(chunk) for chunk in conn['out_queue'])  # FileSegment has len() too
+
+    def stats(self) -> ServerStats:
+        """
+        Get the traffic counters of the server and of each connected client.
+        :return:
+        """
+        now = time.monotonic()
+        connections: List[ConnectionStats] = []
+        for conn in self.__conns.values():
+            age = now - conn['connected_at']
+            connections.append({
+                'port': conn['addr'][1], 'age': round(age, 3), 'bytes_in': conn['bytes_in'],
+                'bytes_out': conn['bytes_out'],
+                'throughput': round((conn['bytes_in'] + conn['bytes_out']) / age, 1) if age > 0 else 0.0,
+                'queued': sum(len(chunk) for chunk in conn['out_queue'])
+            })
+
+        return {
+            'accepted': self.__accepted, 'open': len(self.__conns), 'bytes_in': self.__bytes_in,
+            'bytes_out': self.__bytes_out, 'connections': connections
+        }
+
+    def is_open(self, fd: socket.socket) -> bool:
+        """
+        Whether the client is connected and has not been disconnected by the server.
+        :param fd: The client socket.
+        :return:
+        """
+        conn = self.__conns.get(fd.fileno(), None)
+        return conn is not None and not conn['closing']
+
+    def getpeername(self, fd: socket.socket):
+        """
+        Get the address of a connected client, works even if the client has already reset the connection.
+        :param fd: The client socket.
+        :return: (addr, port)
+        """
+        return self.__conns[fd.fileno()]['addr']
 
     def disconnect(self, fd: socket.socket):
         """
-        Disconnect a client.
+        Disconnect a client. If there is pending output for the client, stop reading from it and close the
+        socket once all the output has been sent.
         :param fd: The client socket to disconnect.
         :return:
         """
-        self.__readfds.remove(fd)
-        fd.close()
+        conn = self.__conns.get(fd.fileno(), None)
+        if conn is None:
+            return
+
+        if conn['out_queue']:
+            conn['closing'] = True
+            conn['reading'] = False
+            self.__update_events(conn)
+            return
 
-    def close(self):
+        self.__close_client(conn)
+
+    def close(self, shutdown=True):
         """
         Close the server socket.
+        :param shutdown: Shut the socket down as well, which stops accepting connections in all the processes
+        sharing the socket (pre-forked workers), not just this one.
         :return:
         """
-        self.__socket.shutdown(socket.SHUT_RDWR)
+        if shutdown:
+            try:
+                self.__socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass  # already shut down (by another process sharing the socket)
         self.__socket.close()
 
     def on(self, event, callback):
@@ -79,7 +365,9 @@ class SocketServer:
         Set an event callback. Available events are:
         - connect - called when a new client connects ((addr, port))
         - disconnect - called when a client disconnects ((addr, port))
-        - data - called when a client sends data (fd, data), receives at most `read_buffer_len` bytes
+        - data - called when a client sends data (fd, data), receives at most `max_read_buffer_len` bytes,
+          `data` is a memoryview of the client's receive buffer, it is only valid until the callback returns
+        - drain - called when the output of a client has been sent after `wait_writable` (fd)
         :param event:
         :param callback:
         :return:
@@ -88,48 +376,250 @@ class SocketServer:
 
         return self
 
-    def __handle_select(self, rlist, wlist, xlist):
+    def __handle_select(self, events):
         """
-        Handle the select call.
-        :param rlist:
-        :param wlist:
-        :param xlist:
+        Handle the events reported by the poller.
+        :param events: List of (key, mask) pairs.
         :return:
         """
-        for fd in rlist:
-            # if the fd is the server socket, accept a new connection
-            if fd is self.__socket:
+        for key, mask in events:
+            # if the fd is the server socket, accept new connections
+            if key.fileobj is self.__socket:
                 self.__handle_select_new_conn()
-            else:
-                self.__handle_select_read(fd)
+                continue
+
+            if callable(key.data):
+                key.data()  # added by `add_reader`
+                continue
+
+            conn: Connection = key.data
+            if mask & selectors.EVENT_READ and conn['reading']:
+                self.__handle_select_read(conn)
+
+            # the client could have been closed while handling the read
+            if mask & selectors.EVENT_WRITE and conn['writing']:
+                self.__handle_select_write(conn)
 
     def __handle_select_new_conn(self):
         """
-        Handle a new connection.
+        Handle new connections, accepts all the pending ones.
         :return:
         """
-        conn, addr = self.__socket.accept()
-        self.__readfds.append(conn)
+        while True:
+            try:
+                fd, addr = self.__socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return  # no more pending connections (or another process has accepted them)
+
+            fd.setblocking(False)
+            buffer = bytearray(self.__read_buffer_len)
+            conn: Connection = {
+                'fd': fd, 'addr': addr, 'out_queue': deque(),
+                'reading': True, 'writing': False, 'closing': False, 'broken': False,
+                'events': 0, 'buffer': buffer, 'view': memoryview(buffer),
+                'read_size': AdaptiveSize(self.__read_buffer_len, self.__max_read_buffer_len),
+                'read_handler': None, 'connected_at': time.monotonic(), 'bytes_in': 0, 'bytes_out': 0
+            }
+            self.__conns[fd.fileno()] = conn
+            self.__accepted += 1
+            self.__update_events(conn)
 
-        if self.__events['connect']:
-            self.__events['connect'](addr)
+            if self.__events['connect']:
+                self.__events['connect'](addr)
 
-    def __handle_select_read(self, fd: socket.socket):
+    def __handle_select_read(self, conn: Connection):
         """
         Handle a read event.
-        :param fd: The file descriptor to read from.
+        :param conn: The client to read from.
         :return:
         """
-        addr, port = fd.getpeername()
+        fd = conn['fd']
+        try:
+            if conn['read_handler']:
+                received = conn['read_handler'](fd)
+                if received == 0:
+                    self.__handle_disconnect(conn)
+                self.__count_in(conn, received)
+                return
 
-        data = fd.recv(self.__read_buffer_len)
+            received = fd.recv_into(conn['buffer'], conn['read_size'].size)
+        except BlockingIOError:
+            return
+        except OSError:
+            received = 0  # connection reset, handle it as a disconnect
 
-        if len(data) == 0:
-            self.__readfds.remove(fd)
-            fd.close()
-            if self.__events['disconnect']:
-                self.__events['disconnect']((addr, port))
+        if received == 0:
+            self.__handle_disconnect(conn)
             return
 
+        self.__count_in(conn, received)
         if self.__events['data']:
-            self.__events['data'](fd, data)
+            self.__events['data'](fd, conn['view'][:received])
+
+        conn['read_size'].observe(received)
+        self.__resize_buffer(conn)
+
+    def __resize_buffer(self, conn: Connection):
+        """
+        Reallocate the receive buffer of a client if it is too small for the current read size, or if it is much
+        larger than needed (so idle clients do not hold large buffers).
+        :param conn:
+        :return:
+        """
+        size = conn['read_size'].size
+        if size > len(conn['buffer']) or size < len(conn['buffer']) // 4:
+            conn['buffer'] = bytearray(size)
+            conn['view'] = memoryview(conn['buffer'])
+
+    def __handle_select_write(self, conn: Connection):
+        """
+        Handle a write event, send as much of the pending output as the socket accepts.
+        :param conn: The client to write to.
+        :return:
+        """
+        if not self.__flush(conn) or conn['broken'] or conn['fd'].fileno() not in self.__conns:
+            return
+
+        conn['writing'] = False
+        self.__update_events(conn)
+
+        if self.__events['drain']:
+            self.__events['drain'](conn['fd'])
+
+    def __enqueue(self, conn: Connection, chunk: Union[memoryview, FileSegment]):
+        """
+        Append a chunk to the output queue of a client.
+        :param conn:
+        :param chunk:
+        :return:
+        """
+        queue = conn['out_queue']
+        queue.append(chunk)
+        if len(queue) == 1:
+            # the queue was empty, try to send right away and poll for writability only if something remains
+            self.__flush(conn)
+            if queue and not conn['broken'] and not conn['writing']:
+                conn['writing'] = True
+                self.__update_events(conn)
+
+        if queue and isinstance(queue[-1], memoryview) and not queue[-1].readonly:
+            # the caller may reuse the underlying buffer (e.g. the receive buffer) once we return
+            queue[-1] = memoryview(bytes(queue[-1]))
+
+    def __flush(self, conn: Connection) -> bool:
+        """
+        Send the queued output of a client until the queue is empty or the socket would block.
+        :param conn:
+        :return: Whether the whole queue has been sent.
+        """
+        fd = conn['fd']
+        queue = conn['out_queue']
+        while queue:
+            chunk = queue[0]
+            try:
+                if isinstance(chunk, FileSegment):
+                    self.__count_out(conn, send_segment(fd, chunk))  # advances the segment itself
+                    if chunk.count > 0:
+                        continue  # until the socket would block
+
+                    queue.popleft()
+                    continue
+
+                sent = fd.send(chunk)
+            except BlockingIOError:
+                return False
+            except OSError:
+                self.__handle_send_error(conn)
+                return True
+
+            self.__count_out(conn, sent)
+            if sent < len(chunk):
+                queue[0] = chunk[sent:]
+                return False
+
+            queue.popleft()
+
+        if conn['closing']:
+            self.__close_client(conn)
+
+        return True
+
+    def __count_in(self, conn: Connection, received: int):
+        conn['bytes_in'] += received
+        self.__bytes_in += received
+
+    def __count_out(self, conn: Connection, sent: int):
+        conn['bytes_out'] += sent
+        self.__bytes_out += sent
+
+    def __handle_send_error(self, conn: Connection):
+        """
+        The client is gone (or the file being sent to it can not be read), there is no point in sending the rest of
+        its output. Drop it and shut the socket down, so the disconnect itself is picked up (and reported) by
+        the next read from the socket.
+        :param conn:
+        :return:
+        """
+        conn['out_queue'].clear()
+        conn['broken'] = True
+        conn['writing'] = False
+        try:
+            conn['fd'].shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass  # not connected anymore
+
+        if conn['closing']:
+            self.__close_client(conn)
+        else:
+            conn['reading'] = True
+            self.__update_events(conn)
+
+    def __handle_disconnect(self, conn: Connection):
+        """
+        Close a client that has disconnected (or failed) and notify the handler.
+        :param conn:
+        :return:
+        """
+        closed_by_server = conn['closing']
+        self.__close_client(conn)
+
+        if not closed_by_server and self.__events['disconnect']:
+            self.__events['disconnect'](conn['addr'])
+
+    def __update_events(self, conn: Connection):
+        """
+        (Re-)register the client in the poller for the events it is interested in.
+        :param conn:
+        :return:
+        """
+        events = (selectors.EVENT_READ if conn['reading'] else 0) | (selectors.EVENT_WRITE if conn['writing'] else 0)
+        if events == conn['events']:
+            return
+
+        if conn['events'] == 0:
+            self.__selector.register(conn['fd'], events, conn)
+        elif events == 0:
+            self.__selector.unregister(conn['fd'])
+        else:
+            self.__selector.modify(conn['fd'], events, conn)
+
+        conn['events'] = events
+
+    def __close_client(self, conn: Connection):
+        """
+        Forget all the state of a client and close its socket.
+        :param conn:
+        :return:
+        """
+        fd = conn['fd']
+        if self.__conns.pop(fd.fileno(), None) is None:
+            return  # already closed
+
+        if conn['events'] != 0:
+            self.__selector.unregister(fd)
+            conn['events'] = 0
+
+        conn['out_queue'].clear()
+        conn['reading'] = conn['writing'] = False
+        conn['read_handler'] = None
+        fd.close()
@@ -0,0 +1,115 @@
+import time
+from collections import deque
+from typing import Deque, Dict, List, TypedDict
+
+
+class DurationStats(TypedDict):
+    """
+    Durations (in seconds) of the transfers of an action, the percentiles are over the recent transfers.
+    """
+    mean: float
+    p50: float
+    p90: float
+    p99: float
+    max: float
+
+
+class ActionStats(TypedDict):
+    """
+    Counters of the transfers of an action.
+    Attributes:
+        completed: Number of transfers that have completed.
+        failed: Number of transfers that have ended with an error or a disconnect.
+        duration: Durations of the completed transfers.
+    """
+    completed: int
+    failed: int
+    duration: DurationStats
+
+
+class ActiveTransfer(TypedDict):
+    """
+    A transfer in progress.
+    Attributes:
+        port: Port of the client.
+        action: See `file_server.TransferState`.
+        fname: The name of the file, '' until read (or for the actions without a single file).
+        fsize: Size of the file, 0 until read.
+        fpos: Position in the file.
+        elapsed: Number of seconds since the request.
+    """
+    port: int
+    action: str
+    fname: str
+    fsize: int
+    fpos: int
+    elapsed: float
+
+
+class TransferStats:
+    """
+    Counts the transfers of the file server and measures their durations.
+    """
+
+    def __init__(self, window=1024):
+        """
+        :param window: Number of recent transfers of each action the percentiles are computed over.
+        """
+        self.__window = window
+        self.__started_at = time.monotonic()
+        # __actions[action] = (counters, recent durations) of the finished transfers of the action
+        self.__actions: Dict[str, Dict[str, float]] = {}
+        self.__recent: Dict[str, Deque[float]] = {}
+
+    @property
+    def uptime(self) -> float:
+        return time.monotonic() - self.__started_at
+
+    def finish(self, action: str, duration: float, ok: bool):
+        """
+        Count a finished transfer.
+        :param action:
+        :param duration: Number of seconds since the request.
+        :param ok: Whether the transfer has completed, or has failed.
+        :return:
+        """
+        counters = self.__actions.setdefault(action, {'completed': 0, 'failed': 0, 'total': 0.0, 'max': 0.0})
+        if not ok:
+            counters['failed'] += 1
+            return
+
+        counters['completed'] += 1
+        counters['total'] += duration
+        counters['max'] = max(counters['max'], duration)
+        self.__recent.setdefault(action, deque(maxlen=self.__window)).append(duration)
+
+    def snapshot(self) -> Dict[str, ActionStats]:
+        """
+        Get the counters of each action.
+        :return:
+        """
+        snapshot = {}
+        for action, counters in self.__actions.items():
+            recent = sorted(self.__recent.get(action, ()))
+            snapshot[action] = {
+                'completed': counters['completed'], 'failed': counters['failed'],
+                'duration': {
+                    'mean': round(counters['total'] / counters['completed'], 6) if counters['completed'] else 0.0,
+                    'p50': self.__percentile(recent, 0.5), 'p90': self.__percentile(recent, 0.9),
+                    'p99': self.__percentile(recent, 0.99), 'max': round(counters['max'], 6)
+                }
+            }
+
+        return snapshot
+
+    @staticmethod
+    def __percentile(values: List[float], q: float) -> float:
+        """
+        :param values: Sorted values.
+        :param q:
+        :return: The value at the q-quantile (nearest rank), 0 if there are no values.
+        """
+        if not values:
+            return 0.0
+
+        return round(values[min(len(values) - 1, int(q * len(values)))], 6)
@@ -0,0 +1,151 @@
+import errno
+import fcntl
+import os
+import socket
+
+# size of the chunks read by the fallback path
+FALLBACK_CHUNK_LEN = 65536
+
+# errors meaning that sendfile/splice is not implemented (by the kernel) at all
+UNAVAILABLE = (errno.ENOSYS,)
+
+# errors meaning that sendfile/splice can not be used for the given pair of file descriptors
+UNSUPPORTED = (errno.EINVAL, errno.ENOTSOCK, errno.EOPNOTSUPP)
+
+# whether os.sendfile is available and has not failed as not implemented yet
+sendfile_available = hasattr(os, 'sendfile')
+
+# whether os.splice (Linux) is available and has not failed as unsupported yet
+splice_available = hasattr(os, 'splice')
+
+# max number of bytes moved by a single splice, the pipe is resized to hold them (if allowed)
+SPLICE_CHUNK_LEN = 1 << 20
+
+
+class FileSegment:
+    """
+    A part of an opened file queued to be sent to a socket.
+    Attributes:
+        fd: The file descriptor of the file, it is not closed by the segment.
+        offset: Position in the file of the first byte that has not been sent yet.
+        count: Number of bytes remaining to be sent.
+        copy: Whether sendfile does not support the file, the rest is read and sent.
+    """
+
+    __slots__ = ('fd', 'offset', 'count', 'copy')
+
+    def __init__(self, fd: int, offset: int, count: int):
+        self.fd = fd
+        self.offset = offset
+        self.count = count
+        self.copy = False
+
+    def __len__(self):
+        return self.count
+
+
+def send_segment(sock: socket.socket, segment: FileSegment) -> int:
+    """
+    Send as much of the segment as the (non-blocking) socket accepts and advance the segment. Uses sendfile,
+    so the file contents go from the page cache to the socket without being copied to userspace, and falls back
+    to reading and sending the file when sendfile is not available, or does not support the file.
+    :param sock:
+    :param segment:
+    :return: Number of bytes sent.
+    :raises BlockingIOError: If the socket does not accept any data right now.
+    :raises OSError: If the file can not be read (e.g. it is a directory).
+    """
+    global sendfile_available
+
+    if sendfile_available and not segment.copy:
+        try:
+            sent = os.sendfile(sock.fileno(), segment.fd, segment.offset, segment.count)
+        except OSError as e:
+            if e.errno in UNAVAILABLE:
+                sendfile_available = False
+            elif e.errno in UNSUPPORTED:
+                # only this file, other files may still be sent with sendfile
+                segment.copy = True
+            else:
+                raise
+            return send_segment(sock, segment)
+    else:
+        data = os.pread(segment.fd, min(segment.count, FALLBACK_CHUNK_LEN), segment.offset)
+        sent = sock.send(data) if data else 0
+
+    if sent == 0:
+        # the file is shorter than expected (truncated in the meantime), there is nothing more to send
+        segment.count = 0
+        return 0
+
+    segment.offset += sent
+    segment.count -= sent
+    return sent
+
+
+class SpliceSink:
+    """
+    Moves data from a socket to an opened file in the kernel (socket -> pipe -> file), so the data is never copied
+    to userspace. Linux only, check `splice_available` before use.
+    Attributes:
+        fd: The file descriptor of the file, it is not closed by the sink.
+        offset: Position in the file the next received byte is written to.
+        count: Number of bytes remaining to be received.
+    """
+
+    def __init__(self, fd: int, offset: int, count: int):
+        self.fd = fd
+        self.offset = offset
+        self.count = count
+        self.__pipe_r, self.__pipe_w = os.pipe()
+        self.__chunk_len = SPLICE_CHUNK_LEN
+
+        if hasattr(fcntl, 'F_SETPIPE_SZ'):
+            try:
+                self.__chunk_len = fcntl.fcntl(self.__pipe_w, fcntl.F_SETPIPE_SZ, SPLICE_CHUNK_LEN)
+            except OSError:
+                # over the unprivileged limit (/proc/sys/fs/pipe-max-size), keep the default pipe size
+                self.__chunk_len = fcntl.fcntl(self.__pipe_w, fcntl.F_GETPIPE_SZ)
+
+    def receive(self, sock: socket.socket) -> int:
+        """
+        Move the data available in the (non-blocking) socket to the file, at most `count` bytes.
+        :param sock:
+        :return: Number of bytes moved, 0 if the socket has been closed by the peer.
+        :raises BlockingIOError: If there is no data available right now.
+        """
+        global splice_available
+
+        moved = os.splice(
+            sock.fileno(), self.__pipe_w, min(self.count, self.__chunk_len),
+            flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK
+        )
+        if moved == 0:
+            return 0
+
+        remaining = moved
+        while remaining > 0:
+            try:
+                written = os.splice(self.__pipe_r, self.fd, remaining, offset_dst=self.offset, flags=os.SPLICE_F_MOVE)
+            except OSError as e:
+                if e.errno not in UNAVAILABLE + UNSUPPORTED:
+                    raise
+                # the filesystem does not support splice, copy the data through userspace this time
+                splice_available = False
+                data, written = os.read(self.__pipe_r, remaining), 0
+                while written < len(data):
+                    written += os.pwrite(self.fd, data[written:], self.offset + written)
+
+            self.offset += written
+            remaining -= written
+
+        self.count -= moved
+        return moved
+
+    def close(self):
+        """
+        Close the pipe.
+        :return:
+        """
+        os.close(self.__pipe_r)
+        os.close(self.__pipe_w)
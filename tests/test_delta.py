@@ -0,0 +1,132 @@
+"""
+Round trips of the delta transfer: the receiver's file -> signatures -> encoded delta -> applied -> the sender's file.
+"""
+import hashlib
+import io
+import os
+import random
+import sys
+import tempfile
+import unittest
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')))
+
+import delta
+from helpers import ViewReader
+
+BLOCK_LEN = delta.MIN_BLOCK_LEN
+
+
+def random_bytes(n: int, seed: int) -> bytes:
+    return random.Random(seed).randbytes(n)
+
+
+class DeltaRoundTripTest(unittest.TestCase):
+
+    def round_trip(self, basis: bytes, new: bytes, part_len=None, **encoder_args):
+        """
+        Encode the new file against the basis, decode and apply the stream (fed in parts of `part_len`).
+        :return: (the encoder, the decoded operations)
+        """
+        signatures = delta.signatures(lambda n, offset: basis[offset:offset + n], len(basis), BLOCK_LEN)
+        encoder = delta.Encoder(delta.parse_signatures(signatures, len(basis), BLOCK_LEN), BLOCK_LEN, **encoder_args)
+        stream = b''.join(encoder.encode(io.BytesIO(new).read))
+
+        decoder = delta.Decoder(len(basis), BLOCK_LEN)
+        part_len = part_len or len(stream)
+        ops = []
+        for pos in range(0, len(stream), part_len):
+            ops += decoder.feed(ViewReader(memoryview(stream[pos:pos + part_len])))
+        self.assertTrue(decoder.done)
+
+        with tempfile.TemporaryFile() as basis_file, tempfile.TemporaryFile() as out_file:
+            basis_file.write(basis)
+            basis_file.flush()
+            digest = hashlib.sha256()
+            written = delta.apply(basis_file.fileno(), out_file.fileno(), ops, digest)
+
+            out_file.seek(0)
+            self.assertEqual(out_file.read(), new)
+
+        self.assertEqual(written, len(new))
+        self.assertEqual(digest.digest(), decoder.digest)
+        self.assertEqual(encoder.literal_len + encoder.copied_len, len(new))
+        return encoder, ops
+
+    def test_empty_basis(self):
+        new = random_bytes(3 * delta.MAX_LITERAL_LEN // 2, 1)
+        encoder, ops = self.round_trip(b'', new)
+
+        self.assertEqual(encoder.copied_len, 0)
+        # split into literals of at most MAX_LITERAL_LEN
+        self.assertEqual([len(op[1]) for op in ops], [delta.MAX_LITERAL_LEN, len(new) - delta.MAX_LITERAL_LEN])
+
+    def test_empty_file(self):
+        encoder, ops = self.round_trip(random_bytes(10 * BLOCK_LEN, 2), b'')
+        self.assertEqual(ops, [])
+
+    def test_unchanged(self):
+        # the last block is shorter than the others
+        basis = random_bytes(10 * BLOCK_LEN + 100, 3)
+        encoder, ops = self.round_trip(basis, basis, part_len=7)
+
+        self.assertEqual(encoder.literal_len, 0)
+        # the blocks are merged into a single copy
+        self.assertEqual(ops, [('copy', 0, len(basis))])
+
+    def test_unchanged_across_refills(self):
+        # the file is read in several parts, windows span the refills
+        basis = random_bytes(20 * BLOCK_LEN + 5, 4)
+        encoder, _ = self.round_trip(basis, basis, read_len=3 * BLOCK_LEN - 1)
+        self.assertEqual(encoder.literal_len, 0)
+
+    def test_insert_at_start(self):
+        basis = random_bytes(10 * BLOCK_LEN, 5)
+        encoder, ops = self.round_trip(basis, b'inserted' + basis)
+
+        self.assertEqual(encoder.literal_len, len(b'inserted'))
+        self.assertEqual(ops[-1], ('copy', 0, len(basis)))
+
+    def test_insert_at_block_boundary(self):
+        basis = random_bytes(10 * BLOCK_LEN, 6)
+        insert = random_bytes(BLOCK_LEN + 10, 7)
+        encoder, ops = self.round_trip(basis, basis[:4 * BLOCK_LEN] + insert + basis[4 * BLOCK_LEN:])
+
+        self.assertEqual(encoder.literal_len, len(insert))
+        self.assertEqual(ops[0], ('copy', 0, 4 * BLOCK_LEN))
+        self.assertEqual(ops[-1], ('copy', 4 * BLOCK_LEN, 6 * BLOCK_LEN))
+
+    def test_insert_across_refill(self):
+        basis = random_bytes(20 * BLOCK_LEN, 8)
+        new = basis[:5 * BLOCK_LEN + 3] + b'x' + basis[5 * BLOCK_LEN + 3:]
+        encoder, _ = self.round_trip(basis, new, read_len=6 * BLOCK_LEN)
+        self.assertLessEqual(encoder.literal_len, BLOCK_LEN + 1)
+
+    def test_truncated_tail(self):
+        basis = random_bytes(10 * BLOCK_LEN, 9)
+        encoder, ops = self.round_trip(basis, basis[:7 * BLOCK_LEN + 123])
+
+        self.assertEqual(encoder.literal_len, 123)
+        self.assertEqual(ops[0], ('copy', 0, 7 * BLOCK_LEN))
+
+    def test_appended_tail(self):
+        basis = random_bytes(10 * BLOCK_LEN + 100, 10)
+        encoder, _ = self.round_trip(basis, basis + b'appended')
+        # the receiver's short last block can only match the end of the file
+        self.assertEqual(encoder.literal_len, 100 + len(b'appended'))
+
+    def test_rewritten_file(self):
+        basis = random_bytes(10 * BLOCK_LEN, 11)
+        encoder, _ = self.round_trip(basis, random_bytes(12 * BLOCK_LEN, 12))
+        self.assertEqual(encoder.copied_len, 0)
+
+    def test_probing_after_roll_limit(self):
+        # the blocks after a long rewritten run are found at the probed (aligned) positions
+        basis = random_bytes(10 * BLOCK_LEN, 13)
+        new = random_bytes(4 * BLOCK_LEN, 14) + basis[4 * BLOCK_LEN:]
+        encoder, _ = self.round_trip(basis, new, max_roll_blocks=1)
+        self.assertEqual(encoder.copied_len, 6 * BLOCK_LEN)
+
+
+if __name__ == '__main__':
+    unittest.main()